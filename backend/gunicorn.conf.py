@@ -0,0 +1,30 @@
+# gunicorn -c gunicorn.conf.py patient_management.wsgi
+#
+# Workers are threaded (gthread): request coalescing and admission control
+# act on the requests one process serves at the same time, and a sync worker
+# only ever serves one. WSGI workers do not serve the live change stream at
+# /api/events/ (a stream would pin a thread for EVENTS_MAX_STREAM_SECONDS),
+# so pages served this way have no live updates. To serve it, run the ASGI application on uvicorn's
+# worker class, where a stream is an idle coroutine:
+#
+#   GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker \
+#       gunicorn -c gunicorn.conf.py patient_management.asgi:application
+#
+# preload_app imports the application (and runs patients.warmup.warm_up)
+# once in the master, so every worker starts with the modules imported,
+# templates compiled and caches primed; worker_exit writes out the
+# worker's buffered audit events. Each worker
+# starts its own audit flush thread with its first event (patients/audit.py);
+# the master never runs one.
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+preload_app = True
+
+
+def worker_exit(server, worker):
+    from patients import audit
+    audit.flush()
@@ -14,3 +14,13 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'patient_management.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.WARMUP_ENABLED:
+    from patients.warmup import warm_up
+    warm_up()
+
+if settings.AUDIT_ENABLED:
+    from patients import audit
+    audit.run_in_background()
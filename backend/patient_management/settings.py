@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 from pathlib import Path
+import json
 import os
 from dotenv import load_dotenv
 
@@ -43,11 +44,16 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'patients.profiling.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'patients.tenancy.ClinicMiddleware',
+    'patients.audit.AuditMiddleware',
+    'patients.coalescing.CoalescingMiddleware',
+    'patients.middleware.AdmissionControlMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -83,6 +89,13 @@ DATABASES = {
     }
 }
 
+# Extra aliases for clinics with their own database, as JSON overrides of the
+# default connection, e.g. {"clinic_north": {"NAME": "clinic_north_db"}}
+for alias, overrides in json.loads(os.getenv('EXTRA_DATABASES', '{}')).items():
+    DATABASES[alias] = {**DATABASES['default'], **overrides}
+
+DATABASE_ROUTERS = ['patients.tenancy.ClinicRouter']
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -106,6 +119,16 @@ USE_I18N = True
 
 USE_TZ = True
 
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'patient-management'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', '100000')),
+        },
+    }
+}
+
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 
@@ -135,3 +158,199 @@ CORS_ALLOWED_ORIGINS = os.getenv(
 ).split(',')
 
 CORS_ALLOW_CREDENTIALS = True
+
+# Visit table partitioning (PostgreSQL only, see patients/partitioning.py)
+VISIT_PARTITION_INTERVAL = os.getenv('VISIT_PARTITION_INTERVAL', 'month')
+VISIT_PARTITIONS_AHEAD = int(os.getenv('VISIT_PARTITIONS_AHEAD', '3'))
+
+# Visits older than this are moved to the archive tables by archive_visits
+ARCHIVE_VISITS_OLDER_THAN_DAYS = int(os.getenv('ARCHIVE_VISITS_OLDER_THAN_DAYS', '730'))
+
+# Rows per Parquet row group in export_snapshot / the snapshot endpoint
+SNAPSHOT_ROW_GROUP_SIZE = int(os.getenv('SNAPSHOT_ROW_GROUP_SIZE', '100000'))
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', str(BASE_DIR / 'snapshots'))
+
+# /api/changes/ outbox feed
+CHANGE_FEED_PAGE_SIZE = int(os.getenv('CHANGE_FEED_PAGE_SIZE', '500'))
+CHANGE_FEED_MAX_WAIT = int(os.getenv('CHANGE_FEED_MAX_WAIT', '25'))
+CHANGE_FEED_POLL_INTERVAL = float(os.getenv('CHANGE_FEED_POLL_INTERVAL', '0.5'))
+# Seconds events are held back so transactions that took a lower seq can commit
+CHANGE_FEED_SAFETY_LAG = float(os.getenv('CHANGE_FEED_SAFETY_LAG', '2'))
+CHANGE_FEED_RETENTION_DAYS = int(os.getenv('CHANGE_FEED_RETENTION_DAYS', '30'))
+
+# /api/sync/ delta sync
+SYNC_CHECKPOINT_OVERLAP = int(os.getenv('SYNC_CHECKPOINT_OVERLAP', '5'))
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.getenv('SYNC_TOMBSTONE_RETENTION_DAYS', '90'))
+SYNC_PAGE_SIZE = int(os.getenv('SYNC_PAGE_SIZE', '1000'))
+
+# Patient listing row cache (patients/listing_cache.py)
+LISTING_ROW_CACHE = os.getenv('LISTING_ROW_CACHE', 'default')
+LISTING_ROW_CACHE_MAX_TIMEOUT = int(os.getenv('LISTING_ROW_CACHE_MAX_TIMEOUT', str(7 * 24 * 3600)))
+
+# Patient/Visit object cache (patients/object_cache.py); set
+# OBJECT_CACHE_BACKEND to a CACHES alias to share fills between workers.
+# Other workers' local copies are only dropped on write with
+# EVENTS_BACKEND=postgres, else they expire after OBJECT_CACHE_TIMEOUT
+OBJECT_CACHE_SIZE = int(os.getenv('OBJECT_CACHE_SIZE', '10000'))
+OBJECT_CACHE_TIMEOUT = int(os.getenv('OBJECT_CACHE_TIMEOUT', '300'))
+OBJECT_CACHE_NEGATIVE_TTL = int(os.getenv('OBJECT_CACHE_NEGATIVE_TTL', '30'))
+OBJECT_CACHE_BACKEND = os.getenv('OBJECT_CACHE_BACKEND', '')
+
+# Admission control (patients/middleware.py): concurrent requests per route
+# class, how long a request may queue for a slot, and how many may queue.
+# Counts are per worker process, so they only bite below the number of
+# threads a worker serves (GUNICORN_THREADS in gunicorn.conf.py). Queued
+# requests hold a thread too, so from 4 threads up the defaults keep the
+# running plus queued reads of all other classes below
+# ADMISSION_CONTROL_THREADS - ADMISSION_CONTROL_WRITE_RESERVE, leaving
+# those threads to writes. Change-feed long polls (up to 25s) get their own
+# class that never queues
+ADMISSION_CONTROL_ENABLED = os.getenv('ADMISSION_CONTROL_ENABLED', 'True') == 'True'
+ADMISSION_CONTROL_THREADS = int(os.getenv('GUNICORN_THREADS', '8'))
+ADMISSION_CONTROL_WRITE_RESERVE = max(1, ADMISSION_CONTROL_THREADS // 4)
+ADMISSION_CONTROL_SHARED = ADMISSION_CONTROL_THREADS - ADMISSION_CONTROL_WRITE_RESERVE
+ADMISSION_CONTROL_MAX_QUEUE = {
+    'write': int(os.getenv('ADMISSION_WRITE_MAX_QUEUE', '200')),
+    'interactive': int(os.getenv('ADMISSION_INTERACTIVE_MAX_QUEUE', str(ADMISSION_CONTROL_SHARED // 6))),
+    'report': int(os.getenv('ADMISSION_REPORT_MAX_QUEUE', str(ADMISSION_CONTROL_SHARED // 12))),
+    'poll': int(os.getenv('ADMISSION_POLL_MAX_QUEUE', '0')),
+}
+ADMISSION_CONTROL_LIMITS = {
+    'write': int(os.getenv('ADMISSION_WRITE_LIMIT', str(ADMISSION_CONTROL_THREADS))),
+    'report': int(os.getenv('ADMISSION_REPORT_LIMIT', str(max(1, ADMISSION_CONTROL_SHARED // 6)))),
+    'poll': int(os.getenv('ADMISSION_POLL_LIMIT', str(max(1, ADMISSION_CONTROL_SHARED // 6)))),
+}
+ADMISSION_CONTROL_LIMITS['interactive'] = int(os.getenv('ADMISSION_INTERACTIVE_LIMIT', str(max(1, (
+    ADMISSION_CONTROL_SHARED - ADMISSION_CONTROL_LIMITS['report'] - ADMISSION_CONTROL_LIMITS['poll']
+    - ADMISSION_CONTROL_MAX_QUEUE['report'] - ADMISSION_CONTROL_MAX_QUEUE['interactive']
+)))))
+ADMISSION_CONTROL_QUEUE_TIMEOUTS = {
+    'write': float(os.getenv('ADMISSION_WRITE_TIMEOUT', '10')),
+    'interactive': float(os.getenv('ADMISSION_INTERACTIVE_TIMEOUT', '2')),
+    'report': float(os.getenv('ADMISSION_REPORT_TIMEOUT', '0.5')),
+    'poll': float(os.getenv('ADMISSION_POLL_TIMEOUT', '0')),
+}
+ADMISSION_CONTROL_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '2'))
+ADMISSION_CONTROL_WRITE_PATHS = [
+    r'^/patients/register/',
+    r'^/patients/vitals/',
+    r'^/patients/assessment/',
+    r'^/patients/$',
+]
+ADMISSION_CONTROL_REPORT_PATHS = [
+    r'^/patients/listing/$',
+    r'^/api/(patients|visits|assessments)/$',
+    r'^/api/snapshot/',
+    r'^/api/sync/',
+]
+ADMISSION_CONTROL_POLL_PATHS = [
+    r'^/api/changes/',
+]
+ADMISSION_CONTROL_EXEMPT_PATHS = [
+    r'^/static/',
+    r'^/api/events/',
+    r'^/api/metrics/',
+]
+
+# Admin changelists show the planner's estimate instead of COUNT(*) above this size
+ADMIN_ESTIMATED_COUNT_THRESHOLD = int(os.getenv('ADMIN_ESTIMATED_COUNT_THRESHOLD', '100000'))
+
+# Duplicate-patient detection (patients/duplicates.py)
+DUPLICATE_SCORE_THRESHOLD = float(os.getenv('DUPLICATE_SCORE_THRESHOLD', '0.85'))
+DUPLICATE_CANDIDATE_LIMIT = int(os.getenv('DUPLICATE_CANDIDATE_LIMIT', '5'))
+DUPLICATE_MAX_BLOCK_SIZE = int(os.getenv('DUPLICATE_MAX_BLOCK_SIZE', '200'))
+
+# Background jobs (patients/jobs.py, manage.py run_worker)
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETRY_BACKOFF = int(os.getenv('JOB_RETRY_BACKOFF', '30'))
+JOB_LOCK_TIMEOUT = int(os.getenv('JOB_LOCK_TIMEOUT', '3600'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+
+# Per-request profiling (patients/profiling.py); captures are listed at /admin/profiles/
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_TOKEN_MAX_AGE = int(os.getenv('PROFILING_TOKEN_MAX_AGE', '3600'))
+PROFILING_DIR = os.getenv('PROFILING_DIR', str(BASE_DIR / 'profiles'))
+PROFILING_MAX_PROFILES = int(os.getenv('PROFILING_MAX_PROFILES', '200'))
+
+# Start-up warm-up run by wsgi.py/asgi.py (patients/warmup.py)
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'True') == 'True'
+WARMUP_PRIME_LIMIT = int(os.getenv('WARMUP_PRIME_LIMIT', '500'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'patients': {
+            'handlers': ['console'],
+            'level': os.getenv('PATIENTS_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
+# Pending-assessment queue (/api/visits/pending-assessment/)
+PENDING_ASSESSMENT_LIMIT = int(os.getenv('PENDING_ASSESSMENT_LIMIT', '500'))
+PENDING_ASSESSMENT_CURSOR_OVERLAP = int(os.getenv('PENDING_ASSESSMENT_CURSOR_OVERLAP', '5'))
+
+# Multi-clinic tenancy (patients/tenancy.py)
+DEFAULT_CLINIC = os.getenv('DEFAULT_CLINIC', '')
+CLINIC_CACHE_SECONDS = int(os.getenv('CLINIC_CACHE_SECONDS', '60'))
+
+# Single-flight coalescing of identical GETs (patients/coalescing.py). Each
+# route may keep responses for ``ttl`` seconds; ``vary`` is 'user' for pages
+# that show the user's name, 'permissions' otherwise. Override as JSON.
+COALESCING_ENABLED = os.getenv('COALESCING_ENABLED', 'True') == 'True'
+COALESCING_ROUTES = json.loads(os.getenv('COALESCING_ROUTES', 'null')) or [
+    {'pattern': r'^/patients/listing/$', 'ttl': 0, 'vary': 'user'},
+    {'pattern': r'^/api/(patients|visits|assessments)/$', 'ttl': 0, 'vary': 'permissions'},
+    {'pattern': r'^/api/visits/pending-assessment/$', 'ttl': 0, 'vary': 'permissions'},
+    {'pattern': r'^/api/dashboard/daily/$', 'ttl': 5, 'vary': 'permissions'},
+]
+COALESCING_WAIT_TIMEOUT = float(os.getenv('COALESCING_WAIT_TIMEOUT', '10'))
+COALESCING_CACHE_SIZE = int(os.getenv('COALESCING_CACHE_SIZE', '500'))
+
+# Live change notifications over server-sent events (patients/events.py):
+# 'local' (in-process) or 'postgres' (LISTEN/NOTIFY across processes)
+EVENTS_BACKEND = os.getenv('EVENTS_BACKEND', 'local')
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', '15'))
+EVENTS_MAX_STREAM_SECONDS = float(os.getenv('EVENTS_MAX_STREAM_SECONDS', '300'))
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', '100'))
+EVENTS_REPLAY_LIMIT = int(os.getenv('EVENTS_REPLAY_LIMIT', '200'))
+EVENTS_RETRY_MS = int(os.getenv('EVENTS_RETRY_MS', '3000'))
+# Serve streams under WSGI too; each open page then holds a worker thread
+EVENTS_WSGI_STREAMS = os.getenv('EVENTS_WSGI_STREAMS', 'False') == 'True'
+
+# Access audit log (patients/audit.py): events are buffered per process and
+# written in batches to the AuditEvent table ('database') or appended as JSON
+# lines to AUDIT_FILE ('file')
+AUDIT_ENABLED = os.getenv('AUDIT_ENABLED', 'True') == 'True'
+AUDIT_BACKEND = os.getenv('AUDIT_BACKEND', 'database')
+AUDIT_FILE = os.getenv('AUDIT_FILE', str(BASE_DIR / 'audit.jsonl'))
+AUDIT_BUFFER_SIZE = int(os.getenv('AUDIT_BUFFER_SIZE', '10000'))
+AUDIT_FLUSH_SIZE = int(os.getenv('AUDIT_FLUSH_SIZE', '200'))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '2'))
+
+# Patient type-ahead (/api/patients/autocomplete/)
+AUTOCOMPLETE_LIMIT = int(os.getenv('AUTOCOMPLETE_LIMIT', '10'))
+AUTOCOMPLETE_MIN_LENGTH = int(os.getenv('AUTOCOMPLETE_MIN_LENGTH', '1'))
+
+# Growth reference for children's BMI-for-age z-scores (patients/growth.py):
+# 'who' (0-19 years) or 'cdc' (2-20 years). Rescore stored visits after a
+# change with ``manage.py visits_maintenance --fix``
+PEDIATRIC_BMI_REFERENCE = os.getenv('PEDIATRIC_BMI_REFERENCE', 'who')
+
+# Slow-query log (patients/slow_queries.py, manage.py query_report): statements
+# over the threshold are appended to SLOW_QUERY_LOG, and a sample of slow
+# SELECTs gets its EXPLAIN plan captured
+SLOW_QUERY_ENABLED = os.getenv('SLOW_QUERY_ENABLED', 'False') == 'True'
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200'))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', '0.1'))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', str(BASE_DIR / 'slow_queries.jsonl'))
+SLOW_QUERY_WATCHED_TABLES = os.getenv(
+    'SLOW_QUERY_WATCHED_TABLES', 'patients_patient,patients_visit'
+).split(',')
@@ -17,8 +17,15 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import RedirectView
+from patients import admin_views
 
 urlpatterns = [
+    path('admin/profiles/', admin.site.admin_view(admin_views.profile_list), name='admin_profiles'),
+    path(
+        'admin/profiles/<str:profile_id>/',
+        admin.site.admin_view(admin_views.profile_detail),
+        name='admin_profile_detail'
+    ),
     path('admin/', admin.site.urls),
     path('api/', include('patients.urls')),
     path('patients/', include('patients.template_urls')),
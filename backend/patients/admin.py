@@ -1,33 +1,108 @@
 from django.contrib import admin
-from .models import Patient, Visit, Assessment
+from .models import (
+    Clinic, Patient, Visit, Assessment, ArchivedVisit, ArchiveSummary, Job, DailyClinicStats, AuditEvent
+)
+from .pagination import EstimatedCountPaginator
+
+
+@admin.register(Clinic)
+class ClinicAdmin(admin.ModelAdmin):
+    list_display = ['code', 'name', 'database', 'created_at']
+    search_fields = ['code', 'name']
+    readonly_fields = ['created_at']
 
 
 @admin.register(Patient)
 class PatientAdmin(admin.ModelAdmin):
-    list_display = ['patient_id', 'full_name', 'date_of_birth', 'gender', 'age', 'registration_date']
-    list_filter = ['gender', 'registration_date']
-    search_fields = ['patient_id', 'first_name', 'middle_name', 'last_name']
+    list_display = ['patient_id', 'full_name', 'date_of_birth', 'gender', 'age', 'clinic', 'registration_date']
+    list_filter = ['clinic', 'gender', 'registration_date']
+    search_fields = ['^patient_id', '^last_name', '^first_name']
     readonly_fields = ['registration_date', 'created_at', 'updated_at', 'age']
     ordering = ['-registration_date']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Visit)
 class VisitAdmin(admin.ModelAdmin):
-    list_display = ['patient', 'visit_date', 'height', 'weight', 'bmi', 'get_bmi_status']
-    list_filter = ['visit_date']
-    search_fields = ['patient__patient_id', 'patient__first_name', 'patient__middle_name', 'patient__last_name']
-    readonly_fields = ['bmi', 'created_at', 'updated_at']
+    list_display = ['patient', 'visit_date', 'height', 'weight', 'bmi', 'bmi_status']
+    list_filter = ['bmi_status', 'visit_date']
+    list_select_related = ['patient']
+    search_fields = ['^patient__patient_id', '^patient__last_name']
+    autocomplete_fields = ['patient']
+    readonly_fields = ['bmi', 'bmi_status', 'created_at', 'updated_at']
     ordering = ['-visit_date']
-    
-    def get_bmi_status(self, obj):
-        return obj.get_bmi_status()
-    get_bmi_status.short_description = 'BMI Status'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Assessment)
 class AssessmentAdmin(admin.ModelAdmin):
     list_display = ['visit', 'assessment_type', 'general_health', 'created_at']
     list_filter = ['assessment_type', 'general_health', 'created_at']
-    search_fields = ['visit__patient__patient_id', 'visit__patient__first_name', 'visit__patient__middle_name', 'visit__patient__last_name']
+    list_select_related = ['visit', 'visit__patient']
+    search_fields = ['^visit__patient__patient_id', '^visit__patient__last_name']
+    raw_id_fields = ['visit']
     readonly_fields = ['created_at', 'updated_at']
     ordering = ['-created_at']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(ArchivedVisit)
+class ArchivedVisitAdmin(admin.ModelAdmin):
+    list_display = ['original_id', 'patient', 'visit_date', 'bmi', 'assessment_type', 'archived_at']
+    list_filter = ['assessment_type']
+    search_fields = ['patient__patient_id']
+    raw_id_fields = ['patient']
+    ordering = ['-visit_date']
+
+
+@admin.register(ArchiveSummary)
+class ArchiveSummaryAdmin(admin.ModelAdmin):
+    list_display = ['patient', 'visit_count', 'assessment_count', 'first_visit_date', 'last_visit_date']
+    search_fields = ['patient__patient_id']
+    raw_id_fields = ['patient']
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'name', 'status', 'priority', 'attempts', 'progress', 'created_at', 'finished_at']
+    list_filter = ['status', 'name']
+    readonly_fields = ['locked_by', 'locked_at', 'result', 'error', 'created_at', 'updated_at', 'finished_at']
+    ordering = ['-created_at']
+
+
+@admin.register(DailyClinicStats)
+class DailyClinicStatsAdmin(admin.ModelAdmin):
+    list_display = [
+        'date',
+        'visits',
+        'underweight',
+        'normal',
+        'overweight',
+        'general_assessments',
+        'overweight_assessments',
+        'updated_at'
+    ]
+    date_hierarchy = 'date'
+    ordering = ['-date']
+
+
+@admin.register(AuditEvent)
+class AuditEventAdmin(admin.ModelAdmin):
+    list_display = ['occurred_at', 'username', 'action', 'patient_pk', 'visit_pk', 'assessment_pk', 'path', 'status']
+    list_filter = ['action']
+    search_fields = ['username', 'path']
+    ordering = ['-occurred_at']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.contrib import admin
+from django.http import Http404
+from django.template.response import TemplateResponse
+
+from . import profiling
+
+
+def profile_list(request):
+    context = {
+        **admin.site.each_context(request),
+        'title': 'Request profiles',
+        'profiles': profiling.list_profiles(),
+        'enabled': settings.PROFILING_ENABLED,
+    }
+    return TemplateResponse(request, 'admin/profiles/list.html', context)
+
+
+def profile_detail(request, profile_id):
+    try:
+        meta = profiling.load(profile_id)
+        tree = profiling.call_tree(profile_id)
+    except (ValueError, FileNotFoundError):
+        raise Http404('Profile not found')
+    context = {
+        **admin.site.each_context(request),
+        'title': f"{meta['method']} {meta.get('route') or '(unresolved)'}",
+        'profile': meta,
+        'tree': tree,
+        'flame_rows': profiling.flame_rows(tree),
+        'slowest_queries': sorted(meta['queries'], key=lambda q: -q['ms'])[:20],
+    }
+    return TemplateResponse(request, 'admin/profiles/detail.html', context)
@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class PatientsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'patients'
+
+    def ready(self):
+        from . import signals, tasks  # noqa: F401
+        from .partitioning import ensure_partitions_after_migrate
+        post_migrate.connect(ensure_partitions_after_migrate, sender=self)
+        if settings.SLOW_QUERY_ENABLED:
+            from .slow_queries import install
+            connection_created.connect(install)
@@ -0,0 +1,206 @@
+"""
+Cold archive tier for old visits and their assessments.
+
+``archive_visits`` moves Visit and Assessment rows older than a cutoff into
+``ArchivedVisit`` (one denormalized row per visit) and keeps an
+``ArchiveSummary`` stub per patient. The API reads through to the archive
+only when a request asks for it (``include_archived=true``) or when one of
+its date filters reaches back into the archived range.
+"""
+import heapq
+from datetime import date, datetime, timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max
+
+from . import changes, daily_stats
+from .models import Visit, Assessment, ArchivedVisit, ArchiveSummary, bmi_status_expression
+
+DATE_PARAMS = ('visit_date', 'visit_date_from', 'visit_date_to')
+
+
+def parse_older_than(value):
+    """Accept either a number of days or an ISO date."""
+    value = str(value).strip()
+    if value.isdigit():
+        return date.today() - timedelta(days=int(value))
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def default_cutoff():
+    return date.today() - timedelta(days=settings.ARCHIVE_VISITS_OLDER_THAN_DAYS)
+
+
+def archived_through():
+    """Latest visit date held in the archive, or None if it is empty."""
+    return ArchivedVisit.objects.aggregate(latest=Max('visit_date'))['latest']
+
+
+def wants_archive(params):
+    """Decide from request query params whether archived rows are needed."""
+    if str(params.get('include_archived', '')).lower() in ('1', 'true', 'yes'):
+        return True
+    requested = []
+    for name in DATE_PARAMS:
+        value = params.get(name)
+        if value:
+            try:
+                requested.append(datetime.strptime(value, '%Y-%m-%d').date())
+            except ValueError:
+                continue
+    if not requested:
+        return False
+    latest = archived_through()
+    return latest is not None and min(requested) <= latest
+
+
+def filter_archived(queryset, params):
+    """Apply the VisitFilter date/patient parameters to ArchivedVisit rows."""
+    if params.get('visit_date'):
+        queryset = queryset.filter(visit_date=params['visit_date'])
+    if params.get('visit_date_from'):
+        queryset = queryset.filter(visit_date__gte=params['visit_date_from'])
+    if params.get('visit_date_to'):
+        queryset = queryset.filter(visit_date__lte=params['visit_date_to'])
+    if params.get('bmi_min'):
+        queryset = queryset.filter(bmi__gte=params['bmi_min'])
+    if params.get('bmi_max'):
+        queryset = queryset.filter(bmi__lte=params['bmi_max'])
+    if params.get('bmi_status'):
+        queryset = queryset.alias(bmi_status=bmi_status_expression(F('bmi'))).filter(bmi_status=params['bmi_status'])
+    if params.get('updated_since'):
+        queryset = queryset.filter(updated_at__gte=params['updated_since'])
+    if params.get('patient'):
+        queryset = queryset.filter(patient__id=params['patient'])
+    if params.get('patient_id'):
+        queryset = queryset.filter(patient__patient_id=params['patient_id'])
+    return queryset
+
+
+class _SortKey:
+    """Compares rows the way ``order_by(*ordering)`` with NULLs last does."""
+
+    def __init__(self, row, ordering):
+        self.values = [(getattr(row, name.lstrip('-')), name.startswith('-')) for name in ordering]
+
+    def __lt__(self, other):
+        for (mine, descending), (theirs, _) in zip(self.values, other.values):
+            if mine == theirs:
+                continue
+            if mine is None or theirs is None:
+                return theirs is None
+            return mine > theirs if descending else mine < theirs
+        return False
+
+
+def _order_by(queryset, ordering):
+    return queryset.order_by(*[
+        F(name[1:]).desc(nulls_last=True) if name.startswith('-') else F(name).asc(nulls_last=True)
+        for name in ordering
+    ], '-pk')
+
+
+class MergedVisits:
+    """
+    Hot and archived visits as one sequence in ``ordering`` (newest first by
+    default). Slicing reads only the first ``stop`` rows of each side in that
+    order and merges them, so a paginator fetches ``offset + limit`` rows per
+    table rather than both tables, and only the page is serialized.
+    """
+
+    def __init__(self, hot, archived, ordering=('-visit_date',)):
+        self.ordering = list(ordering)
+        self.hot = _order_by(hot, self.ordering)
+        self.archived = _order_by(archived, self.ordering)
+
+    def count(self):
+        return self.hot.count() + self.archived.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop = index.start or 0, index.stop
+        hot, archived = (self.hot, self.archived) if stop is None else (self.hot[:stop], self.archived[:stop])
+        merged = heapq.merge(hot, archived, key=lambda row: _SortKey(row, self.ordering))
+        return list(islice(merged, start, stop))
+
+
+def _archive_row(visit):
+    try:
+        assessment = visit.assessment
+    except Assessment.DoesNotExist:
+        assessment = None
+    row = ArchivedVisit(
+        original_id=visit.id,
+        patient_id=visit.patient_id,
+        visit_date=visit.visit_date,
+        height=visit.height,
+        weight=visit.weight,
+        bmi=visit.bmi,
+        created_at=visit.created_at,
+        updated_at=visit.updated_at,
+    )
+    if assessment is not None:
+        row.assessment_id = assessment.id
+        row.assessment_type = assessment.assessment_type
+        row.general_health = assessment.general_health
+        row.on_diet = assessment.on_diet
+        row.using_drugs = assessment.using_drugs
+        row.comments = assessment.comments
+        row.assessment_created_at = assessment.created_at
+    return row
+
+
+def _update_summaries(rows):
+    by_patient = {}
+    for row in rows:
+        by_patient.setdefault(row.patient_id, []).append(row)
+
+    for patient_id, patient_rows in by_patient.items():
+        summary, _ = ArchiveSummary.objects.select_for_update().get_or_create(patient_id=patient_id)
+        newest = max(patient_rows, key=lambda r: r.visit_date)
+        oldest = min(patient_rows, key=lambda r: r.visit_date)
+        summary.visit_count += len(patient_rows)
+        summary.assessment_count += sum(1 for r in patient_rows if r.assessment_id)
+        if summary.first_visit_date is None or oldest.visit_date < summary.first_visit_date:
+            summary.first_visit_date = oldest.visit_date
+        if summary.last_visit_date is None or newest.visit_date >= summary.last_visit_date:
+            summary.last_visit_date = newest.visit_date
+            summary.last_bmi = newest.bmi
+        summary.save()
+
+
+def archive_visits(cutoff, batch_size=1000, dry_run=False):
+    """
+    Move visits dated before ``cutoff`` into the archive in batches, each
+    batch in its own transaction. Returns the number of visits archived.
+    """
+    queryset = Visit.objects.filter(visit_date__lt=cutoff).order_by('id')
+    if dry_run:
+        return queryset.count()
+
+    archived = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                queryset.select_related('assessment').select_for_update(of=('self',))[:batch_size]
+            )
+            if not batch:
+                break
+            rows = [_archive_row(visit) for visit in batch]
+            ArchivedVisit.objects.bulk_create(rows)
+            _update_summaries(rows)
+            # Archived visits still count on the dashboard and are not deletions
+            # for change-feed consumers, sync clients or the pending queue.
+            with daily_stats.paused(), changes.paused():
+                Visit.objects.filter(id__in=[visit.id for visit in batch]).delete()
+            archived += len(batch)
+    return archived
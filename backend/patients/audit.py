@@ -0,0 +1,412 @@
+"""
+Buffered access audit log.
+
+``AuditMiddleware`` records who listed, viewed or changed which patient,
+visit or assessment for every request to a route in ``ROUTES`` - API,
+pages and admin, including responses served by request coalescing. Events
+go into a bounded per-process ring buffer instead of being inserted by the
+request; ``flush()`` writes them in one batch, either ``bulk_create`` into
+``AuditEvent`` (``AUDIT_BACKEND = 'database'``) or as JSON lines appended
+to ``AUDIT_FILE`` (``'file'``). While flushing, visit and assessment ids are
+resolved to their patient with one query per kind, so the log can be
+searched by patient.
+
+Server entrypoints (``wsgi.py``, ``asgi.py``) call ``run_in_background()``:
+each process then starts a daemon thread with its first event, which
+flushes every ``AUDIT_FLUSH_INTERVAL`` seconds, or as soon as
+``AUDIT_FLUSH_SIZE`` events are waiting, and the buffer is flushed at
+interpreter exit (gunicorn workers also flush in ``worker_exit``). A
+gunicorn master that preloads the application records nothing, so it never
+runs the thread, and a forked child gets fresh locks and an empty buffer.
+Listings record one event per patient on the page (see ``annotate()``).
+Elsewhere the request that fills the batch flushes it. If writing fails the
+events are put back; the oldest are only dropped once ``AUDIT_BUFFER_SIZE``
+is exceeded, and drops are counted in ``/api/metrics/``.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Assessment, AuditEvent, Patient, Visit
+from .tenancy import current_database, get_current_clinic
+
+logger = logging.getLogger(__name__)
+
+# URL name -> (URL kwarg holding the record's id, kind of record). Routes
+# without a kwarg are listings (or creates, whose id comes from the response);
+# ``patient_code`` is the patient's natural ``patient_id``.
+ROUTES = {
+    'patient-list': (None, 'patient'),
+    'patient-detail': ('pk', 'patient'),
+    'patient-visits': ('pk', 'patient'),
+    'patient-autocomplete': (None, None),
+    'visit-list': (None, 'visit'),
+    'visit-detail': ('pk', 'visit'),
+    'visit-assessment': ('pk', 'visit'),
+    'visit-pending-assessment': (None, None),
+    'assessment-list': (None, 'assessment'),
+    'assessment-detail': ('pk', 'assessment'),
+    'change-feed': (None, None),
+    'sync': (None, None),
+    'snapshot-export': (None, None),
+    'patient_listing': (None, None),
+    'patient_listing_row': ('pk', 'patient'),
+    'pending_assessments': (None, None),
+    'pending_assessment_row': ('pk', 'visit'),
+    'patient_registration': (None, None),
+    'vitals_form': ('patient_id', 'patient_code'),
+    'general_assessment': ('visit_id', 'visit'),
+    'overweight_assessment': ('visit_id', 'visit'),
+    'admin:patients_patient_changelist': (None, None),
+    'admin:patients_patient_change': ('object_id', 'patient'),
+    'admin:patients_patient_delete': ('object_id', 'patient'),
+    'admin:patients_visit_changelist': (None, None),
+    'admin:patients_visit_change': ('object_id', 'visit'),
+    'admin:patients_visit_delete': ('object_id', 'visit'),
+    'admin:patients_assessment_changelist': (None, None),
+    'admin:patients_assessment_change': ('object_id', 'assessment'),
+    'admin:patients_assessment_delete': ('object_id', 'assessment'),
+}
+
+METHOD_ACTIONS = {'POST': 'create', 'PUT': 'update', 'PATCH': 'update', 'DELETE': 'delete'}
+# Admin pages POST to existing records: change forms, delete confirmations, changelist actions.
+ADMIN_POST_ACTIONS = {'_change': 'update', '_delete': 'delete', '_changelist': 'update'}
+COLUMNS = ['occurred_at', 'user_id', 'username', 'action', 'clinic_id', 'patient_pk', 'visit_pk', 'assessment_pk', 'path', 'status']
+FILTERS = {
+    'user': 'user_id',
+    'username': 'username',
+    'action': 'action',
+    'clinic': 'clinic_id',
+    'patient': 'patient_pk',
+    'visit': 'visit_pk',
+    'assessment': 'assessment_pk',
+}
+
+
+class AuditBuffer:
+    """Bounded FIFO of events waiting to be written, shared by the threads of one process."""
+
+    def __init__(self, size):
+        self.size = size
+        self.events = deque()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stats = {'recorded': 0, 'flushed': 0, 'batches': 0, 'failures': 0, 'dropped': 0}
+
+    def _trim(self):
+        while len(self.events) > self.size:
+            self.events.popleft()
+            self.stats['dropped'] += 1
+
+    def append(self, event):
+        """Add ``event``; return True when a flush is due."""
+        with self.lock:
+            self.events.append(event)
+            self.stats['recorded'] += 1
+            self._trim()
+            return len(self.events) >= settings.AUDIT_FLUSH_SIZE
+
+    def drain(self):
+        with self.lock:
+            batch = list(self.events)
+            self.events.clear()
+            return batch
+
+    def restore(self, batch):
+        """Put back a batch that could not be written, ahead of newer events."""
+        with self.lock:
+            self.events.extendleft(reversed(batch))
+            self.stats['failures'] += 1
+            self._trim()
+
+    def written(self, count):
+        with self.lock:
+            self.stats['flushed'] += count
+            self.stats['batches'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(
+                self.stats,
+                buffered=len(self.events),
+                backend=settings.AUDIT_BACKEND,
+                background=_flusher['pid'] == os.getpid(),
+            )
+
+
+buffer = AuditBuffer(settings.AUDIT_BUFFER_SIZE)
+
+
+def target(request):
+    """Return ``(action, kind, id)`` for an audited request, or None."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        # Responses replayed by request coalescing never reached URL resolution.
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+    if match.view_name not in ROUTES:
+        return None
+    kwarg, kind = ROUTES[match.view_name]
+    action = METHOD_ACTIONS.get(request.method, 'view' if kwarg else 'list')
+    if request.method == 'POST' and match.view_name.startswith('admin:'):
+        suffix = match.view_name[match.view_name.rindex('_'):]
+        action = ADMIN_POST_ACTIONS.get(suffix, action)
+    return action, kind, match.kwargs.get(kwarg) if kwarg else None
+
+
+def record(request, response):
+    found = target(request)
+    if found is None:
+        return
+    action, kind, value = found
+    if action == 'create' and value is None and response.status_code == 201:
+        created = getattr(response, 'data', None)
+        value = created.get('id') if isinstance(created, dict) else None
+    user = getattr(request, 'user', None)
+    authenticated = user is not None and user.is_authenticated
+    clinic = get_current_clinic()
+    event = {
+        'occurred_at': timezone.now(),
+        'user_id': user.pk if authenticated else None,
+        'username': user.get_username() if authenticated else '',
+        'action': action,
+        'clinic_id': clinic.pk if clinic is not None else None,
+        'database': current_database(),
+        'path': request.get_full_path()[:255],
+        'status': response.status_code,
+        'kind': kind,
+        'value': value,
+    }
+    # Ids a view only learned while handling the request; see annotate().
+    ids = getattr(request, 'audit_ids', {})
+    event.update({column: pk for column, pk in ids.items() if not isinstance(pk, list)})
+    events = [event]
+    for column, pks in ids.items():
+        if isinstance(pks, list):
+            events = [dict(each, **{column: pk}) for each in events for pk in pks] or events
+    if _flusher['enabled'] and _flusher['pid'] != os.getpid():
+        start_flusher()
+    due = False
+    for event in events:
+        due = buffer.append(event) or due
+    if due:
+        if _flusher['enabled']:
+            _flusher['wake'].set()
+        else:
+            flush()
+
+
+def annotate(request, **ids):
+    """
+    Attach ids of records a view created, e.g. ``annotate(request, visit=visit.pk)``,
+    or a list of the ids on a listing's page, recorded as one event each.
+    """
+    # DRF's Request does not forward attribute writes to the HttpRequest the middleware sees.
+    request = getattr(request, '_request', request)
+    request.audit_ids = {f'{kind}_pk': pk for kind, pk in ids.items()}
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _fill_parents(events, model, source, field, column, database):
+    missing = {event[source] for event in events if event[source] and event[field] is None}
+    if not missing:
+        return
+    parents = dict(model.all_clinics.using(database).filter(pk__in=missing).order_by().values_list('pk', column))
+    for event in events:
+        if event[source] and event[field] is None:
+            event[field] = parents.get(event[source])
+
+
+def resolve_ids(batch):
+    """Turn buffered events into rows, filling in the visit and patient of each record."""
+    for event in batch:
+        kind, value = event.pop('kind'), event.pop('value')
+        for column in ('patient_pk', 'visit_pk', 'assessment_pk'):
+            event.setdefault(column, None)
+        if kind == 'patient_code':
+            event['patient_code'] = value
+        elif kind is not None and event[f'{kind}_pk'] is None:
+            event[f'{kind}_pk'] = _as_int(value)
+
+    for database in {event['database'] for event in batch}:
+        events = [event for event in batch if event['database'] == database]
+        codes = {event['patient_code'] for event in events if event.get('patient_code')}
+        if codes:
+            by_code = dict(
+                Patient.all_clinics.using(database).filter(patient_id__in=codes).order_by().values_list('patient_id', 'pk')
+            )
+            for event in events:
+                if event.get('patient_code') and event['patient_pk'] is None:
+                    event['patient_pk'] = by_code.get(event['patient_code'])
+        _fill_parents(events, Assessment, 'assessment_pk', 'visit_pk', 'visit_id', database)
+        _fill_parents(events, Visit, 'visit_pk', 'patient_pk', 'patient_id', database)
+    return [{column: event[column] for column in COLUMNS} for event in batch]
+
+
+def write_database(rows):
+    with transaction.atomic(using='default'):
+        AuditEvent.objects.using('default').bulk_create(
+            [AuditEvent(**row) for row in rows],
+            batch_size=settings.AUDIT_FLUSH_SIZE
+        )
+
+
+def write_file(rows):
+    data = ''.join(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in rows).encode()
+    # One O_APPEND write per batch, so lines from several processes never interleave.
+    fd = os.open(settings.AUDIT_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+WRITERS = {'database': write_database, 'file': write_file}
+
+
+def flush():
+    """Write everything buffered in this process; return the number of events written."""
+    with buffer.flush_lock:
+        batch = buffer.drain()
+        if not batch:
+            return 0
+        try:
+            WRITERS[settings.AUDIT_BACKEND](resolve_ids([dict(event) for event in batch]))
+        except Exception:
+            logger.exception("Could not write %s audit events; keeping them buffered", len(batch))
+            buffer.restore(batch)
+            return 0
+        buffer.written(len(batch))
+        return len(batch)
+
+
+_flusher = {'enabled': False, 'pid': None, 'wake': None}
+_flusher_lock = threading.Lock()
+
+
+def _flush_forever(wake):
+    while True:
+        wake.wait(settings.AUDIT_FLUSH_INTERVAL)
+        wake.clear()
+        flush()
+        close_old_connections()
+
+
+def start_flusher():
+    """Start the flush thread in this process (again after a fork)."""
+    with _flusher_lock:
+        if _flusher['pid'] == os.getpid():
+            return
+        _flusher['pid'] = os.getpid()
+        _flusher['wake'] = threading.Event()
+        threading.Thread(
+            target=_flush_forever, args=(_flusher['wake'],), name='audit-flush', daemon=True
+        ).start()
+        atexit.register(flush)
+
+
+def run_in_background():
+    """
+    Flush on a timer from a daemon thread, and at exit; called by the server
+    entrypoints. The thread starts with the process's first event.
+    """
+    _flusher['enabled'] = True
+
+
+def _after_fork():
+    # A lock some other thread held at fork() stays held for good in the
+    # child, and the events buffered so far are the parent's to write.
+    global _flusher_lock
+    buffer.lock = threading.Lock()
+    buffer.flush_lock = threading.Lock()
+    buffer.events.clear()
+    _flusher_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def parse_filters(params):
+    """Validate ``/api/audit/`` query parameters; raises ValueError."""
+    filters = {}
+    for param, column in FILTERS.items():
+        value = params.get(param)
+        if value:
+            filters[column] = value if column in ('username', 'action') else int(value)
+    for param in ('since', 'until'):
+        value = params.get(param)
+        if value:
+            moment = parse_datetime(value)
+            if moment is None:
+                raise ValueError(f'{param} must be an ISO 8601 datetime')
+            filters[param] = timezone.make_aware(moment) if timezone.is_naive(moment) else moment
+    return filters
+
+
+def read_file(filters, since=None, until=None):
+    if not os.path.exists(settings.AUDIT_FILE):
+        return []
+    rows = []
+    with open(settings.AUDIT_FILE, encoding='utf-8') as fp:
+        for line in fp:
+            row = json.loads(line)
+            occurred_at = parse_datetime(row['occurred_at'])
+            if (since and occurred_at < since) or (until and occurred_at >= until):
+                continue
+            if all(row.get(column) == value for column, value in filters.items()):
+                rows.append(row)
+    rows.reverse()
+    return rows
+
+
+def query(filters):
+    """Stored events matching ``filters`` (see parse_filters), newest first."""
+    flush()
+    filters = dict(filters)
+    since, until = filters.pop('since', None), filters.pop('until', None)
+    if settings.AUDIT_BACKEND == 'file':
+        return read_file(filters, since, until)
+    events = AuditEvent.objects.using('default').filter(**filters)
+    if since:
+        events = events.filter(occurred_at__gte=since)
+    if until:
+        events = events.filter(occurred_at__lt=until)
+    return events.order_by('-occurred_at', '-id')
+
+
+class AuditMiddleware:
+    """Buffer an audit event for each request to an audited route."""
+
+    def __init__(self, get_response):
+        if not settings.AUDIT_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        record(request, response)
+        return response
@@ -0,0 +1,80 @@
+"""
+Patient type-ahead for the registration screen and API clients.
+
+``search(prefix)`` returns up to ``AUTOCOMPLETE_LIMIT`` rows of ``(id,
+patient_id, name)`` whose patient ID or last name starts with ``prefix``,
+ignoring case, patient ID matches first. Only those columns are read - no
+serializer and no per-row visit lookups.
+
+On PostgreSQL each column is one scan of the admin search index on
+``UPPER(column) text_pattern_ops`` (migration 0006). Those operators compare
+byte by byte, so a prefix is a single contiguous key range; ordering with
+``USING ~<~`` (the same operator class) lets the index return the matches
+already in order and the scan stops after ``LIMIT`` rows however common the
+prefix is. Other databases fall back to the ORM's ``istartswith``.
+"""
+from django.conf import settings
+from django.db import connections, router
+from django.db.models.functions import Upper
+
+from .models import Patient
+from .tenancy import get_current_clinic
+
+COLUMNS = ['id', 'patient_id', 'first_name', 'middle_name', 'last_name']
+SEARCH_FIELDS = ['patient_id', 'last_name']
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def display_name(first_name, middle_name, last_name):
+    return ' '.join(part for part in (first_name, middle_name, last_name) if part)
+
+
+def _postgres_matches(connection, field, prefix, limit):
+    quote = connection.ops.quote_name
+    key = f'UPPER({quote(field)}::text)'
+    clinic = get_current_clinic()
+    sql = (
+        f"SELECT {', '.join(quote(column) for column in COLUMNS)} "
+        f"FROM {quote(Patient._meta.db_table)} "
+        f"WHERE {key} LIKE UPPER(%s)"
+        + (f" AND {quote('clinic_id')} = %s" if clinic is not None else '')
+        + f" ORDER BY {key} USING ~<~ LIMIT %s"
+    )
+    params = [escape_like(prefix) + '%'] + ([clinic.pk] if clinic is not None else []) + [limit]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _orm_matches(field, prefix, limit):
+    return list(
+        Patient.objects.filter(**{f'{field}__istartswith': prefix})
+        .order_by(Upper(field))
+        .values_list(*COLUMNS)[:limit]
+    )
+
+
+def search(prefix, limit=None):
+    limit = limit or settings.AUTOCOMPLETE_LIMIT
+    connection = connections[router.db_for_read(Patient)]
+    rows = []
+    seen = set()
+    for field in SEARCH_FIELDS:
+        if connection.vendor == 'postgresql':
+            matches = _postgres_matches(connection, field, prefix, limit)
+        else:
+            matches = _orm_matches(field, prefix, limit)
+        for pk, patient_id, first_name, middle_name, last_name in matches:
+            if pk not in seen and len(rows) < limit:
+                seen.add(pk)
+                rows.append({
+                    'id': pk,
+                    'patient_id': patient_id,
+                    'name': display_name(first_name, middle_name, last_name),
+                })
+        if len(rows) >= limit:
+            break
+    return rows
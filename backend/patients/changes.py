@@ -0,0 +1,167 @@
+"""
+Transactional outbox for Patient, Visit and Assessment writes.
+
+Every create, update and delete appends a ``ChangeEvent`` from a
+``post_save``/``post_delete`` receiver. The models wrap ``save()`` in
+``transaction.atomic()`` and Django's deletion collector is already atomic,
+so the event commits or rolls back together with the row it describes,
+whichever path made the write (DRF, template views, admin or the shell).
+Bulk ``QuerySet.update()``/``bulk_create()`` bypass signals and therefore
+the outbox. Archiving deletes visits under ``paused()``: the rows move to
+the cold tier rather than disappear, so no delete is published.
+
+Sequence numbers are taken at insert but become visible at commit, so a
+transaction can commit an event below a ``seq`` a reader has already
+passed. ``fetch_changes`` therefore only returns events older than
+``CHANGE_FEED_SAFETY_LAG`` seconds and, on PostgreSQL, older than the
+start of the oldest transaction that is still writing; anything newer may
+still be overtaken and is served on a later call.
+
+Events carry the clinic of the row's patient and ``ChangeEvent.objects`` is
+clinic-scoped, so clinics sharing a database only see their own changes.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Patient, Visit, Assessment, ChangeEvent
+from .tenancy import get_current_clinic
+
+TRACKED_MODELS = {
+    Patient: 'patient',
+    Visit: 'visit',
+    Assessment: 'assessment',
+}
+
+_paused = ContextVar('changes_paused', default=False)
+
+
+@contextmanager
+def paused():
+    """Record no change events, tombstones or pending-queue moves for deletes."""
+    token = _paused.set(True)
+    try:
+        yield
+    finally:
+        _paused.reset(token)
+
+
+def recording():
+    return not _paused.get()
+
+
+def event_payload(instance):
+    if isinstance(instance, Patient):
+        return {'patient_id': instance.patient_id}
+    if isinstance(instance, Visit):
+        return {
+            'patient': instance.patient_id,
+            'visit_date': str(instance.visit_date),
+        }
+    if isinstance(instance, Assessment):
+        return {
+            'visit': instance.visit_id,
+            'assessment_type': instance.assessment_type,
+        }
+    return {}
+
+
+def clinic_of(instance, patient_pk):
+    """Clinic id of a tracked row: its patient's clinic."""
+    if isinstance(instance, Patient):
+        return instance.clinic_id
+    clinic = get_current_clinic()
+    if clinic is not None:
+        return clinic.pk
+    if patient_pk is None:
+        return None
+    return (
+        Patient.all_clinics.using(instance._state.db or 'default')
+        .filter(pk=patient_pk)
+        .values_list('clinic_id', flat=True)
+        .first()
+    )
+
+
+def record_change(instance, action, patient_pk):
+    # On the row's database, inside the write's transaction, wherever the router points.
+    return ChangeEvent.objects.using(instance._state.db).create(
+        clinic_id=clinic_of(instance, patient_pk),
+        model=TRACKED_MODELS[type(instance)],
+        object_id=instance.pk,
+        action=action,
+        payload=event_payload(instance),
+    )
+
+
+def latest_seq():
+    return ChangeEvent.objects.aggregate(latest=Max('seq'))['latest'] or 0
+
+
+def seq_before(moment):
+    return ChangeEvent.objects.filter(created_at__lt=moment).aggregate(latest=Max('seq'))['latest'] or 0
+
+
+def settled_before():
+    """
+    Events created before this moment can no longer be overtaken by a
+    transaction committing a lower ``seq``.
+    """
+    lag = timedelta(seconds=settings.CHANGE_FEED_SAFETY_LAG)
+    horizon = timezone.now() - lag
+    connection = connections[router.db_for_read(ChangeEvent)]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            # Only transactions that were assigned an xid have written anything.
+            cursor.execute(
+                "SELECT min(xact_start) FROM pg_stat_activity "
+                "WHERE backend_xid IS NOT NULL AND datname = current_database() "
+                "AND pid <> pg_backend_pid()"
+            )
+            oldest = cursor.fetchone()[0]
+        if oldest is not None:
+            horizon = min(horizon, oldest - lag)
+    return horizon
+
+
+def fetch_changes(after=0, limit=None, wait=0, settled=True):
+    """
+    Return events with ``seq > after``. When there are none and ``wait`` is
+    positive, poll until one arrives or ``wait`` seconds have passed. With
+    ``settled``, events that may still be overtaken are held back.
+    """
+    limit = min(limit or settings.CHANGE_FEED_PAGE_SIZE, settings.CHANGE_FEED_PAGE_SIZE)
+    wait = max(0, min(wait, settings.CHANGE_FEED_MAX_WAIT))
+    deadline = time.monotonic() + wait
+    while True:
+        events = ChangeEvent.objects.filter(seq__gt=after)
+        if settled:
+            events = events.filter(created_at__lt=settled_before())
+        events = list(events.order_by('seq')[:limit])
+        if events or time.monotonic() >= deadline:
+            return events
+        time.sleep(settings.CHANGE_FEED_POLL_INTERVAL)
+
+
+def compact_changes(before_seq):
+    """Keep only the newest event per object among events up to ``before_seq``."""
+    queryset = ChangeEvent.objects.filter(seq__lte=before_seq)
+    newest = (
+        queryset.values('model', 'object_id')
+        .annotate(newest=Max('seq'))
+        .values_list('newest', flat=True)
+    )
+    deleted, _ = queryset.exclude(seq__in=newest).delete()
+    return deleted
+
+
+def prune_changes(older_than):
+    """Delete events created before ``older_than`` (a datetime)."""
+    deleted, _ = ChangeEvent.objects.filter(created_at__lt=older_than).delete()
+    return deleted
@@ -0,0 +1,200 @@
+"""
+Single-flight coalescing of identical read requests.
+
+At shift start many terminals ask for the same listing or API page within a
+few seconds. ``CoalescingMiddleware`` lets the first GET for a configured
+route (the leader) run the view while identical concurrent requests in the
+same worker wait for its response instead of repeating the queries; this
+needs a worker that serves requests on several threads (gunicorn.conf.py
+runs gthread workers). Routes
+with a ``ttl`` also keep the response in a small in-process micro-cache for
+that many seconds; it is cleared whenever this worker saves or deletes a
+patient, visit or assessment.
+
+Requests are identical when method, path, query string, ``Accept`` header,
+clinic and the caller's identity match. Identity is either the user
+(``'vary': 'user'``, for pages that show the user's name) or their
+permission level (``'vary': 'permissions'``: anonymous, authenticated, staff
+or superuser, plus any ``Authorization`` header). Only plain 200 responses
+that set no cookies and did not use the CSRF token or modify the session
+are shared; otherwise followers run the view themselves.
+"""
+import hashlib
+import re
+import threading
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+
+from .object_cache import LRUCache
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.snapshot = None
+
+
+class Coalescer:
+    """In-flight computations and the micro-cache, keyed by request key."""
+
+    def __init__(self, cache_size):
+        self.cache = LRUCache(cache_size)
+        self.stats = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _count(self, route, name):
+        with self._lock:
+            counters = self.stats.setdefault(route, {
+                'requests': 0,
+                'computed': 0,
+                'coalesced': 0,
+                'cache_hits': 0,
+                'not_shareable': 0,
+                'wait_timeouts': 0,
+            })
+            counters[name] += 1
+
+    def join(self, key):
+        """Return ``(flight, is_leader)`` for ``key``."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def finish(self, key, flight, snapshot, ttl):
+        if snapshot is not None and ttl:
+            self.cache.set(key, snapshot, ttl)
+        flight.snapshot = snapshot
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.done.set()
+
+    def clear(self):
+        self.cache.clear()
+
+    def reset(self):
+        self.cache.clear()
+        with self._lock:
+            self.stats = {}
+
+    def get_stats(self):
+        with self._lock:
+            routes = {route: dict(counters) for route, counters in self.stats.items()}
+            in_flight = len(self._flights)
+        return {'routes': routes, 'in_flight': in_flight, 'cached_responses': len(self.cache)}
+
+
+coalescer = Coalescer(settings.COALESCING_CACHE_SIZE)
+
+
+def snapshot(request, response):
+    """Return a shareable copy of ``response``, or None if it is personal or not a plain 200."""
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return None
+    if request.META.get('CSRF_COOKIE_NEEDS_UPDATE'):
+        return None
+    session = getattr(request, 'session', None)
+    if session is not None and session.modified:
+        return None
+    # The audit log records the ids a listing showed for every request it answers.
+    return (response.status_code, response.content, list(response.items()), getattr(request, 'audit_ids', {}))
+
+
+def replay(snapshot, source, request):
+    status, content, headers, audit_ids = snapshot
+    request.audit_ids = audit_ids
+    response = HttpResponse(content, status=status)
+    for name, value in headers:
+        response[name] = value
+    response['X-Coalesced'] = source
+    return response
+
+
+class CoalescingMiddleware:
+    """Share one computation between identical concurrent GETs of configured routes."""
+
+    def __init__(self, get_response):
+        if not settings.COALESCING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.routes = [
+            (re.compile(route['pattern']), route.get('ttl', 0), route.get('vary', 'permissions'))
+            for route in settings.COALESCING_ROUTES
+        ]
+
+    def route_for(self, request):
+        if request.method != 'GET':
+            return None
+        for pattern, ttl, vary in self.routes:
+            if pattern.match(request.path_info):
+                return pattern.pattern, ttl, vary
+        return None
+
+    def identity(self, request, vary):
+        user = getattr(request, 'user', None)
+        if vary == 'user':
+            return f"user:{user.pk}" if user is not None and user.is_authenticated else 'anonymous'
+        if user is None or not user.is_authenticated:
+            level = 'anonymous'
+        elif user.is_superuser:
+            level = 'superuser'
+        elif user.is_staff:
+            level = 'staff'
+        else:
+            level = 'authenticated'
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if authorization:
+            level += ':' + hashlib.sha256(authorization.encode()).hexdigest()
+        return level
+
+    def key(self, request, vary):
+        clinic = getattr(request, 'clinic', None)
+        parts = [
+            request.method,
+            request.get_full_path(),
+            request.META.get('HTTP_ACCEPT', ''),
+            str(clinic.pk if clinic is not None else ''),
+            self.identity(request, vary),
+        ]
+        return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+    def __call__(self, request):
+        route = self.route_for(request)
+        if route is None:
+            return self.get_response(request)
+        name, ttl, vary = route
+        key = self.key(request, vary)
+        coalescer._count(name, 'requests')
+
+        if ttl:
+            cached = coalescer.cache.get(key)
+            if cached is not None:
+                coalescer._count(name, 'cache_hits')
+                return replay(cached, 'cache', request)
+
+        flight, leader = coalescer.join(key)
+        if not leader:
+            if not flight.done.wait(settings.COALESCING_WAIT_TIMEOUT):
+                coalescer._count(name, 'wait_timeouts')
+            elif flight.snapshot is not None:
+                coalescer._count(name, 'coalesced')
+                return replay(flight.snapshot, 'shared', request)
+            coalescer._count(name, 'computed')
+            return self.get_response(request)
+
+        shared = None
+        try:
+            coalescer._count(name, 'computed')
+            response = self.get_response(request)
+            shared = snapshot(request, response)
+            if shared is None:
+                coalescer._count(name, 'not_shareable')
+            return response
+        finally:
+            coalescer.finish(key, flight, shared, ttl)
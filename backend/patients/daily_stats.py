@@ -0,0 +1,260 @@
+"""
+Incremental per-day counters behind the clinic dashboard.
+
+Every Visit and Assessment write is reduced to the set of counters it
+contributes to, keyed by the patient's clinic and the visit date: for a visit, ``visits`` plus its BMI
+status; for an assessment, its type. ``pre_save`` records the contributions
+of the row as stored, ``post_save``/``post_delete`` apply the difference
+with ``F()`` increments inside the write's transaction, so the dashboard
+reads one row per day however many visits there are. ``manage.py
+reconcile_daily_stats`` recomputes the counters from the tables (including
+the archive) and repairs any drift.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.db import router, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from .duplicates import as_date
+from .models import Patient, Visit, Assessment, ArchivedVisit, DailyClinicStats, bmi_status
+from .tenancy import get_current_clinic
+
+STATUS_FIELDS = {
+    'Underweight': 'underweight',
+    'Normal': 'normal',
+    'Overweight': 'overweight',
+}
+ASSESSMENT_FIELDS = {
+    'general': 'general_assessments',
+    'overweight': 'overweight_assessments',
+}
+COUNTER_FIELDS = ['visits', 'underweight', 'normal', 'overweight', 'general_assessments', 'overweight_assessments']
+
+_paused = ContextVar('daily_stats_paused', default=False)
+
+
+@contextmanager
+def paused():
+    """Skip counter updates, e.g. while archiving moves visits between tables."""
+    token = _paused.set(True)
+    try:
+        yield
+    finally:
+        _paused.reset(token)
+
+
+def visit_contributions(clinic_id, visit_date, bmi):
+    visit_date = as_date(visit_date)
+    keys = {(clinic_id, visit_date, 'visits')}
+    status = bmi_status(bmi)
+    if status:
+        keys.add((clinic_id, visit_date, STATUS_FIELDS[status]))
+    return keys
+
+
+def _patient_clinic_id(patient_pk, using):
+    return Patient.all_clinics.using(using).filter(pk=patient_pk).values_list('clinic_id', flat=True).first()
+
+
+def _visit_clinic_id(visit):
+    if Visit.patient.is_cached(visit):
+        return visit.patient.clinic_id
+    return _patient_clinic_id(visit.patient_id, visit._state.db)
+
+
+def contributions(instance):
+    if isinstance(instance, Visit):
+        return visit_contributions(_visit_clinic_id(instance), instance.visit_date, instance.bmi)
+    try:
+        visit = instance.visit
+    except Visit.DoesNotExist:
+        return set()
+    return {(_visit_clinic_id(visit), as_date(visit.visit_date), ASSESSMENT_FIELDS[instance.assessment_type])}
+
+
+def stored_contributions(instance):
+    """Contributions of ``instance`` as currently stored in the database."""
+    if isinstance(instance, Visit):
+        row = (
+            Visit.all_clinics.filter(pk=instance.pk)
+            .values('visit_date', 'bmi', 'patient__clinic_id')
+            .first()
+        )
+        return visit_contributions(row['patient__clinic_id'], row['visit_date'], row['bmi']) if row else set()
+    row = (
+        Assessment.all_clinics.filter(pk=instance.pk)
+        .values('assessment_type', 'visit__visit_date', 'visit__patient__clinic_id')
+        .first()
+    )
+    if row is None:
+        return set()
+    return {(
+        row['visit__patient__clinic_id'],
+        row['visit__visit_date'],
+        ASSESSMENT_FIELDS[row['assessment_type']]
+    )}
+
+
+def apply(removed=(), added=()):
+    if _paused.get():
+        return
+    deltas = Counter()
+    for key in removed:
+        deltas[key] -= 1
+    for key in added:
+        deltas[key] += 1
+
+    by_day = {}
+    for (clinic_id, day, field), delta in deltas.items():
+        if delta:
+            by_day.setdefault((clinic_id, day), {})[field] = delta
+    now = timezone.now()
+    for (clinic_id, day), fields in by_day.items():
+        DailyClinicStats.objects.get_or_create(clinic_id=clinic_id, date=day)
+        DailyClinicStats.objects.filter(clinic_id=clinic_id, date=day).update(
+            updated_at=now,
+            **{field: F(field) + delta for field, delta in fields.items()}
+        )
+
+
+def record_previous(instance):
+    if instance.pk is not None and not instance._state.adding and not _paused.get():
+        instance._daily_stats_previous = stored_contributions(instance)
+
+
+def record_saved(instance, created):
+    previous = set() if created else getattr(instance, '_daily_stats_previous', set())
+    current = contributions(instance)
+    previous_days = {(clinic_id, day) for clinic_id, day, field in previous if field == 'visits'}
+    current_days = {(clinic_id, day) for clinic_id, day, field in current if field == 'visits'}
+    if isinstance(instance, Visit) and previous_days and previous_days != current_days:
+        # Moving a visit to another day moves its assessment too.
+        assessment_type = (
+            Assessment.all_clinics.filter(visit=instance).values_list('assessment_type', flat=True).first()
+        )
+        if assessment_type:
+            field = ASSESSMENT_FIELDS[assessment_type]
+            previous |= {(clinic_id, day, field) for clinic_id, day in previous_days}
+            current |= {(clinic_id, day, field) for clinic_id, day in current_days}
+    apply(removed=previous - current, added=current - previous)
+
+
+def record_deleted(instance):
+    apply(removed=contributions(instance))
+
+
+def compute(start, end):
+    """Counters for ``start``..``end`` (inclusive) per (clinic id, date), recomputed from the tables."""
+    totals = {}
+    visits = (
+        Visit.all_clinics.filter(visit_date__range=(start, end))
+        .values('patient__clinic_id', 'visit_date')
+        .annotate(
+            visits=Count('id'),
+            underweight=Count('id', filter=Q(bmi__lt=18.5)),
+            normal=Count('id', filter=Q(bmi__gte=18.5, bmi__lt=25)),
+            overweight=Count('id', filter=Q(bmi__gte=25)),
+            general_assessments=Count('assessment', filter=Q(assessment__assessment_type='general')),
+            overweight_assessments=Count('assessment', filter=Q(assessment__assessment_type='overweight')),
+        )
+        .order_by()
+    )
+    archived = (
+        ArchivedVisit.all_clinics.filter(visit_date__range=(start, end))
+        .values('patient__clinic_id', 'visit_date')
+        .annotate(
+            visits=Count('id'),
+            underweight=Count('id', filter=Q(bmi__lt=18.5)),
+            normal=Count('id', filter=Q(bmi__gte=18.5, bmi__lt=25)),
+            overweight=Count('id', filter=Q(bmi__gte=25)),
+            general_assessments=Count('id', filter=Q(assessment_type='general')),
+            overweight_assessments=Count('id', filter=Q(assessment_type='overweight')),
+        )
+        .order_by()
+    )
+    for row in list(visits) + list(archived):
+        key = (row['patient__clinic_id'], row['visit_date'])
+        day = totals.setdefault(key, dict.fromkeys(COUNTER_FIELDS, 0))
+        for field in COUNTER_FIELDS:
+            day[field] += row[field]
+    return totals
+
+
+def reconcile(start, end, dry_run=False):
+    """
+    Compare stored counters with recomputed ones for ``start``..``end`` on
+    the current clinic's database and fix the differences. Returns
+    ``{(clinic id, date): {field: (stored, actual)}}``.
+    """
+    with transaction.atomic(using=router.db_for_write(DailyClinicStats)):
+        stored = {
+            (row.clinic_id, row.date): row
+            for row in DailyClinicStats.objects.select_for_update().filter(date__range=(start, end))
+        }
+        actual = compute(start, end)
+        drift = {}
+        for key in sorted(set(stored) | set(actual), key=lambda key: (key[0] or 0, key[1])):
+            row = stored.get(key)
+            expected = actual.get(key, dict.fromkeys(COUNTER_FIELDS, 0))
+            differences = {
+                field: (getattr(row, field) if row else 0, expected[field])
+                for field in COUNTER_FIELDS
+                if (getattr(row, field) if row else 0) != expected[field]
+            }
+            if not differences:
+                continue
+            drift[key] = differences
+            if dry_run:
+                continue
+            if row is None:
+                DailyClinicStats.objects.create(clinic_id=key[0], date=key[1], **expected)
+            elif not any(expected.values()):
+                row.delete()
+            else:
+                DailyClinicStats.objects.filter(pk=row.pk).update(updated_at=timezone.now(), **expected)
+    return drift
+
+
+def date_range(params, default_days=30, max_days=366):
+    """Read ``start``/``end`` (ISO dates) or ``days`` from query params."""
+    end = params.get('end')
+    end = as_date(end) if end else timezone.localdate()
+    start = params.get('start')
+    if start:
+        start = as_date(start)
+    else:
+        days = int(params.get('days') or default_days)
+        if days < 1:
+            raise ValueError('days must be positive')
+        start = end - timedelta(days=days - 1)
+    if start > end:
+        raise ValueError('start must not be after end')
+    if (end - start).days >= max_days:
+        raise ValueError(f'at most {max_days} days can be shown')
+    return start, end
+
+
+def dashboard(start, end):
+    """
+    One entry per day from ``start`` to ``end``, newest first, zeros for
+    quiet days; for the current clinic, or summed over all clinics.
+    """
+    queryset = DailyClinicStats.objects.filter(date__range=(start, end))
+    clinic = get_current_clinic()
+    if clinic is not None:
+        rows = {row.date: row for row in queryset.filter(clinic=clinic)}
+    else:
+        rows = {
+            row['date']: DailyClinicStats(**row)
+            for row in queryset.values('date').annotate(**{field: Sum(field) for field in COUNTER_FIELDS}).order_by()
+        }
+    days = []
+    day = end
+    while day >= start:
+        days.append(rows.get(day) or DailyClinicStats(date=day))
+        day -= timedelta(days=1)
+    return days
@@ -0,0 +1,174 @@
+"""
+Duplicate-patient detection with blocking keys.
+
+Instead of comparing a registration against every patient, each patient is
+indexed under a handful of blocking keys:
+
+- ``ph:`` Soundex of last and first name plus the full date of birth, which
+  catches spelling variants of the same person;
+- ``tg:`` each trigram of the last name plus the birth year, which catches
+  typos that change the phonetic code.
+
+Only patients sharing a key are scored, so the registration check costs one
+indexed lookup and the full audit is linear in the number of key collisions
+rather than quadratic in the registry size.
+"""
+import unicodedata
+from datetime import date
+from difflib import SequenceMatcher
+from itertools import groupby
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from .models import Patient, PatientBlockingKey
+
+SOUNDEX_CODES = {
+    **dict.fromkeys('BFPV', '1'),
+    **dict.fromkeys('CGJKQSXZ', '2'),
+    **dict.fromkeys('DT', '3'),
+    'L': '4',
+    **dict.fromkeys('MN', '5'),
+    'R': '6',
+}
+
+
+def normalize(value):
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    return ''.join(c for c in value.upper() if c.isalpha())
+
+
+def soundex(value):
+    value = normalize(value)
+    if not value:
+        return ''
+    code = value[0]
+    previous = SOUNDEX_CODES.get(value[0], '')
+    for char in value[1:]:
+        digit = SOUNDEX_CODES.get(char, '')
+        if digit and digit != previous:
+            code += digit
+        if char not in 'HW':
+            previous = digit
+    return (code + '000')[:4]
+
+
+def trigrams(value):
+    value = normalize(value)
+    if len(value) < 3:
+        return {value} if value else set()
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def as_date(value):
+    # Views may save dates straight from POST data as ISO strings.
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def blocking_keys(first_name, last_name, date_of_birth):
+    date_of_birth = as_date(date_of_birth)
+    keys = {f"ph:{soundex(last_name)}:{soundex(first_name)}:{date_of_birth.isoformat()}"}
+    keys.update(f"tg:{gram}:{date_of_birth.year}" for gram in trigrams(last_name))
+    return keys
+
+
+def score(a, b):
+    """Similarity between two patients' identifying fields, from 0 to 1."""
+    name_a = f"{normalize(a['first_name'])} {normalize(a['last_name'])}"
+    name_b = f"{normalize(b['first_name'])} {normalize(b['last_name'])}"
+    name_score = SequenceMatcher(None, name_a, name_b).ratio()
+    if a['date_of_birth'] == b['date_of_birth']:
+        dob_score = 1.0
+    elif a['date_of_birth'].year == b['date_of_birth'].year:
+        dob_score = 0.5
+    else:
+        dob_score = 0.0
+    gender_score = 1.0 if a['gender'] == b['gender'] else 0.0
+    return round(0.6 * name_score + 0.3 * dob_score + 0.1 * gender_score, 4)
+
+
+def index_patient(patient):
+    """Replace the stored blocking keys for ``patient``."""
+    keys = blocking_keys(patient.first_name, patient.last_name, patient.date_of_birth)
+    using = patient._state.db or 'default'
+    with transaction.atomic(using=using):
+        PatientBlockingKey.objects.using(using).filter(patient=patient).delete()
+        PatientBlockingKey.objects.using(using).bulk_create([
+            PatientBlockingKey(patient=patient, key=key) for key in sorted(keys)
+        ])
+
+
+PATIENT_FIELDS = ('id', 'patient_id', 'first_name', 'last_name', 'date_of_birth', 'gender')
+
+
+def find_candidates(first_name, last_name, date_of_birth, gender, exclude_pk=None, limit=None):
+    """
+    Return existing patients that look like the given person, best match
+    first, as dicts with a ``score``.
+    """
+    limit = limit or settings.DUPLICATE_CANDIDATE_LIMIT
+    keys = blocking_keys(first_name, last_name, date_of_birth)
+    matches = PatientBlockingKey.objects.filter(key__in=keys)
+    if exclude_pk is not None:
+        matches = matches.exclude(patient_id=exclude_pk)
+    patient_pks = (
+        matches.values('patient_id')
+        .annotate(shared=Count('id'))
+        .order_by('-shared')
+        .values_list('patient_id', flat=True)[:settings.DUPLICATE_MAX_BLOCK_SIZE]
+    )
+
+    person = {
+        'first_name': first_name,
+        'last_name': last_name,
+        'date_of_birth': as_date(date_of_birth),
+        'gender': gender,
+    }
+    candidates = []
+    for row in Patient.objects.filter(pk__in=list(patient_pks)).values(*PATIENT_FIELDS):
+        row['score'] = score(person, row)
+        if row['score'] >= settings.DUPLICATE_SCORE_THRESHOLD:
+            candidates.append(row)
+    candidates.sort(key=lambda row: row['score'], reverse=True)
+    return candidates[:limit]
+
+
+def candidate_pairs(max_block_size=None):
+    """Yield unique (pk, pk) pairs of patients that share a blocking key."""
+    max_block_size = max_block_size or settings.DUPLICATE_MAX_BLOCK_SIZE
+    blocks = (
+        PatientBlockingKey.objects.values('key')
+        .annotate(size=Count('patient_id'))
+        .filter(size__gt=1, size__lte=max_block_size)
+        .values('key')
+    )
+    # One streamed query over every block's members, grouped by key.
+    rows = (
+        PatientBlockingKey.objects.filter(key__in=blocks)
+        .order_by('key', 'patient_id')
+        .values_list('key', 'patient_id')
+        .iterator(chunk_size=5000)
+    )
+    seen = set()
+    for _, block in groupby(rows, key=lambda row: row[0]):
+        members = [patient_pk for _, patient_pk in block]
+        for i, first in enumerate(members):
+            for second in members[i + 1:]:
+                if (first, second) not in seen:
+                    seen.add((first, second))
+                    yield first, second
+
+
+def score_pairs(pairs, patients, threshold):
+    """
+    Score pairs against a pk -> patient dict; runs inside worker processes.
+    Returns ``(patient_id, patient_id, score)`` for pairs at or above ``threshold``.
+    """
+    results = []
+    for first, second in pairs:
+        value = score(patients[first], patients[second])
+        if value >= threshold:
+            results.append((patients[first]['patient_id'], patients[second]['patient_id'], value))
+    return results
@@ -0,0 +1,304 @@
+"""
+Live change notifications for open pages, streamed as server-sent events.
+
+Every outbox ``ChangeEvent`` (see patients/changes.py) is also published as
+a small notification - model, action, ids, patient and clinic, no patient
+details - once its transaction commits. ``/api/events/`` streams the
+notifications for the caller's clinic; the listing and pending-assessment
+pages use them to re-fetch only the rows that changed instead of reloading.
+
+With ``EVENTS_BACKEND = 'local'`` notifications go through an in-process
+broadcaster, so a stream only sees writes made by the same server process.
+With ``'postgres'`` they are sent with ``pg_notify`` (delivered by
+PostgreSQL at commit) and a listener thread in each process relays them to
+its streams, so every process sees every write.
+
+Served through ``asgi.py`` a stream is an idle coroutine. Under WSGI it
+would pin a whole worker, so streams are only served there with
+``EVENTS_WSGI_STREAMS`` (for threaded workers with threads to spare); pages
+rendered over WSGI leave live updates off and the endpoint answers 204,
+which tells ``EventSource`` not to reconnect. Streams end after
+``EVENTS_MAX_STREAM_SECONDS`` and the browser reconnects with
+``Last-Event-ID``. Missed events are replayed from the outbox, or a
+``resync`` event asks the page to reload.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connections, transaction
+
+from . import changes
+from .models import Visit
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'patients_events'
+
+
+class Subscription:
+    """Notifications waiting to be sent on one stream, filtered to its clinic."""
+
+    def __init__(self, clinic_id):
+        self.clinic_id = clinic_id
+        self.overflowed = False
+
+    def wants(self, event):
+        return self.clinic_id is None or event.get('clinic') == self.clinic_id
+
+
+class QueueSubscription(Subscription):
+    def __init__(self, clinic_id, maxsize):
+        super().__init__(clinic_id)
+        self.queue = queue.Queue(maxsize)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(Subscription):
+    def __init__(self, clinic_id, maxsize):
+        super().__init__(clinic_id)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The stream's event loop is already closed.
+            pass
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broadcaster:
+    """Fan notifications out to the streams open in this process."""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, subscription):
+        if settings.EVENTS_BACKEND == 'postgres':
+            start_listeners()
+        with self._lock:
+            self._subscriptions.add(subscription)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def has_subscribers(self):
+        return bool(self._subscriptions)
+
+    def publish(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            self.published += 1
+        for subscription in subscriptions:
+            if subscription.wants(event):
+                subscription.put(event)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'backend': settings.EVENTS_BACKEND,
+                'streams': len(self._subscriptions),
+                'published': self.published,
+                'listeners': sorted(_listeners),
+            }
+
+
+broadcaster = Broadcaster()
+
+
+def streams_available(request):
+    """Whether ``/api/events/`` streams to clients of this server."""
+    return isinstance(request, ASGIRequest) or settings.EVENTS_WSGI_STREAMS
+
+
+def notification(change, patient_pk, visit_pk, clinic_id):
+    return {
+        'seq': change.seq,
+        'model': change.model,
+        'action': change.action,
+        'id': change.object_id,
+        'patient': patient_pk,
+        'visit': visit_pk,
+        'clinic': clinic_id,
+    }
+
+
+def notify(instance, change, patient_pk):
+    """Publish ``change`` once the transaction that wrote it commits."""
+    using = instance._state.db or 'default'
+    postgres = settings.EVENTS_BACKEND == 'postgres' and connections[using].vendor == 'postgresql'
+    if not postgres and not broadcaster.has_subscribers():
+        return
+    visit_pk = instance.pk if isinstance(instance, Visit) else getattr(instance, 'visit_id', None)
+    event = notification(change, patient_pk, visit_pk, change.clinic_id)
+
+    if postgres:
+        # NOTIFY is transactional: PostgreSQL delivers it at commit, or never.
+        with connections[using].cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, json.dumps(event)])
+    else:
+        transaction.on_commit(lambda: broadcaster.publish(event), using=using)
+
+
+def replay(after, clinic_id, limit=None):
+    """
+    Rebuild the notifications after outbox position ``after`` for a
+    reconnecting stream. Returns None when too many were missed to replay.
+    """
+    limit = limit or settings.EVENTS_REPLAY_LIMIT
+    # Live streams also receive events as they commit, so no need to hold any back.
+    missed = changes.fetch_changes(after=after, limit=limit + 1, settled=False)
+    if len(missed) > limit:
+        return None
+
+    visit_patients = dict(
+        Visit.all_clinics.filter(
+            pk__in=[c.payload.get('visit') for c in missed if c.model == 'assessment']
+        ).values_list('pk', 'patient_id')
+    )
+    events = []
+    for change in missed:
+        if change.model == 'patient':
+            patient_pk, visit_pk = change.object_id, None
+        elif change.model == 'visit':
+            patient_pk, visit_pk = change.payload.get('patient'), change.object_id
+        else:
+            visit_pk = change.payload.get('visit')
+            patient_pk = visit_patients.get(visit_pk)
+        events.append(notification(change, patient_pk, visit_pk, change.clinic_id))
+    return [event for event in events if clinic_id is None or event['clinic'] == clinic_id]
+
+
+def format_event(event):
+    return f"id: {event['seq']}\nevent: {event['model']}\ndata: {json.dumps(event)}\n\n"
+
+
+RESYNC = 'event: resync\ndata: {}\n\n'
+KEEPALIVE = ': keepalive\n\n'
+
+
+def _opening(backlog):
+    yield f"retry: {settings.EVENTS_RETRY_MS}\n\n"
+    if backlog is None:
+        yield RESYNC
+    else:
+        for event in backlog:
+            yield format_event(event)
+
+
+def sync_stream(clinic_id, backlog=()):
+    subscription = QueueSubscription(clinic_id, settings.EVENTS_QUEUE_SIZE)
+    broadcaster.subscribe(subscription)
+    try:
+        yield from _opening(backlog)
+        deadline = time.monotonic() + settings.EVENTS_MAX_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            event = subscription.get(min(settings.EVENTS_HEARTBEAT, max(0, deadline - time.monotonic())))
+            if subscription.overflowed:
+                subscription.overflowed = False
+                yield RESYNC
+            yield KEEPALIVE if event is None else format_event(event)
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+async def async_stream(clinic_id, backlog=()):
+    subscription = AsyncSubscription(clinic_id, settings.EVENTS_QUEUE_SIZE)
+    broadcaster.subscribe(subscription)
+    try:
+        for chunk in _opening(backlog):
+            yield chunk
+        deadline = time.monotonic() + settings.EVENTS_MAX_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            event = await subscription.get(min(settings.EVENTS_HEARTBEAT, max(0, deadline - time.monotonic())))
+            if subscription.overflowed:
+                subscription.overflowed = False
+                yield RESYNC
+            yield KEEPALIVE if event is None else format_event(event)
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def start_listeners():
+    """Start one LISTEN thread per PostgreSQL database in this process."""
+    with _listeners_lock:
+        for alias in connections:
+            if alias in _listeners or connections[alias].vendor != 'postgresql':
+                continue
+            thread = threading.Thread(target=listen, args=(alias,), name=f'events-{alias}', daemon=True)
+            _listeners[alias] = thread
+            thread.start()
+
+
+def _after_fork():
+    # Listener threads do not survive fork(); let the child start its own.
+    global _listeners_lock
+    _listeners.clear()
+    _listeners_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def listen(alias):
+    wrapper = connections[alias]
+    while True:
+        connection = None
+        try:
+            connection = wrapper.get_new_connection(wrapper.get_connection_params())
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            while True:
+                if select.select([connection], [], [], settings.EVENTS_HEARTBEAT) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    broadcaster.publish(json.loads(connection.notifies.pop(0).payload))
+        except Exception:
+            logger.exception("Event listener on %s failed; reconnecting", alias)
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            time.sleep(settings.EVENTS_RETRY_MS / 1000)
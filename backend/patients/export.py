@@ -0,0 +1,174 @@
+"""
+Columnar (Parquet) snapshots of Patient, Visit and Assessment for analytics.
+
+All tables are read inside one read-only transaction (REPEATABLE READ on
+PostgreSQL) so the files describe a single consistent point in time. Rows
+are streamed from the database in chunks and each chunk is written as one
+Parquet row group, so memory use is bounded by ``row_group_size``.
+
+Categorical columns are dictionary-encoded, dates are stored as ``date32``,
+timestamps as UTC microseconds and decimals as ``decimal128`` so pandas and
+Arrow readers get typed columns without any parsing.
+
+pyarrow is imported lazily so the web process does not pay for it unless a
+snapshot is requested.
+"""
+import json
+import os
+import zipfile
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import Patient, Visit, Assessment
+
+# (column, arrow type name) per table; 'dictionary' marks categorical strings.
+TABLES = {
+    'patients': (Patient, [
+        ('id', 'int64'),
+        ('patient_id', 'string'),
+        ('first_name', 'string'),
+        ('middle_name', 'string'),
+        ('last_name', 'string'),
+        ('date_of_birth', 'date'),
+        ('gender', 'dictionary'),
+        ('registration_date', 'date'),
+        ('created_at', 'timestamp'),
+        ('updated_at', 'timestamp'),
+    ]),
+    'visits': (Visit, [
+        ('id', 'int64'),
+        ('patient_id', 'int64'),
+        ('visit_date', 'date'),
+        ('height_mm', 'int64'),
+        ('weight_g', 'int64'),
+        ('bmi', 'decimal'),
+        ('bmi_status', 'dictionary'),
+        ('created_at', 'timestamp'),
+        ('updated_at', 'timestamp'),
+    ]),
+    'assessments': (Assessment, [
+        ('id', 'int64'),
+        ('visit_id', 'int64'),
+        ('assessment_type', 'dictionary'),
+        ('general_health', 'dictionary'),
+        ('on_diet', 'bool'),
+        ('using_drugs', 'bool'),
+        ('comments', 'string'),
+        ('created_at', 'timestamp'),
+        ('updated_at', 'timestamp'),
+    ]),
+}
+
+
+def _arrow_type(pa, model, column, kind):
+    if kind == 'int64':
+        return pa.int64()
+    if kind == 'bool':
+        return pa.bool_()
+    if kind == 'date':
+        return pa.date32()
+    if kind == 'timestamp':
+        return pa.timestamp('us', tz='UTC')
+    if kind == 'decimal':
+        field = model._meta.get_field(column)
+        return pa.decimal128(field.max_digits, field.decimal_places)
+    if kind == 'dictionary':
+        return pa.dictionary(pa.int8(), pa.string())
+    return pa.string()
+
+
+def schema_for(name):
+    import pyarrow as pa
+
+    model, columns = TABLES[name]
+    return pa.schema([
+        pa.field(column, _arrow_type(pa, model, column, kind))
+        for column, kind in columns
+    ])
+
+
+def _quantize(model, column, values):
+    places = model._meta.get_field(column).decimal_places
+    exponent = Decimal(1).scaleb(-places)
+    return [None if v is None else v.quantize(exponent) for v in values]
+
+
+def _write_table(name, path, row_group_size):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    model, columns = TABLES[name]
+    schema = schema_for(name)
+    names = [column for column, _ in columns]
+    queryset = model.objects.order_by('pk').values_list(*names)
+
+    count = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        buffer = []
+        for row in queryset.iterator(chunk_size=row_group_size):
+            buffer.append(row)
+            if len(buffer) >= row_group_size:
+                writer.write_table(_to_arrow(pa, model, columns, schema, buffer))
+                count += len(buffer)
+                buffer = []
+        if buffer or count == 0:
+            writer.write_table(_to_arrow(pa, model, columns, schema, buffer))
+            count += len(buffer)
+    return count
+
+
+def _to_arrow(pa, model, columns, schema, rows):
+    arrays = []
+    for index, (column, kind) in enumerate(columns):
+        values = [row[index] for row in rows]
+        if kind == 'decimal':
+            values = _quantize(model, column, values)
+        arrays.append(pa.array(values, type=schema.field(column).type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _begin_snapshot():
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+
+
+def write_snapshot(directory, tables=None, row_group_size=None):
+    """
+    Write one ``<table>.parquet`` per table plus ``manifest.json`` into
+    ``directory`` and return the manifest.
+    """
+    tables = tables or list(TABLES)
+    row_group_size = row_group_size or settings.SNAPSHOT_ROW_GROUP_SIZE
+    os.makedirs(directory, exist_ok=True)
+
+    manifest = {
+        'taken_at': datetime.now(timezone.utc).isoformat(),
+        'row_group_size': row_group_size,
+        'tables': {},
+    }
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost:
+            _begin_snapshot()
+        for name in tables:
+            filename = f"{name}.parquet"
+            rows = _write_table(name, os.path.join(directory, filename), row_group_size)
+            manifest['tables'][name] = {'file': filename, 'rows': rows}
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    return manifest
+
+
+def write_snapshot_zip(fileobj, directory, tables=None, row_group_size=None):
+    """Write a snapshot into ``directory`` and pack it into a zip archive."""
+    manifest = write_snapshot(directory, tables=tables, row_group_size=row_group_size)
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_STORED) as archive:
+        archive.write(os.path.join(directory, 'manifest.json'), 'manifest.json')
+        for info in manifest['tables'].values():
+            archive.write(os.path.join(directory, info['file']), info['file'])
+    return manifest
@@ -1,5 +1,5 @@
 import django_filters
-from .models import Patient, Visit
+from .models import Patient, Visit, Assessment
 
 
 class PatientFilter(django_filters.FilterSet):
@@ -17,6 +17,10 @@ class PatientFilter(django_filters.FilterSet):
         field_name='registration_date',
         lookup_expr='lte'
     )
+    updated_since = django_filters.IsoDateTimeFilter(
+        field_name='updated_at',
+        lookup_expr='gte'
+    )
     
     class Meta:
         model = Patient
@@ -48,7 +52,23 @@ class VisitFilter(django_filters.FilterSet):
         field_name='bmi',
         lookup_expr='lte'
     )
+    bmi_status = django_filters.ChoiceFilter(choices=Visit.BMI_STATUS_CHOICES)
+    updated_since = django_filters.IsoDateTimeFilter(
+        field_name='updated_at',
+        lookup_expr='gte'
+    )
     
     class Meta:
         model = Visit
         fields = ['visit_date', 'patient']
+
+
+class AssessmentFilter(django_filters.FilterSet):
+    updated_since = django_filters.IsoDateTimeFilter(
+        field_name='updated_at',
+        lookup_expr='gte'
+    )
+    
+    class Meta:
+        model = Assessment
+        fields = ['updated_since']
@@ -0,0 +1,198 @@
+"""
+BMI-for-age z-scores and percentiles for children.
+
+Adult BMI cut-offs (``bmi_status``) do not apply to children, whose BMI has
+to be read against reference growth curves for their age and sex. The
+tables in ``patients/reference/`` hold the LMS parameters of those curves
+(Box-Cox power L, median M, coefficient of variation S) by age in days:
+
+- ``who``: WHO Child Growth Standards (0-5 years, daily) followed by the
+  WHO Growth Reference (5-19 years, monthly);
+- ``cdc``: CDC 2000 growth charts (2-20 years, by half month).
+
+``PEDIATRIC_BMI_REFERENCE`` selects one. Scores are computed for whole
+arrays of visits at once: L, M and S are interpolated linearly in age and
+``z = ((BMI / M) ** L - 1) / (L * S)``. With the WHO reference, z-scores
+beyond +/-3 are measured in units of the distance between the 2 and 3 SD
+curves, as the WHO software does for weight-based indicators. Visits
+outside the table's age range, and patients whose gender is neither M nor
+F, get no score.
+
+``Visit.save()`` scores a single visit; ``update_visits()`` rescores a
+queryset in primary-key chunks and writes only the rows that changed.
+"""
+import csv
+from decimal import Decimal
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+REFERENCE_DIR = Path(__file__).resolve().parent / 'reference'
+REFERENCES = ('who', 'cdc')
+SEXES = ('M', 'F')
+# Bounds of the DecimalField(max_digits=5, decimal_places=2) the z-score is stored in.
+Z_LIMIT = 999.99
+
+
+@lru_cache(maxsize=None)
+def load_reference(name):
+    """``{sex: (age_days, L, M, S)}`` arrays for reference ``name``."""
+    if name not in REFERENCES:
+        raise ValueError(f"Unknown BMI-for-age reference: {name}")
+    columns = {sex: ([], [], [], []) for sex in SEXES}
+    with open(REFERENCE_DIR / f'bmi_for_age_{name}.csv', newline='') as fp:
+        for row in csv.DictReader(line for line in fp if not line.startswith('#')):
+            for values, key in zip(columns[row['sex']], ('age_days', 'L', 'M', 'S')):
+                values.append(float(row[key]))
+    return {sex: tuple(np.array(values) for values in arrays) for sex, arrays in columns.items()}
+
+
+def normal_cdf(z):
+    """Standard normal CDF via Abramowitz & Stegun 7.1.26 (absolute error below 1e-7)."""
+    x = np.abs(z) / np.sqrt(2)
+    t = 1 / (1 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return 0.5 * (1 + np.sign(z) * (1 - poly * np.exp(-x * x)))
+
+
+def lms_z(value, L, M, S):
+    near_zero = np.abs(L) < 1e-9
+    L = np.where(near_zero, 1, L)
+    return np.where(near_zero, np.log(value / M) / S, ((value / M) ** L - 1) / (L * S))
+
+
+def lms_value(z, L, M, S):
+    """The measurement at z-score ``z`` (the inverse of ``lms_z``)."""
+    near_zero = np.abs(L) < 1e-9
+    L = np.where(near_zero, 1, L)
+    return np.where(near_zero, M * np.exp(S * z), M * (1 + L * S * z) ** (1 / L))
+
+
+def restrict_tails(z, value, L, M, S):
+    sd2, sd3 = lms_value(2, L, M, S), lms_value(3, L, M, S)
+    sd2neg, sd3neg = lms_value(-2, L, M, S), lms_value(-3, L, M, S)
+    return np.select(
+        [z > 3, z < -3],
+        [3 + (value - sd3) / (sd3 - sd2), -3 + (value - sd3neg) / (sd2neg - sd3neg)],
+        z
+    )
+
+
+def bmi_for_age(bmi, age_days, sex, reference=None):
+    """
+    ``(z, percentile)`` arrays for arrays of BMI, age in days and gender
+    codes; NaN where no reference applies.
+    """
+    reference = reference or settings.PEDIATRIC_BMI_REFERENCE
+    bmi = np.asarray(bmi, dtype=float)
+    age_days = np.asarray(age_days, dtype=float)
+    sex = np.asarray(sex)
+    z = np.full(bmi.shape, np.nan)
+    for code, (ages, L, M, S) in load_reference(reference).items():
+        rows = (sex == code) & (age_days >= ages[0]) & (age_days <= ages[-1]) & (bmi > 0)
+        if not rows.any():
+            continue
+        at, value = age_days[rows], bmi[rows]
+        l, m, s = (np.interp(at, ages, column) for column in (L, M, S))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scores = lms_z(value, l, m, s)
+            if reference == 'who':
+                scores = restrict_tails(scores, value, l, m, s)
+        z[rows] = scores
+    z = np.clip(z, -Z_LIMIT, Z_LIMIT)
+    return z, 100 * normal_cdf(z)
+
+
+def age_in_days(dates_of_birth, visit_dates):
+    return (
+        np.array(visit_dates, dtype='datetime64[D]') - np.array(dates_of_birth, dtype='datetime64[D]')
+    ).astype(np.int64)
+
+
+def hundredths(values):
+    """Scores as integer hundredths, -1e9 where NaN, for exact comparison with stored values."""
+    return np.where(np.isnan(values), -10 ** 9, np.rint(np.nan_to_num(values) * 100)).astype(np.int64)
+
+
+def stored_hundredths(values):
+    return np.array([-10 ** 9 if value is None else int(value * 100) for value in values], dtype=np.int64)
+
+
+def as_decimal(value):
+    return None if value == -10 ** 9 else Decimal(int(value)).scaleb(-2)
+
+
+def score(bmi, date_of_birth, gender, visit_date):
+    """``(z, percentile)`` as Decimals for one visit, or ``(None, None)``."""
+    if bmi is None or date_of_birth is None or visit_date is None:
+        return None, None
+    z, percentile = bmi_for_age([float(bmi)], age_in_days([date_of_birth], [visit_date]), [gender])
+    return as_decimal(hundredths(z)[0]), as_decimal(hundredths(percentile)[0])
+
+
+def write_scores(model, using, pks, z, percentile):
+    """
+    Store hundredths ``z``/``percentile`` for ``pks`` with one statement per
+    batch, moving ``updated_at`` so delta sync picks the rows up.
+    """
+    z = [as_decimal(value) for value in z]
+    percentile = [as_decimal(value) for value in percentile]
+    now = timezone.now()
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        table = connection.ops.quote_name(model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET bmi_for_age_z = d.z, bmi_for_age_percentile = d.p, updated_at = %s "
+                f"FROM unnest(%s::bigint[], %s::numeric[], %s::numeric[]) AS d(id, z, p) "
+                f"WHERE {table}.id = d.id",
+                [now, list(pks), z, percentile]
+            )
+        return
+    model._base_manager.using(using).bulk_update(
+        [
+            model(pk=pk, bmi_for_age_z=zv, bmi_for_age_percentile=pv, updated_at=now)
+            for pk, zv, pv in zip(pks, z, percentile)
+        ],
+        ['bmi_for_age_z', 'bmi_for_age_percentile', 'updated_at'],
+        batch_size=500
+    )
+
+
+def update_visits(queryset, chunk_size=50000):
+    """
+    Rescore the visits in ``queryset`` in pk order, ``chunk_size`` at a
+    time, writing only rows whose stored values differ. Returns
+    ``(visit_pk, patient_pk, visit_date)`` for the rows that changed.
+    Bypasses ``save()``, so no signals are sent.
+    """
+    changed = []
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        rows = list(chunk.values_list(
+            'pk', 'patient_id', 'visit_date', 'bmi', 'patient__date_of_birth', 'patient__gender',
+            'bmi_for_age_z', 'bmi_for_age_percentile'
+        )[:chunk_size])
+        if not rows:
+            return changed
+        last_pk = rows[-1][0]
+        pks, patients, dates, bmis, births, genders, stored_z, stored_percentile = zip(*rows)
+        z, percentile = bmi_for_age(
+            [np.nan if bmi is None else float(bmi) for bmi in bmis],
+            age_in_days(births, dates),
+            genders
+        )
+        z, percentile = hundredths(z), hundredths(percentile)
+        stale = np.flatnonzero(
+            (z != stored_hundredths(stored_z)) | (percentile != stored_hundredths(stored_percentile))
+        )
+        if stale.size:
+            write_scores(queryset.model, queryset.db, [pks[i] for i in stale], z[stale], percentile[stale])
+            changed.extend((pks[i], patients[i], dates[i]) for i in stale)
@@ -0,0 +1,191 @@
+"""
+Database-backed background jobs.
+
+Work is registered with ``@register('name')`` and queued with ``enqueue``.
+``manage.py run_worker`` processes claim queued jobs one at a time: on
+PostgreSQL with ``SELECT ... FOR UPDATE SKIP LOCKED`` so concurrent workers
+never block on each other, elsewhere (SQLite) with a conditional
+``UPDATE ... WHERE status = 'queued'`` that only one worker can win. Failed
+jobs are retried with exponential backoff up to ``max_attempts``. A running
+job's lock is refreshed by a heartbeat thread and by ``set_progress``; jobs
+whose worker died are requeued once their lock is older than
+``JOB_LOCK_TIMEOUT`` seconds, or marked failed if they have used up their
+attempts.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def register(name):
+    def decorator(func):
+        registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, priority=0, max_attempts=None, delay=0):
+    if name not in registry:
+        raise ValueError(f"Unknown job: {name}")
+    return Job.objects.create(
+        name=name,
+        payload=payload or {},
+        priority=priority,
+        max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def requeue_stale():
+    """Requeue jobs whose worker stopped refreshing the lock; fail those out of attempts."""
+    now = timezone.now()
+    stale = Job.objects.filter(status='running', locked_at__lt=now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT))
+    stale.filter(attempts__gte=F('max_attempts')).update(
+        status='failed',
+        locked_by='',
+        locked_at=None,
+        error='Worker stopped responding while running the job',
+        finished_at=now,
+        updated_at=now,
+    )
+    return stale.update(
+        status='queued',
+        locked_by='',
+        locked_at=None,
+        updated_at=now,
+    )
+
+
+def claim(worker):
+    """Atomically take the next runnable job for ``worker``, or return None."""
+    runnable = Job.objects.filter(
+        status='queued',
+        run_after__lte=timezone.now()
+    ).order_by('-priority', 'run_after', 'id')
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = runnable.select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            job.status = 'running'
+            job.locked_by = worker
+            job.locked_at = timezone.now()
+            job.attempts += 1
+            job.save(update_fields=['status', 'locked_by', 'locked_at', 'attempts', 'updated_at'])
+            return job
+
+    for job in runnable[:10]:
+        claimed = Job.objects.filter(pk=job.pk, status='queued').update(
+            status='running',
+            locked_by=worker,
+            locked_at=timezone.now(),
+            attempts=job.attempts + 1,
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def set_progress(job, percent, message=''):
+    """Report progress from inside a running job."""
+    job.progress = max(0, min(100, int(percent)))
+    job.progress_message = message[:255]
+    now = timezone.now()
+    job.locked_at = now
+    Job.objects.filter(pk=job.pk).update(
+        progress=job.progress,
+        progress_message=job.progress_message,
+        locked_at=now,
+        updated_at=now,
+    )
+
+
+def heartbeat(job, stop):
+    """Refresh ``job``'s lock until ``stop`` is set, so a long job is not requeued."""
+    try:
+        while not stop.wait(settings.JOB_LOCK_TIMEOUT / 3):
+            Job.objects.filter(pk=job.pk, status='running', locked_by=job.locked_by).update(
+                locked_at=timezone.now()
+            )
+    finally:
+        connections.close_all()
+
+
+def run(job):
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(job, stop), name=f'job-{job.pk}-heartbeat', daemon=True).start()
+    try:
+        return _run(job)
+    finally:
+        stop.set()
+
+
+def _run(job):
+    func = registry.get(job.name)
+    try:
+        if func is None:
+            raise LookupError(f"No job registered as {job.name!r}")
+        result = func(job, **job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception("Job %s (%s) failed on attempt %s", job.pk, job.name, job.attempts)
+        job.error = error
+        job.locked_by = ''
+        job.locked_at = None
+        if job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_after = timezone.now() + timedelta(
+                seconds=settings.JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1)
+            )
+        else:
+            job.status = 'failed'
+            job.finished_at = timezone.now()
+        job.save()
+        return False
+
+    job.status = 'succeeded'
+    job.result = result
+    job.progress = 100
+    job.error = ''
+    job.finished_at = timezone.now()
+    job.save()
+    return True
+
+
+def work(worker=None, once=False, poll_interval=None, should_stop=lambda: False):
+    """Claim and run jobs until ``should_stop()`` (or the queue is empty with ``once``)."""
+    worker = worker or worker_id()
+    poll_interval = poll_interval or settings.JOB_POLL_INTERVAL
+    processed = 0
+    while not should_stop():
+        requeue_stale()
+        job = claim(worker)
+        if job is None:
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+        run(job)
+        processed += 1
+    return processed
@@ -0,0 +1,87 @@
+"""
+Per-patient row cache for the patient listing page.
+
+Each row (age, latest BMI status, last assessment date, ...) is cached under
+a key built from the patient pk and ``ROW_VERSION``; bump the version when
+the row layout changes. Signal receivers delete a single patient's entry
+whenever that patient, one of its visits or one of its assessments is
+written. Age is the only time-dependent field, so each entry expires at the
+midnight when the patient's age next changes.
+"""
+from datetime import date, datetime, time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+ROW_VERSION = 2
+
+
+def get_cache():
+    return caches[settings.LISTING_ROW_CACHE]
+
+
+def row_key(patient_pk, using='default'):
+    return f"listing-row:v{ROW_VERSION}:{using}:{patient_pk}"
+
+
+def next_age_change(date_of_birth, today=None):
+    """First date after ``today`` on which ``Patient.age`` changes."""
+    today = today or date.today()
+    year = today.year
+    while True:
+        try:
+            birthday = date(year, date_of_birth.month, date_of_birth.day)
+        except ValueError:
+            # 29 February outside a leap year: age changes on 1 March.
+            birthday = date(year, 3, 1)
+        if birthday > today:
+            return birthday
+        year += 1
+
+
+def seconds_until(day):
+    midnight = timezone.make_aware(datetime.combine(day, time.min))
+    remaining = (midnight - timezone.now()).total_seconds()
+    return max(1, min(int(remaining), settings.LISTING_ROW_CACHE_MAX_TIMEOUT))
+
+
+def build_row(patient):
+    return {
+        'id': patient.id,
+        'patient_id': patient.patient_id,
+        'first_name': patient.first_name,
+        'middle_name': patient.middle_name,
+        'last_name': patient.last_name,
+        'age': patient.age,
+        'last_bmi_status': patient.get_latest_bmi_status(),
+        'last_bmi_percentile': patient.get_latest_bmi_percentile(),
+        'last_assessment_date': patient.get_latest_assessment_date()
+    }
+
+
+def get_rows(patients):
+    """Return listing rows for ``patients``, computing and caching misses."""
+    patients = list(patients)
+    cache = get_cache()
+    cached = cache.get_many([row_key(patient.pk, patient._state.db) for patient in patients])
+
+    rows = []
+    for patient in patients:
+        key = row_key(patient.pk, patient._state.db)
+        row = cached.get(key)
+        if row is None:
+            row = build_row(patient)
+            cache.set(
+                key,
+                row,
+                seconds_until(next_age_change(patient.date_of_birth))
+            )
+        rows.append(row)
+    return rows
+
+
+def invalidate(patient_pk, using='default'):
+    if patient_pk is not None:
+        get_cache().delete(row_key(patient_pk, using))
+
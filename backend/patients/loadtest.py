@@ -0,0 +1,294 @@
+"""
+Load generator that replays the clinic workflow against a running server.
+
+Each simulated clinician logs in once through the HTML login form and then
+handles patient arrivals: register -> vitals -> general or overweight
+assessment -> listing, using its own cookie jar and echoing the CSRF token
+the way a browser form post does. Redirects are not followed automatically,
+so every request is timed as its own step. Patient arrivals are open-loop
+(Poisson at ``rate`` per second) so a saturated server shows up as growing
+latency and a backlog instead of silently slowing the generator down.
+Optional API readers issue GETs against the JSON endpoints at their own rate.
+"""
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import date
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urljoin
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, Request, build_opener
+
+FIRST_NAMES = ['Amina', 'Brian', 'Carmen', 'David', 'Esther', 'Felix', 'Grace', 'Hassan', 'Irene', 'James']
+LAST_NAMES = ['Otieno', 'Smith', 'Garcia', 'Kamau', 'Nguyen', 'Mwangi', 'Brown', 'Achieng', 'Lopez', 'Wanjiru']
+API_PATHS = [
+    '/api/patients/',
+    '/api/visits/?ordering=-visit_date',
+    '/api/assessments/?ordering=-created_at',
+]
+ASSESSMENT_PATH = re.compile(r'/patients/assessment/(general|overweight)/\d+/')
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of ``values`` (0 < p <= 100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+class StepStats:
+    """Thread-safe latency and error counters per workflow step."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, step, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(step, []).append(seconds)
+            self.errors.setdefault(step, 0)
+            if not ok:
+                self.errors[step] += 1
+
+    def summary(self):
+        with self._lock:
+            rows = []
+            for step, values in self.latencies.items():
+                rows.append({
+                    'step': step,
+                    'count': len(values),
+                    'errors': self.errors[step],
+                    'p50_ms': round(percentile(values, 50) * 1000, 1),
+                    'p95_ms': round(percentile(values, 95) * 1000, 1),
+                    'p99_ms': round(percentile(values, 99) * 1000, 1),
+                    'max_ms': round(max(values) * 1000, 1),
+                })
+            return rows
+
+
+class _NoRedirect(HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class StepFailed(Exception):
+    pass
+
+
+class Session:
+    """One browser-like session: its own cookies and CSRF token."""
+
+    def __init__(self, base_url, stats, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+        self.cookies = CookieJar()
+        self.opener = build_opener(HTTPCookieProcessor(self.cookies), _NoRedirect)
+
+    def csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == 'csrftoken':
+                return cookie.value
+        return ''
+
+    def request(self, step, path, data=None, expect=(200,)):
+        """Issue one request, record its latency and return (status, location, body)."""
+        url = urljoin(self.base_url + '/', path.lstrip('/'))
+        headers = {'Accept': 'text/html,application/json'}
+        body = None
+        if data is not None:
+            data = dict(data, csrfmiddlewaretoken=self.csrf_token())
+            body = urlencode(data).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            headers['Referer'] = url
+        request = Request(url, data=body, headers=headers)
+
+        started = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                status, location, content = response.status, response.headers.get('Location'), response.read()
+        except HTTPError as exc:
+            status, location, content = exc.code, exc.headers.get('Location'), exc.read()
+        except (URLError, OSError) as exc:
+            self.stats.record(step, time.perf_counter() - started, ok=False)
+            raise StepFailed(f"{step}: {exc}")
+        elapsed = time.perf_counter() - started
+
+        ok = status in expect
+        self.stats.record(step, elapsed, ok)
+        if not ok:
+            raise StepFailed(f"{step}: HTTP {status}")
+        return status, location or '', content.decode('utf-8', 'replace')
+
+    def login(self, username, password):
+        self.request('login_form', '/patients/')
+        status, location, _ = self.request(
+            'login', '/patients/', {'username': username, 'password': password}, expect=(302,)
+        )
+        if 'listing' not in location:
+            raise StepFailed('login: credentials rejected')
+
+    def register_patient(self):
+        patient_id = f"LT-{uuid.uuid4().hex[:10].upper()}"
+        form = {
+            'patient_id': patient_id,
+            'first_name': random.choice(FIRST_NAMES),
+            'middle_name': '',
+            'last_name': random.choice(LAST_NAMES),
+            'date_of_birth': date(random.randint(1940, 2010), random.randint(1, 12), random.randint(1, 28)).isoformat(),
+            'gender': random.choice('MF'),
+        }
+        self.request('register_form', '/patients/register/')
+        status, location, content = self.request(
+            'register', '/patients/register/', form, expect=(200, 302)
+        )
+        if status == 200:
+            if 'confirm_duplicate' not in content:
+                raise StepFailed('register: form rejected')
+            # Random names collide with earlier runs; confirm like a clinician would.
+            self.request('register_confirm', '/patients/register/', dict(form, confirm_duplicate='true'), expect=(302,))
+        return patient_id
+
+    def record_vitals(self, patient_id):
+        path = f'/patients/vitals/{patient_id}/'
+        self.request('vitals_form', path)
+        _, location, _ = self.request('vitals', path, {
+            'visit_date': date.today().isoformat(),
+            'height': f"{random.uniform(150, 195):.1f}",
+            'weight': f"{random.uniform(45, 120):.1f}",
+        }, expect=(302,))
+        match = ASSESSMENT_PATH.search(location)
+        if match is None:
+            raise StepFailed(f'vitals: unexpected redirect to {location!r}')
+        return match.group(0), match.group(1)
+
+    def assess(self, path, kind):
+        self.request(f'{kind}_assessment_form', path)
+        data = {'general_health': random.choice(['Good', 'Poor']), 'comments': 'Load test visit'}
+        if kind == 'general':
+            data['using_drugs'] = random.choice(['true', 'false'])
+        else:
+            data['on_diet'] = random.choice(['true', 'false'])
+        self.request(f'{kind}_assessment', path, data, expect=(302,))
+
+    def workflow(self):
+        patient_id = self.register_patient()
+        path, kind = self.record_vitals(patient_id)
+        self.assess(path, kind)
+        self.request('listing', '/patients/listing/')
+
+
+def _arrivals(rate, duration, stop):
+    """Yield Poisson arrival times (monotonic) for ``duration`` seconds."""
+    end = time.monotonic() + duration
+    next_at = time.monotonic()
+    while not stop.is_set():
+        next_at += random.expovariate(rate)
+        if next_at >= end:
+            return
+        yield next_at
+
+
+def run(base_url, username, password, clinicians=4, rate=1.0, duration=60,
+        api_readers=0, api_rate=0.0, timeout=30):
+    """
+    Run one load stage and return a report dict with per-step percentiles,
+    completed/failed workflows and the arrivals still queued at the end.
+    """
+    stats = StepStats()
+    stop = threading.Event()
+    arrivals = queue.Queue()
+    outcome = {'completed': 0, 'failed': 0, 'errors': {}}
+    outcome_lock = threading.Lock()
+    logged_in = threading.Semaphore(0)
+
+    def fail(message):
+        with outcome_lock:
+            outcome['failed'] += 1
+            outcome['errors'][message] = outcome['errors'].get(message, 0) + 1
+
+    def clinician():
+        session = Session(base_url, stats, timeout=timeout)
+        try:
+            session.login(username, password)
+        except StepFailed as exc:
+            fail(str(exc))
+            session = None
+        finally:
+            logged_in.release()
+        while True:
+            arrived = arrivals.get()
+            if arrived is None:
+                return
+            if session is None:
+                fail('login failed')
+                continue
+            stats.record('queue_wait', time.monotonic() - arrived, ok=True)
+            try:
+                session.workflow()
+            except StepFailed as exc:
+                fail(str(exc))
+            else:
+                with outcome_lock:
+                    outcome['completed'] += 1
+
+    def api_reader(reader_rate):
+        session = Session(base_url, stats, timeout=timeout)
+        for at in _arrivals(reader_rate, duration, stop):
+            time.sleep(max(0, at - time.monotonic()))
+            try:
+                session.request('api_read', random.choice(API_PATHS))
+            except StepFailed:
+                pass
+
+    threads = [threading.Thread(target=clinician, daemon=True) for _ in range(clinicians)]
+    if api_readers and api_rate:
+        threads += [
+            threading.Thread(target=api_reader, args=(api_rate / api_readers,), daemon=True)
+            for _ in range(api_readers)
+        ]
+    for thread in threads:
+        thread.start()
+    # Sessions log in before the clock starts so login cost is not counted as queueing.
+    for _ in range(clinicians):
+        logged_in.acquire(timeout=timeout)
+
+    started = time.monotonic()
+    offered = 0
+    for at in _arrivals(rate, duration, stop):
+        time.sleep(max(0, at - time.monotonic()))
+        arrivals.put(at)
+        offered += 1
+
+    backlog = arrivals.qsize()
+    stop.set()
+    # Drop arrivals nobody picked up so the stage ends on time.
+    while True:
+        try:
+            arrivals.get_nowait()
+        except queue.Empty:
+            break
+    for _ in range(clinicians):
+        arrivals.put(None)
+    for thread in threads:
+        thread.join(timeout=timeout + 5)
+    elapsed = time.monotonic() - started
+
+    return {
+        'rate': rate,
+        'clinicians': clinicians,
+        'duration_s': round(elapsed, 1),
+        'offered': offered,
+        'completed': outcome['completed'],
+        'failed': outcome['failed'],
+        'backlog': backlog,
+        'throughput_per_s': round(outcome['completed'] / elapsed, 2) if elapsed else 0,
+        'errors': outcome['errors'],
+        'steps': stats.summary(),
+    }
@@ -0,0 +1,277 @@
+"""
+Chunked BMI recomputation and integrity checks over the visit table.
+
+``manage.py visits_maintenance`` splits the visit primary-key range into
+chunks and hands them to a process pool. A chunk is read with one narrow
+``values_list`` query per table; BMI and BMI status are recomputed for the
+whole chunk at once with NumPy, using the same integer arithmetic as
+``models.calculate_bmi``. With ``--fix`` the rows whose stored values
+drifted are rewritten by one set-based ``UPDATE``
+(``VisitQuerySet.recalculate_bmi()``), with their outbox events inserted in
+the same transaction, and stale BMI-for-age scores are rewritten with
+``growth.write_scores``; rows with out-of-range vitals are only reported,
+as their recomputed BMI may not fit the column. Each chunk reports the
+rows that break a rule:
+
+- ``bmi``: stored ``bmi``/``bmi_status`` differ from the recomputed values;
+- ``bmi_for_age``: stored BMI-for-age z-score/percentile differ from the
+  values for the recomputed BMI under ``PEDIATRIC_BMI_REFERENCE``;
+- ``vitals_range``: ``height_mm``/``weight_g`` outside the model validators;
+- ``assessment_type``: an overweight assessment on a visit with BMI <= 25,
+  or a general one above 25 (``AssessmentSerializer.validate``);
+- ``assessment_fields``: ``on_diet``/``using_drugs`` missing or set for the
+  wrong assessment type;
+- ``duplicate_visit``: several visits for one patient and date
+  (``unique_together``), checked once with a grouped query.
+
+After every chunk its results are appended to a JSON-lines file and the
+chunk is marked done in a small JSON checkpoint, so an interrupted run
+continues with ``--resume`` and no chunk rewrites what earlier ones saved.
+"""
+import json
+import os
+
+import numpy as np
+from django.db import router, transaction
+from django.db.models import Count
+
+from . import events, growth
+from .models import Assessment, ChangeEvent, Clinic, Visit
+from .tenancy import use_clinic
+
+STATUSES = ['', 'Underweight', 'Normal', 'Overweight']
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+HEIGHT_RANGE = (300, 3000)
+WEIGHT_RANGE = (1000, 500000)
+
+
+def bmi_hundredths(height_mm, weight_g):
+    """``calculate_bmi`` for int64 arrays, in hundredths; -1 where it would be None."""
+    valid = (height_mm > 0) & (weight_g > 0)
+    squared = np.where(valid, height_mm * height_mm, 1)
+    return np.where(valid, (weight_g * 200000 + squared) // (2 * squared), -1)
+
+
+def status_codes(hundredths):
+    """``bmi_status`` for an array of hundredths, as indexes into STATUSES."""
+    return np.select(
+        [hundredths < 0, hundredths < 1850, hundredths < 2500],
+        [STATUS_CODES[''], STATUS_CODES['Underweight'], STATUS_CODES['Normal']],
+        STATUS_CODES['Overweight']
+    )
+
+
+def format_bmi(hundredths):
+    return 'None' if hundredths < 0 else f'{hundredths // 100}.{hundredths % 100:02d}'
+
+
+def chunk_ranges(first_pk, last_pk, size):
+    """Half-open ``[start, end)`` pk ranges covering ``first_pk..last_pk``."""
+    return [(start, min(start + size, last_pk + 1)) for start in range(first_pk, last_pk + 1, size)]
+
+
+def check_assessments(start, end, position, expected):
+    violations = []
+    rows = list(
+        Assessment.objects.filter(visit_id__gte=start, visit_id__lt=end)
+        .order_by('pk')
+        .values_list('pk', 'visit_id', 'assessment_type', 'on_diet', 'using_drugs')
+    )
+    if not rows:
+        return violations
+    pks, visit_ids, types, on_diet, using_drugs = zip(*rows)
+    types = np.array(types)
+    over = expected[[position[visit_id] for visit_id in visit_ids]] > 2500
+    overweight = types == 'overweight'
+    general = types == 'general'
+    diet_set = np.array([value is not None for value in on_diet])
+    drugs_set = np.array([value is not None for value in using_drugs])
+
+    for i in np.flatnonzero((overweight & ~over) | (general & over)):
+        violations.append((
+            'assessment_type', 'assessment', pks[i],
+            f"{types[i]} assessment on visit {visit_ids[i]} with BMI {format_bmi(expected[position[visit_ids[i]]])}"
+        ))
+    for i in np.flatnonzero((overweight & (~diet_set | drugs_set)) | (general & (~drugs_set | diet_set))):
+        violations.append((
+            'assessment_fields', 'assessment', pks[i],
+            f"{types[i]} assessment with on_diet={on_diet[i]}, using_drugs={using_drugs[i]}"
+        ))
+    return violations
+
+
+def check_chunk(start, end, fix=False):
+    """Check, and with ``fix`` repair, the visits with ``start <= pk < end``."""
+    result = {'start': start, 'end': end, 'checked': 0, 'fixed': [], 'violations': []}
+    rows = list(
+        Visit.objects.filter(pk__gte=start, pk__lt=end)
+        .order_by('pk')
+        .values_list(
+            'pk', 'patient_id', 'visit_date', 'height_mm', 'weight_g', 'bmi', 'bmi_status',
+            'patient__date_of_birth', 'patient__gender', 'bmi_for_age_z', 'bmi_for_age_percentile',
+            'patient__clinic_id'
+        )
+    )
+    if not rows:
+        return result
+    (pks, patients, dates, heights, weights, bmis, statuses, births, genders,
+     stored_z, stored_percentile, clinics) = zip(*rows)
+    height_mm = np.array(heights, dtype=np.int64)
+    weight_g = np.array(weights, dtype=np.int64)
+    expected = bmi_hundredths(height_mm, weight_g)
+    expected_status = status_codes(expected)
+    stored = np.array([-1 if bmi is None else int(bmi * 100) for bmi in bmis], dtype=np.int64)
+    stored_status = np.array([STATUS_CODES.get(status, -1) for status in statuses])
+    result['checked'] = len(rows)
+
+    drifted = (stored != expected) | (stored_status != expected_status)
+    violations = result['violations']
+    for i in np.flatnonzero(drifted):
+        violations.append((
+            'bmi', 'visit', pks[i],
+            f"stored {format_bmi(stored[i])} {statuses[i]!r}, "
+            f"expected {format_bmi(expected[i])} {STATUSES[expected_status[i]]!r}"
+        ))
+    out_of_range = (
+        (height_mm < HEIGHT_RANGE[0]) | (height_mm > HEIGHT_RANGE[1])
+        | (weight_g < WEIGHT_RANGE[0]) | (weight_g > WEIGHT_RANGE[1])
+    )
+    for i in np.flatnonzero(out_of_range):
+        violations.append(('vitals_range', 'visit', pks[i], f"height_mm={heights[i]}, weight_g={weights[i]}"))
+    violations.extend(check_assessments(start, end, {pk: i for i, pk in enumerate(pks)}, expected))
+
+    z, percentile = growth.bmi_for_age(
+        np.where(expected < 0, np.nan, expected / 100), growth.age_in_days(births, dates), genders
+    )
+    z, percentile = growth.hundredths(z), growth.hundredths(percentile)
+    rescored = (
+        (z != growth.stored_hundredths(stored_z))
+        | (percentile != growth.stored_hundredths(stored_percentile))
+    ) & ~out_of_range
+    for i in np.flatnonzero(rescored):
+        violations.append((
+            'bmi_for_age', 'visit', pks[i],
+            f"stored z={stored_z[i]} p={stored_percentile[i]}, "
+            f"expected z={growth.as_decimal(z[i])} p={growth.as_decimal(percentile[i])}"
+        ))
+
+    fixed = np.flatnonzero((drifted | rescored) & ~out_of_range)
+    if fix and fixed.size:
+        recalculate = np.flatnonzero(drifted & ~out_of_range)
+        rescore = np.flatnonzero(rescored)
+        with transaction.atomic(using=router.db_for_write(Visit)):
+            if recalculate.size:
+                Visit.objects.filter(pk__in=[pks[i] for i in recalculate]).recalculate_bmi()
+            if rescore.size:
+                growth.write_scores(
+                    Visit, router.db_for_write(Visit), [pks[i] for i in rescore], z[rescore], percentile[rescore]
+                )
+            # QuerySet.update() bypasses the post_save outbox receiver; notify
+            # too, so server processes drop their cached copies.
+            created = ChangeEvent.objects.bulk_create([
+                ChangeEvent(
+                    clinic_id=clinics[i],
+                    model='visit',
+                    object_id=pks[i],
+                    action='update',
+                    payload={'patient': patients[i], 'visit_date': str(dates[i])}
+                )
+                for i in fixed
+            ])
+            for change, i in zip(created, fixed):
+                visit = Visit(pk=pks[i], patient_id=patients[i])
+                visit._state.db = router.db_for_write(Visit)
+                events.notify(visit, change, patients[i])
+        result['fixed'] = [(pks[i], patients[i], str(dates[i])) for i in fixed]
+    return result
+
+
+def run_chunk(args):
+    """Pool entry point: ``(start, end, clinic_pk, fix)``."""
+    start, end, clinic_pk, fix = args
+    clinic = Clinic.objects.get(pk=clinic_pk) if clinic_pk else None
+    with use_clinic(clinic):
+        return check_chunk(start, end, fix)
+
+
+def duplicate_visits():
+    rows = (
+        Visit.objects.order_by()
+        .values('patient_id', 'visit_date')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+    )
+    return [
+        ('duplicate_visit', 'patient', row['patient_id'], f"{row['count']} visits on {row['visit_date']}")
+        for row in rows
+    ]
+
+
+class Checkpoint:
+    """
+    Run parameters and finished chunks, saved as JSON after each chunk. Chunk
+    results go to ``<path>.results.jsonl``, one line per chunk.
+    """
+
+    def __init__(self, path, plan, done=()):
+        self.path = path
+        self.results_path = f'{path}.results.jsonl'
+        self.plan = plan
+        self.done = {tuple(chunk) for chunk in done}
+
+    @classmethod
+    def create(cls, path, plan):
+        checkpoint = cls(path, plan)
+        open(checkpoint.results_path, 'w').close()
+        return checkpoint
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fp:
+            state = json.load(fp)
+        return cls(path, **state)
+
+    def add(self, result):
+        # Appended before the chunk is marked done; a line whose chunk never
+        # made it into ``done`` is ignored and the chunk runs again.
+        with open(self.results_path, 'a') as fp:
+            fp.write(json.dumps(result, default=int) + '\n')
+        self.done.add((result['start'], result['end']))
+
+    def save(self):
+        state = {'plan': self.plan, 'done': sorted(self.done)}
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as fp:
+            json.dump(state, fp, default=int)
+        os.replace(temporary, self.path)
+
+    def results(self):
+        """Results of the finished chunks, each once."""
+        seen = set()
+        if not os.path.exists(self.results_path):
+            return
+        with open(self.results_path) as fp:
+            for line in fp:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted write.
+                    continue
+                chunk = (result['start'], result['end'])
+                if chunk in self.done and chunk not in seen:
+                    seen.add(chunk)
+                    yield result
+
+    def totals(self):
+        """``(checked, fixed, violations)`` over the finished chunks."""
+        checked, fixed, violations = 0, [], []
+        for result in self.results():
+            checked += result['checked']
+            fixed.extend(tuple(row) for row in result['fixed'])
+            violations.extend(tuple(row) for row in result['violations'])
+        return checked, fixed, violations
+
+    def remove(self):
+        for path in (self.path, self.results_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from patients import archive
+
+
+class Command(BaseCommand):
+    help = "Move old visits and their assessments into the cold archive tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            help='Number of days or an ISO date (YYYY-MM-DD). Defaults to ARCHIVE_VISITS_OLDER_THAN_DAYS.'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many visits would be archived.'
+        )
+
+    def handle(self, *args, **options):
+        if options['older_than']:
+            try:
+                cutoff = archive.parse_older_than(options['older_than'])
+            except ValueError:
+                raise CommandError('--older-than must be a number of days or a YYYY-MM-DD date.')
+        else:
+            cutoff = archive.default_cutoff()
+
+        count = archive.archive_visits(
+            cutoff,
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run']
+        )
+        if options['dry_run']:
+            self.stdout.write(f"{count} visit(s) before {cutoff} would be archived.")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Archived {count} visit(s) before {cutoff}."))
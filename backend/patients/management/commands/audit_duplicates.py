@@ -0,0 +1,93 @@
+import csv
+from itertools import islice
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from patients import duplicates
+from patients.models import Patient
+
+
+def _score(args):
+    return duplicates.score_pairs(*args)
+
+
+class Command(BaseCommand):
+    help = (
+        "Score candidate duplicate-patient pairs that share a blocking key and "
+        "write the pairs above the threshold as CSV."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Scoring processes.')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Pairs per work unit.')
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=settings.DUPLICATE_SCORE_THRESHOLD,
+            help='Minimum score to report.'
+        )
+        parser.add_argument('--output', help='CSV file to write (defaults to stdout).')
+        parser.add_argument(
+            '--rebuild-keys',
+            action='store_true',
+            help='Recompute blocking keys for every patient first.'
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild_keys']:
+            count = 0
+            for patient in Patient.objects.order_by('pk').iterator(chunk_size=2000):
+                duplicates.index_patient(patient)
+                count += 1
+            self.stderr.write(f"Rebuilt blocking keys for {count} patient(s).")
+
+        scored = [0]
+        pairs = duplicates.candidate_pairs()
+
+        def work():
+            # One chunk of pairs and its patients at a time, so memory stays
+            # bounded by --chunk-size rather than the number of pairs.
+            while True:
+                chunk = list(islice(pairs, options['chunk_size']))
+                if not chunk:
+                    return
+                scored[0] += len(chunk)
+                pks = {pk for pair in chunk for pk in pair}
+                patients = {
+                    row['id']: row
+                    for row in Patient.objects.filter(pk__in=pks).values(*duplicates.PATIENT_FIELDS)
+                }
+                yield chunk, patients, options['threshold']
+
+        if options['workers'] > 1:
+            # Workers only score in memory; the parent keeps reading pairs
+            # over its own connection, opened after the fork.
+            connections.close_all()
+            with Pool(options['workers']) as pool:
+                results = list(pool.imap_unordered(_score, work()))
+        else:
+            results = [duplicates.score_pairs(*args) for args in work()]
+
+        matches = sorted(
+            (match for result in results for match in result),
+            key=lambda match: match[2],
+            reverse=True
+        )
+
+        output = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+        try:
+            writer = csv.writer(output)
+            writer.writerow(['patient_a', 'patient_b', 'score'])
+            for first, second, value in matches:
+                writer.writerow([first, second, value])
+        finally:
+            if options['output']:
+                output.close()
+
+        self.stderr.write(
+            f"Scored {scored[0]} candidate pair(s); "
+            f"{len(matches)} above {options['threshold']}."
+        )
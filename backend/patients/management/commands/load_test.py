@@ -0,0 +1,88 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from patients import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay the clinic workflow (login, registration, vitals, assessment, "
+        "listing) plus API reads against a running server and report latency "
+        "percentiles per step."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of the server under test.')
+        parser.add_argument('--username', default='loadtest')
+        parser.add_argument('--password', default='loadtest-password')
+        parser.add_argument(
+            '--create-user',
+            action='store_true',
+            help='Create the login user in this project\'s database if it does not exist.'
+        )
+        parser.add_argument('--clinicians', type=int, default=4, help='Concurrent logged-in clinician sessions.')
+        parser.add_argument(
+            '--rate',
+            default='1',
+            help='Patient arrivals per second; a comma-separated list runs one stage per rate.'
+        )
+        parser.add_argument('--duration', type=float, default=60, help='Seconds per stage.')
+        parser.add_argument('--api-readers', type=int, default=0, help='Concurrent API reader sessions.')
+        parser.add_argument('--api-rate', type=float, default=0, help='Total API reads per second.')
+        parser.add_argument('--timeout', type=float, default=30, help='Per-request timeout in seconds.')
+        parser.add_argument('--json', dest='json_path', help='Also write the full report to this file.')
+
+    def handle(self, *args, **options):
+        try:
+            rates = [float(rate) for rate in options['rate'].split(',')]
+        except ValueError:
+            raise CommandError('--rate must be a number or a comma-separated list of numbers.')
+        if any(rate <= 0 for rate in rates):
+            raise CommandError('--rate values must be positive.')
+
+        if options['create_user'] and not User.objects.filter(username=options['username']).exists():
+            User.objects.create_user(options['username'], password=options['password'])
+
+        reports = []
+        for rate in rates:
+            self.stdout.write(
+                f"Stage: {rate}/s arrivals, {options['clinicians']} clinician(s), {options['duration']}s"
+            )
+            report = loadtest.run(
+                options['url'],
+                options['username'],
+                options['password'],
+                clinicians=options['clinicians'],
+                rate=rate,
+                duration=options['duration'],
+                api_readers=options['api_readers'],
+                api_rate=options['api_rate'],
+                timeout=options['timeout'],
+            )
+            reports.append(report)
+            self.write_report(report)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as fp:
+                json.dump(reports, fp, indent=2)
+
+    def write_report(self, report):
+        self.stdout.write(f"{'step':<28}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for row in report['steps']:
+            self.stdout.write(
+                f"{row['step']:<28}{row['count']:>7}{row['errors']:>8}"
+                f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}"
+            )
+        summary = (
+            f"offered {report['offered']}, completed {report['completed']}, failed {report['failed']}, "
+            f"backlog {report['backlog']}, {report['throughput_per_s']} workflows/s"
+        )
+        if report['backlog'] > report['clinicians']:
+            self.stdout.write(self.style.WARNING(f"{summary} (saturated)"))
+        else:
+            self.stdout.write(summary)
+        for message, count in report['errors'].items():
+            self.stdout.write(self.style.ERROR(f"  {count} x {message}"))
+        self.stdout.write('')
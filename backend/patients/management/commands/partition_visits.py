@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from patients import partitioning
+
+
+class Command(BaseCommand):
+    help = (
+        "Manage PostgreSQL range partitions of the visits table. "
+        "Use --convert once to rebuild an existing table, then run without "
+        "arguments (e.g. daily) to create upcoming partitions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert',
+            action='store_true',
+            help='Rebuild patients_visit as a table partitioned by visit_date.'
+        )
+        parser.add_argument(
+            '--interval',
+            choices=partitioning.INTERVALS,
+            help='Partition size for --convert (defaults to VISIT_PARTITION_INTERVAL); '
+                 'afterwards the converted table\'s own interval is used.'
+        )
+        parser.add_argument(
+            '--ahead',
+            type=int,
+            help='Number of future periods to pre-create (defaults to VISIT_PARTITIONS_AHEAD).'
+        )
+
+    def handle(self, *args, **options):
+        if not partitioning.is_supported():
+            raise CommandError('Visit partitioning requires PostgreSQL.')
+
+        interval = options['interval']
+        ahead = options['ahead']
+
+        if options['convert']:
+            partitioning.convert_visit_table(interval=interval, ahead=ahead, stdout=self.stdout)
+
+        try:
+            created = partitioning.ensure_partitions(ahead=ahead, interval=interval)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        for name in created:
+            self.stdout.write(f"Created partition {name}")
+        self.stdout.write(self.style.SUCCESS(f"{len(created)} partition(s) created."))
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from patients import profiling
+
+
+class Command(BaseCommand):
+    help = "Print a signed X-Profile header value that makes a request get profiled."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--label', default='manual', help='Free-form label stored in the token.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(profiling.make_token(options['label']))
+        self.stderr.write(
+            f"Valid for {settings.PROFILING_TOKEN_MAX_AGE}s; send as 'X-Profile: <token>'"
+            f"{'' if settings.PROFILING_ENABLED else ' once PROFILING_ENABLED is set'}."
+        )
@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from patients import changes, sync
+
+
+class Command(BaseCommand):
+    help = "Compact and expire events in the change outbox and expired sync tombstones."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retention-days',
+            type=int,
+            default=settings.CHANGE_FEED_RETENTION_DAYS,
+            help='Delete events older than this many days.'
+        )
+        parser.add_argument(
+            '--compact-before',
+            type=int,
+            help='Keep only the newest event per object for events with seq <= this value.'
+        )
+
+    def handle(self, *args, **options):
+        if options['compact_before'] is not None:
+            compacted = changes.compact_changes(options['compact_before'])
+            self.stdout.write(f"Compacted {compacted} superseded event(s).")
+
+        cutoff = timezone.now() - timedelta(days=options['retention_days'])
+        pruned = changes.prune_changes(cutoff)
+        self.stdout.write(f"Pruned {sync.prune_tombstones()} expired tombstone(s).")
+        self.stdout.write(self.style.SUCCESS(f"Pruned {pruned} event(s) older than {cutoff:%Y-%m-%d}."))
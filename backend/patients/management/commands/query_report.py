@@ -0,0 +1,53 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+
+from patients import slow_queries
+
+
+class Command(BaseCommand):
+    help = (
+        "Rank the query shapes in the slow-query log by total time and flag "
+        "sequential scans of the watched tables."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', default=None, help='Log file (defaults to SLOW_QUERY_LOG).')
+        parser.add_argument('--since', help='Only entries from this date or ISO 8601 time on.')
+        parser.add_argument('--limit', type=int, default=20, help='Number of shapes to show.')
+        parser.add_argument('--json', action='store_true', help='Print the ranking as JSON.')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            moment = parse_datetime(options['since']) or parse_date(options['since'])
+            if moment is None:
+                raise CommandError(f"Invalid --since: {options['since']}")
+            since = moment.isoformat()
+        entries = slow_queries.read_log(options['log'] or settings.SLOW_QUERY_LOG, since)
+        rows = slow_queries.report(entries)[:options['limit']]
+
+        if options['json']:
+            self.stdout.write(json.dumps(rows, indent=2))
+            return
+        if not rows:
+            self.stdout.write("No slow queries logged.")
+            return
+
+        for rank, row in enumerate(rows, start=1):
+            self.stdout.write(
+                f"#{rank} [{row['fingerprint']}] {row['total_ms']:.1f} ms total, {row['count']} call(s), "
+                f"mean {row['mean_ms']:.1f} ms, max {row['max_ms']:.1f} ms, {row['explained']} plan(s)"
+            )
+            self.stdout.write(f"    {row['shape']}")
+            for site, count in row['call_sites']:
+                self.stdout.write(f"    from {site} ({count})")
+            for scan in row['seq_scans']:
+                advice = (
+                    f"consider an index on {scan['table']} ({', '.join(scan['filtered_on'])})"
+                    if scan['filtered_on'] else 'no filter on this table; the whole table is read'
+                )
+                self.stdout.write(self.style.WARNING(f"    SEQ SCAN on {scan['table']}: {advice}"))
+        self.stdout.write(f"{len(entries)} slow statement(s) logged.")
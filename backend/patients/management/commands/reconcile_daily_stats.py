@@ -0,0 +1,69 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from patients import daily_stats
+from patients.models import Clinic, Visit, ArchivedVisit, DailyClinicStats
+from patients.tenancy import use_clinic
+
+
+class Command(BaseCommand):
+    help = "Recompute the dashboard's per-day counters from the visit tables and fix any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Only check the last N days.')
+        parser.add_argument('--start', help='First date to check (YYYY-MM-DD).')
+        parser.add_argument('--end', help='Last date to check (YYYY-MM-DD).')
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without fixing it.')
+        parser.add_argument('--clinic', help="Clinic code; reconciles that clinic's database.")
+
+    def handle(self, *args, **options):
+        clinic = None
+        if options['clinic']:
+            clinic = Clinic.objects.filter(code=options['clinic']).first()
+            if clinic is None:
+                raise CommandError(f"Unknown clinic: {options['clinic']}")
+        with use_clinic(clinic):
+            self.reconcile(options)
+
+    def reconcile(self, options):
+        try:
+            start, end = self.get_range(options)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if start is None:
+            self.stdout.write("Nothing to reconcile.")
+            return
+
+        drift = daily_stats.reconcile(start, end, dry_run=options['dry_run'])
+        for (clinic_id, day), fields in drift.items():
+            changes = ', '.join(f"{field} {stored} -> {actual}" for field, (stored, actual) in fields.items())
+            self.stdout.write(f"{day}{f' (clinic {clinic_id})' if clinic_id else ''}: {changes}")
+        verb = 'would be fixed' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {start} to {end}: {len(drift)} day(s) {verb}."
+        ))
+
+    def get_range(self, options):
+        if options['days']:
+            end = timezone.localdate()
+            return end - timedelta(days=options['days'] - 1), end
+        bounds = [
+            queryset.aggregate(first=Min(field), last=Max(field))
+            for queryset, field in (
+                (Visit.all_clinics, 'visit_date'),
+                (ArchivedVisit.all_clinics, 'visit_date'),
+                (DailyClinicStats.objects, 'date'),
+            )
+        ]
+        firsts = [b['first'] for b in bounds if b['first']]
+        lasts = [b['last'] for b in bounds if b['last']]
+        start = daily_stats.as_date(options['start']) if options['start'] else min(firsts, default=None)
+        end = daily_stats.as_date(options['end']) if options['end'] else max(lasts, default=None)
+        if start is None or end is None:
+            return None, None
+        if start > end:
+            raise ValueError('--start must not be after --end')
+        return start, end
@@ -0,0 +1,56 @@
+import signal
+from multiprocessing import Process, Event
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from patients import jobs
+
+
+def _worker_main(stop_event, once, poll_interval):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    jobs.work(once=once, poll_interval=poll_interval, should_stop=stop_event.is_set)
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Run background job workers (no external broker required)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help='Number of worker processes.')
+        parser.add_argument('--poll-interval', type=float, help='Seconds between polls of an empty queue.')
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit once the queue is empty instead of polling forever.'
+        )
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            processed = jobs.work(once=options['once'], poll_interval=options['poll_interval'])
+            self.stdout.write(f"Processed {processed} job(s).")
+            return
+
+        stop_event = Event()
+
+        def stop(signum, frame):
+            self.stdout.write("Stopping workers after their current job...")
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        connections.close_all()
+        workers = [
+            Process(
+                target=_worker_main,
+                args=(stop_event, options['once'], options['poll_interval']),
+                daemon=False
+            )
+            for _ in range(options['processes'])
+        ]
+        for process in workers:
+            process.start()
+        self.stdout.write(f"Started {len(workers)} worker process(es).")
+        for process in workers:
+            process.join()
@@ -0,0 +1,155 @@
+import csv
+import os
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+
+from patients import daily_stats, listing_cache, maintenance
+from patients.models import Clinic, Visit
+from patients.object_cache import object_cache
+from patients.tenancy import current_database, use_clinic
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute stored BMIs and BMI-for-age scores in parallel pk-range chunks and "
+        "check visit and assessment integrity; violations are written as CSV."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Worker processes.')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Visit ids per work unit.')
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Rewrite drifted BMI and BMI-for-age values (other violations are only reported).'
+        )
+        parser.add_argument('--clinic', help="Clinic code; checks that clinic's visits on its database.")
+        parser.add_argument(
+            '--checkpoint',
+            default='visits_maintenance.json',
+            help=(
+                'Progress file, updated after every chunk and removed when the run completes; '
+                'chunk results are kept next to it in <checkpoint>.results.jsonl.'
+            )
+        )
+        parser.add_argument('--resume', action='store_true', help='Continue the run saved in --checkpoint.')
+        parser.add_argument('--output', help='CSV file for violations (defaults to stdout).')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+        clinic = None
+        if options['clinic']:
+            clinic = Clinic.objects.filter(code=options['clinic']).first()
+            if clinic is None:
+                raise CommandError(f"Unknown clinic: {options['clinic']}")
+        with use_clinic(clinic):
+            checkpoint = self.get_checkpoint(options, clinic)
+            self.run(checkpoint, options, clinic)
+            checked, fixed, violations = checkpoint.totals()
+            if options['fix']:
+                self.refresh_derived(fixed)
+        self.report(checked, fixed, violations, options)
+        checkpoint.remove()
+
+    def get_checkpoint(self, options, clinic):
+        if options['resume']:
+            if not os.path.exists(options['checkpoint']):
+                raise CommandError(f"No checkpoint at {options['checkpoint']} to resume.")
+            checkpoint = maintenance.Checkpoint.load(options['checkpoint'])
+            expected = {
+                'clinic': options['clinic'],
+                'chunk_size': options['chunk_size'],
+                'fix': options['fix'],
+            }
+            if any(checkpoint.plan[key] != value for key, value in expected.items()):
+                raise CommandError(
+                    f"The checkpoint was started with {checkpoint.plan}; resume with the same options."
+                )
+            return checkpoint
+
+        # Rows added after the run starts are saved through Visit.save() and need no repair.
+        bounds = Visit.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        plan = {
+            'clinic': options['clinic'],
+            'chunk_size': options['chunk_size'],
+            'fix': options['fix'],
+            'first_pk': bounds['first'],
+            'last_pk': bounds['last'],
+        }
+        return maintenance.Checkpoint.create(options['checkpoint'], plan)
+
+    def run(self, checkpoint, options, clinic):
+        plan = checkpoint.plan
+        if plan['first_pk'] is None:
+            return
+        chunks = [
+            chunk
+            for chunk in maintenance.chunk_ranges(plan['first_pk'], plan['last_pk'], plan['chunk_size'])
+            if chunk not in checkpoint.done
+        ]
+        work = [(start, end, clinic.pk if clinic else None, plan['fix']) for start, end in chunks]
+        total = len(checkpoint.done) + len(work)
+
+        def finished(result):
+            checkpoint.add(result)
+            checkpoint.save()
+            self.stderr.write(
+                f"Chunk {result['start']}-{result['end'] - 1}: {result['checked']} visit(s), "
+                f"{len(result['fixed'])} fixed, {len(result['violations'])} violation(s) "
+                f"[{len(checkpoint.done)}/{total}]"
+            )
+
+        if options['workers'] > 1 and len(work) > 1:
+            # Each worker opens its own connections; drop ours before forking.
+            connections.close_all()
+            with Pool(options['workers']) as pool:
+                for result in pool.imap_unordered(maintenance.run_chunk, work):
+                    finished(result)
+        else:
+            for args in work:
+                finished(maintenance.run_chunk(args))
+
+    def refresh_derived(self, fixed):
+        """Bring the counters and caches that post_save would have updated in line with the fixes."""
+        if not fixed:
+            return
+        dates = sorted(daily_stats.as_date(visit_date) for _, _, visit_date in fixed)
+        drift = daily_stats.reconcile(dates[0], dates[-1])
+        using = current_database()
+        # This process's own LRU is about to exit; what counts is that
+        # discard() also deletes the entries in the shared tier
+        # (OBJECT_CACHE_BACKEND). Server processes drop their local copies
+        # when the notifications check_chunk() sent reach them
+        # (EVENTS_BACKEND = 'postgres'), else at OBJECT_CACHE_TIMEOUT.
+        for visit_pk, patient_pk, _ in fixed:
+            visit = Visit(pk=visit_pk)
+            visit._state.db = using
+            object_cache.discard(visit)
+        for patient_pk in {patient_pk for _, patient_pk, _ in fixed}:
+            listing_cache.invalidate(patient_pk, using)
+        self.stderr.write(f"Reconciled daily counters for {len(drift)} day(s) from {dates[0]} to {dates[-1]}.")
+
+    def report(self, checked, fixed, violations, options):
+        violations = violations + maintenance.duplicate_visits()
+        output = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+        try:
+            writer = csv.writer(output)
+            writer.writerow(['rule', 'model', 'id', 'detail'])
+            for row in sorted(violations, key=lambda row: (row[0], row[2])):
+                writer.writerow(row)
+        finally:
+            if options['output']:
+                output.close()
+
+        counts = {}
+        for rule, *_ in violations:
+            counts[rule] = counts.get(rule, 0) + 1
+        summary = ', '.join(f"{rule}: {count}" for rule, count in sorted(counts.items())) or 'none'
+        self.stderr.write(
+            f"Checked {checked} visit(s); fixed {len(fixed)} visit(s). "
+            f"Violations - {summary}."
+        )
@@ -0,0 +1,127 @@
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+
+
+class AdmissionController:
+    """
+    Bounded concurrency per route class with a short queue.
+
+    Each class (``write``, ``interactive``, ``report``, ``poll``) has its own in-flight
+    limit and queue deadline, so slow report-style requests can never take
+    the slots that registration and other writes need. Requests that cannot
+    be admitted before their class deadline, or that find the queue full,
+    are shed. Counts are per process: the limits only matter when a worker
+    serves requests on more threads than a class may use.
+    """
+
+    def __init__(self, limits, timeouts, max_queue):
+        self.limits = dict(limits)
+        self.timeouts = dict(timeouts)
+        self.max_queue = dict(max_queue)
+        self.in_flight = {name: 0 for name in self.limits}
+        self.waiting = {name: 0 for name in self.limits}
+        self.admitted = {name: 0 for name in self.limits}
+        self.shed = {name: 0 for name in self.limits}
+        self._condition = threading.Condition()
+
+    def acquire(self, route_class):
+        deadline = time.monotonic() + self.timeouts[route_class]
+        with self._condition:
+            if self.in_flight[route_class] < self.limits[route_class]:
+                return self._admit(route_class)
+            if self.waiting[route_class] >= self.max_queue[route_class]:
+                self.shed[route_class] += 1
+                return False
+
+            self.waiting[route_class] += 1
+            try:
+                while self.in_flight[route_class] >= self.limits[route_class]:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed[route_class] += 1
+                        return False
+                    self._condition.wait(remaining)
+                return self._admit(route_class)
+            finally:
+                self.waiting[route_class] -= 1
+
+    def _admit(self, route_class):
+        self.in_flight[route_class] += 1
+        self.admitted[route_class] += 1
+        return True
+
+    def release(self, route_class):
+        with self._condition:
+            self.in_flight[route_class] -= 1
+            self._condition.notify_all()
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                name: {
+                    'limit': self.limits[name],
+                    'in_flight': self.in_flight[name],
+                    'queue_depth': self.waiting[name],
+                    'admitted': self.admitted[name],
+                    'shed': self.shed[name],
+                }
+                for name in self.limits
+            }
+
+
+admission_controller = AdmissionController(
+    limits=settings.ADMISSION_CONTROL_LIMITS,
+    timeouts=settings.ADMISSION_CONTROL_QUEUE_TIMEOUTS,
+    max_queue=settings.ADMISSION_CONTROL_MAX_QUEUE,
+)
+
+
+class AdmissionControlMiddleware:
+    """Shed load with a fast 503 instead of letting slow requests pile up."""
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.write_paths = [re.compile(p) for p in settings.ADMISSION_CONTROL_WRITE_PATHS]
+        self.report_paths = [re.compile(p) for p in settings.ADMISSION_CONTROL_REPORT_PATHS]
+        self.poll_paths = [re.compile(p) for p in settings.ADMISSION_CONTROL_POLL_PATHS]
+        self.exempt_paths = [re.compile(p) for p in settings.ADMISSION_CONTROL_EXEMPT_PATHS]
+
+    def classify(self, request):
+        path = request.path_info
+        if any(p.match(path) for p in self.exempt_paths):
+            return None
+        if request.method not in self.SAFE_METHODS:
+            return 'write'
+        if any(p.match(path) for p in self.write_paths):
+            return 'write'
+        if any(p.match(path) for p in self.report_paths):
+            return 'report'
+        if any(p.match(path) for p in self.poll_paths):
+            return 'poll'
+        return 'interactive'
+
+    def __call__(self, request):
+        if not settings.ADMISSION_CONTROL_ENABLED:
+            return self.get_response(request)
+
+        route_class = self.classify(request)
+        if route_class is None:
+            return self.get_response(request)
+
+        if not admission_controller.acquire(route_class):
+            response = HttpResponse(
+                'Server is busy, please retry shortly.',
+                status=503,
+                content_type='text/plain'
+            )
+            response['Retry-After'] = str(settings.ADMISSION_CONTROL_RETRY_AFTER)
+            return response
+        try:
+            return self.get_response(request)
+        finally:
+            admission_controller.release(route_class)
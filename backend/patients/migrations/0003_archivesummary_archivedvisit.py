@@ -0,0 +1,53 @@
+# Generated by Django 4.2.9 on 2026-10-19 06:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0002_patient_middle_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('visit_count', models.PositiveIntegerField(default=0)),
+                ('assessment_count', models.PositiveIntegerField(default=0)),
+                ('first_visit_date', models.DateField(blank=True, null=True)),
+                ('last_visit_date', models.DateField(blank=True, null=True)),
+                ('last_bmi', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('patient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='archive_summary', to='patients.patient')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedVisit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.BigIntegerField(unique=True)),
+                ('visit_date', models.DateField()),
+                ('height', models.DecimalField(decimal_places=2, max_digits=5)),
+                ('weight', models.DecimalField(decimal_places=2, max_digits=5)),
+                ('bmi', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('assessment_id', models.BigIntegerField(blank=True, null=True)),
+                ('assessment_type', models.CharField(blank=True, choices=[('general', 'General Assessment'), ('overweight', 'Overweight Assessment')], max_length=20)),
+                ('general_health', models.CharField(blank=True, choices=[('Good', 'Good'), ('Poor', 'Poor')], max_length=10)),
+                ('on_diet', models.BooleanField(blank=True, null=True)),
+                ('using_drugs', models.BooleanField(blank=True, null=True)),
+                ('comments', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('assessment_created_at', models.DateTimeField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_visits', to='patients.patient')),
+            ],
+            options={
+                'ordering': ['-visit_date'],
+                'indexes': [models.Index(fields=['patient', '-visit_date'], name='patients_ar_patient_bcea50_idx'), models.Index(fields=['-visit_date'], name='patients_ar_visit_d_f8d67b_idx')],
+            },
+        ),
+    ]
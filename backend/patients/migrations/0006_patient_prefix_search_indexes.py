@@ -0,0 +1,38 @@
+from django.db import migrations
+
+# Admin search uses istartswith (``^field``), which PostgreSQL evaluates as
+# UPPER(col) LIKE 'PREFIX%'. These expression indexes with pattern ops let
+# that predicate use an index scan instead of a sequential scan.
+PREFIX_INDEXES = [
+    ('patients_pa_patient_id_upper_like', 'patient_id'),
+    ('patients_pa_last_name_upper_like', 'last_name'),
+    ('patients_pa_first_name_upper_like', 'first_name'),
+]
+
+
+def create_prefix_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, column in PREFIX_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS "{name}" ON "patients_patient" '
+            f'(UPPER("{column}"::text) text_pattern_ops)'
+        )
+
+
+def drop_prefix_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _ in PREFIX_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0005_tombstone_assessment_patients_as_updated_aa2556_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_prefix_indexes, drop_prefix_indexes),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.9 on 2026-10-19 06:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0008_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyClinicStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('visits', models.IntegerField(default=0)),
+                ('underweight', models.IntegerField(default=0)),
+                ('normal', models.IntegerField(default=0)),
+                ('overweight', models.IntegerField(default=0)),
+                ('general_assessments', models.IntegerField(default=0)),
+                ('overweight_assessments', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'daily clinic stats',
+                'ordering': ['-date'],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.9 on 2026-10-19 06:55
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def mark_assessed_visits(apps, schema_editor):
+    Visit = apps.get_model('patients', 'Visit')
+    Visit.objects.using(schema_editor.connection.alias).filter(
+        assessment__isnull=False
+    ).update(awaiting_assessment=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0009_daily_clinic_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visit',
+            name='assessment_status_changed_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='awaiting_assessment',
+            field=models.BooleanField(default=True, help_text='Maintained by Assessment signals; see patients/pending.py'),
+        ),
+        migrations.RunPython(mark_assessed_visits, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(condition=models.Q(('awaiting_assessment', True)), fields=['visit_date', 'id'], name='visit_pending_assessment_idx'),
+        ),
+    ]
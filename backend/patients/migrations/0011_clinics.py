@@ -0,0 +1,50 @@
+# Generated by Django 4.2.9 on 2026-10-19 07:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0010_visit_awaiting_assessment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Clinic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.SlugField(unique=True)),
+                ('name', models.CharField(max_length=200)),
+                ('database', models.CharField(blank=True, help_text="Database alias holding this clinic's data (blank for default)", max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='dailyclinicstats',
+            name='date',
+            field=models.DateField(),
+        ),
+        migrations.AddField(
+            model_name='dailyclinicstats',
+            name='clinic',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='patients.clinic'),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='clinic',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='patients.clinic'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyclinicstats',
+            constraint=models.UniqueConstraint(fields=('clinic', 'date'), name='daily_stats_clinic_date_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyclinicstats',
+            constraint=models.UniqueConstraint(condition=models.Q(('clinic__isnull', True)), fields=('date',), name='daily_stats_date_uniq'),
+        ),
+    ]
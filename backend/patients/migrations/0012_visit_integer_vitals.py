@@ -0,0 +1,106 @@
+from decimal import Decimal
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Cast, Round
+from django.db.models.lookups import GreaterThanOrEqual, LessThan
+
+
+def bmi_status(bmi):
+    return Case(
+        When(LessThan(bmi, Decimal('18.5')), then=Value('Underweight')),
+        When(LessThan(bmi, Decimal('25.0')), then=Value('Normal')),
+        When(GreaterThanOrEqual(bmi, Decimal('25.0')), then=Value('Overweight')),
+        default=Value(''),
+        output_field=models.CharField(),
+    )
+
+
+def to_integer_units(apps, schema_editor):
+    Visit = apps.get_model('patients', 'Visit')
+    visits = Visit.objects.using(schema_editor.connection.alias)
+    visits.update(
+        height_mm=Round(F('height') * 10),
+        weight_g=Round(F('weight') * 1000),
+    )
+    squared = F('height_mm') * F('height_mm')
+    hundredths = (Cast('weight_g', models.BigIntegerField()) * 200000 + squared) / (squared * 2)
+    bmi = Cast(hundredths, models.DecimalField(max_digits=7, decimal_places=2)) * Value(Decimal('0.01'))
+    visits.update(bmi=bmi, bmi_status=bmi_status(bmi))
+
+
+def to_decimal_units(apps, schema_editor):
+    Visit = apps.get_model('patients', 'Visit')
+    Visit.objects.using(schema_editor.connection.alias).update(
+        height=F('height_mm') * Value(Decimal('0.1')),
+        weight=F('weight_g') * Value(Decimal('0.001')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0011_clinics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visit',
+            name='height_mm',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='weight_g',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='bmi_status',
+            field=models.CharField(blank=True, choices=[('Underweight', 'Underweight'), ('Normal', 'Normal'), ('Overweight', 'Overweight')], default='', editable=False, help_text='Classification of bmi (derived)', max_length=11),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='visit',
+            name='height',
+            field=models.DecimalField(decimal_places=2, max_digits=5, null=True),
+        ),
+        migrations.AlterField(
+            model_name='visit',
+            name='weight',
+            field=models.DecimalField(decimal_places=2, max_digits=5, null=True),
+        ),
+        migrations.RunPython(to_integer_units, to_decimal_units),
+        migrations.RemoveField(
+            model_name='visit',
+            name='height',
+        ),
+        migrations.RemoveField(
+            model_name='visit',
+            name='weight',
+        ),
+        migrations.AlterField(
+            model_name='visit',
+            name='height_mm',
+            field=models.PositiveIntegerField(help_text='Height in millimetres', validators=[django.core.validators.MinValueValidator(300), django.core.validators.MaxValueValidator(3000)]),
+        ),
+        migrations.AlterField(
+            model_name='visit',
+            name='weight_g',
+            field=models.PositiveIntegerField(help_text='Weight in grams', validators=[django.core.validators.MinValueValidator(1000), django.core.validators.MaxValueValidator(500000)]),
+        ),
+        migrations.AlterField(
+            model_name='visit',
+            name='bmi',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, help_text='Body Mass Index (derived from height_mm and weight_g)', max_digits=5, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(fields=['bmi'], name='visit_bmi_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(fields=['bmi_status', '-visit_date'], name='visit_bmi_status_idx'),
+        ),
+    ]
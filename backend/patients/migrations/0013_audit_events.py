@@ -0,0 +1,36 @@
+# Generated by Django 4.2.9 on 2026-10-19 07:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('patients', '0012_visit_integer_vitals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('occurred_at', models.DateTimeField()),
+                ('username', models.CharField(blank=True, max_length=150)),
+                ('action', models.CharField(choices=[('list', 'List'), ('view', 'View'), ('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=10)),
+                ('patient_pk', models.BigIntegerField(blank=True, null=True)),
+                ('visit_pk', models.BigIntegerField(blank=True, null=True)),
+                ('assessment_pk', models.BigIntegerField(blank=True, null=True)),
+                ('path', models.CharField(max_length=255)),
+                ('status', models.PositiveSmallIntegerField()),
+                ('clinic', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='patients.clinic')),
+                ('user', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-occurred_at'],
+                'indexes': [models.Index(fields=['occurred_at'], name='patients_au_occurre_3752f9_idx'), models.Index(fields=['patient_pk', '-occurred_at'], name='patients_au_patient_8cfc56_idx'), models.Index(fields=['user', '-occurred_at'], name='patients_au_user_id_77876c_idx')],
+            },
+        ),
+    ]
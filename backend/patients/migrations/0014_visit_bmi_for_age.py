@@ -0,0 +1,30 @@
+# Generated by Django 4.2.9 on 2026-10-19 07:40
+
+from django.db import migrations, models
+
+
+def score_visits(apps, schema_editor):
+    from patients.growth import update_visits
+    Visit = apps.get_model('patients', 'Visit')
+    update_visits(Visit.objects.using(schema_editor.connection.alias))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0013_audit_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visit',
+            name='bmi_for_age_percentile',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, help_text='BMI-for-age percentile for children (derived)', max_digits=5, null=True),
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='bmi_for_age_z',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, help_text='BMI-for-age z-score for children (derived; see patients/growth.py)', max_digits=5, null=True),
+        ),
+        migrations.RunPython(score_visits, migrations.RunPython.noop),
+    ]
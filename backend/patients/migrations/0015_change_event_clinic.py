@@ -0,0 +1,69 @@
+# Generated by Django 4.2.9 on 2026-10-19 07:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def attribute_clinics(apps, schema_editor):
+    """
+    Give existing events the clinic of their patient, and tombstones the
+    clinic of their delete event. Rows whose patient is gone stay unassigned
+    and are only visible without a current clinic.
+    """
+    alias = schema_editor.connection.alias
+    Patient = apps.get_model('patients', 'Patient')
+    Visit = apps.get_model('patients', 'Visit')
+    ChangeEvent = apps.get_model('patients', 'ChangeEvent')
+    Tombstone = apps.get_model('patients', 'Tombstone')
+    patient_clinics = dict(Patient.objects.using(alias).exclude(clinic=None).values_list('pk', 'clinic_id'))
+    if not patient_clinics:
+        return
+
+    events = list(ChangeEvent.objects.using(alias).values_list('seq', 'model', 'object_id', 'action', 'payload'))
+    visit_patients = dict(
+        Visit.objects.using(alias)
+        .filter(pk__in={payload.get('visit') for _, model, _, _, payload in events if model == 'assessment'})
+        .values_list('pk', 'patient_id')
+    )
+    by_clinic, deleted = {}, {}
+    for seq, model, object_id, action, payload in events:
+        if model == 'patient':
+            patient_pk = object_id
+        elif model == 'visit':
+            patient_pk = payload.get('patient')
+        else:
+            patient_pk = visit_patients.get(payload.get('visit'))
+        clinic_id = patient_clinics.get(patient_pk)
+        if clinic_id is None:
+            continue
+        by_clinic.setdefault(clinic_id, []).append(seq)
+        if action == 'delete':
+            deleted[model, object_id] = clinic_id
+
+    for clinic_id, seqs in by_clinic.items():
+        for start in range(0, len(seqs), 5000):
+            ChangeEvent.objects.using(alias).filter(seq__in=seqs[start:start + 5000]).update(clinic_id=clinic_id)
+    for pk, model, object_id in Tombstone.objects.using(alias).values_list('pk', 'model', 'object_id'):
+        if (model, object_id) in deleted:
+            Tombstone.objects.using(alias).filter(pk=pk).update(clinic_id=deleted[model, object_id])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0014_visit_bmi_for_age'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='changeevent',
+            name='clinic',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='patients.clinic'),
+        ),
+        migrations.AddField(
+            model_name='tombstone',
+            name='clinic',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='patients.clinic'),
+        ),
+        migrations.RunPython(attribute_clinics, migrations.RunPython.noop),
+    ]
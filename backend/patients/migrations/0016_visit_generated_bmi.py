@@ -0,0 +1,68 @@
+# Generated by Django 4.2.9 on 2026-10-19 08:03
+
+from django.db import migrations
+import patients.models
+
+# calculate_bmi in SQL: integer hundredths, rounded half up.
+BMI = (
+    "CASE WHEN height_mm > 0 AND weight_g > 0 THEN "
+    "((weight_g::bigint * 200000 + height_mm::bigint * height_mm) "
+    "/ (2 * height_mm::bigint * height_mm))::numeric(7, 2) / 100 END"
+)
+BMI_STATUS = (
+    f"CASE WHEN ({BMI}) < 18.5 THEN 'Underweight' "
+    f"WHEN ({BMI}) < 25.0 THEN 'Normal' "
+    f"WHEN ({BMI}) >= 25.0 THEN 'Overweight' ELSE '' END"
+)
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS "visit_bmi_idx" ON "patients_visit" ("bmi")',
+    'CREATE INDEX IF NOT EXISTS "visit_bmi_status_idx" ON "patients_visit" ("bmi_status", "visit_date" DESC)',
+]
+
+
+def generate_bmi_columns(apps, schema_editor):
+    """
+    On PostgreSQL, let the database derive bmi and bmi_status. A column
+    cannot be turned into a generated one in place, so both are re-added
+    (which drops and recreates their indexes). Other databases keep the
+    values save() and recalculate_bmi() write.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'ALTER TABLE "patients_visit" DROP COLUMN "bmi_status", DROP COLUMN "bmi", '
+        f'ADD COLUMN "bmi" numeric(5, 2) GENERATED ALWAYS AS (({BMI})::numeric(5, 2)) STORED, '
+        f'ADD COLUMN "bmi_status" varchar(11) NOT NULL GENERATED ALWAYS AS ({BMI_STATUS}) STORED'
+    )
+    for statement in INDEXES:
+        schema_editor.execute(statement)
+
+
+def plain_bmi_columns(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'ALTER TABLE "patients_visit" ALTER COLUMN "bmi_status" DROP EXPRESSION, '
+        'ALTER COLUMN "bmi" DROP EXPRESSION'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0015_change_event_clinic'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='visit',
+            name='bmi',
+            field=patients.models.GeneratedOnPostgresDecimalField(blank=True, decimal_places=2, editable=False, help_text='Body Mass Index (derived from height_mm and weight_g)', max_digits=5, null=True),
+        ),
+        migrations.AlterField(
+            model_name='visit',
+            name='bmi_status',
+            field=patients.models.GeneratedOnPostgresCharField(blank=True, choices=[('Underweight', 'Underweight'), ('Normal', 'Normal'), ('Overweight', 'Overweight')], editable=False, help_text='Classification of bmi (derived)', max_length=11),
+        ),
+        migrations.RunPython(generate_bmi_columns, plain_bmi_columns),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.9 on 2026-10-19 08:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0016_visit_generated_bmi'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='assessment',
+            name='patients_as_updated_aa2556_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='patient',
+            name='patients_pa_updated_efb345_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='visit',
+            name='patients_vi_updated_7bdcb5_idx',
+        ),
+        migrations.AddIndex(
+            model_name='assessment',
+            index=models.Index(fields=['updated_at', 'id'], name='patients_as_updated_6fa3fc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['updated_at', 'id'], name='patients_pa_updated_cbb866_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visit',
+            index=models.Index(fields=['updated_at', 'id'], name='patients_vi_updated_ee5535_idx'),
+        ),
+    ]
@@ -1,7 +1,124 @@
-from django.db import models
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Cast, Now
+from django.db.models.lookups import GreaterThanOrEqual, LessThan
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError
-from decimal import Decimal
+from django.utils import timezone
+from decimal import Decimal, ROUND_HALF_UP
+
+from . import growth
+from .tenancy import ClinicScopedManager, get_current_clinic
+
+
+def bmi_status(bmi):
+    if bmi is None:
+        return None
+    
+    if bmi < Decimal('18.5'):
+        return 'Underweight'
+    elif bmi < Decimal('25.0'):
+        return 'Normal'
+    else:
+        return 'Overweight'
+
+
+def to_units(value, per_unit):
+    """Convert a decimal measurement (cm, kg) to integer sub-units (mm, g)."""
+    if value is None or value == '':
+        return None
+    return int((Decimal(str(value)) * per_unit).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_units(value, per_unit):
+    if value is None:
+        return None
+    return (Decimal(value) / per_unit).quantize(Decimal('0.01'))
+
+
+def calculate_bmi(height_mm, weight_g):
+    """
+    BMI (kg/m2) to two places, rounded half up. Computed in integer
+    hundredths so ``bmi_expression`` gives the same value on every database.
+    """
+    if not height_mm or not weight_g:
+        return None
+    squared = height_mm * height_mm
+    return Decimal((weight_g * 200000 + squared) // (2 * squared)).scaleb(-2)
+
+
+def bmi_expression():
+    """``calculate_bmi`` as a database expression over ``height_mm`` and ``weight_g``."""
+    squared = F('height_mm') * F('height_mm')
+    hundredths = (Cast('weight_g', models.BigIntegerField()) * 200000 + squared) / (squared * 2)
+    return Cast(hundredths, models.DecimalField(max_digits=7, decimal_places=2)) * Value(Decimal('0.01'))
+
+
+def bmi_status_expression(bmi):
+    """``bmi_status`` as a database expression; '' when ``bmi`` is NULL."""
+    return Case(
+        When(LessThan(bmi, Decimal('18.5')), then=Value('Underweight')),
+        When(LessThan(bmi, Decimal('25.0')), then=Value('Normal')),
+        When(GreaterThanOrEqual(bmi, Decimal('25.0')), then=Value('Overweight')),
+        default=Value(''),
+        output_field=models.CharField(),
+    )
+
+
+class GeneratedValue:
+    """``DEFAULT``: the only value PostgreSQL accepts for a generated column."""
+
+    def as_sql(self, compiler, connection):
+        return 'DEFAULT', []
+
+
+class GeneratedOnPostgresMixin:
+    """
+    A derived column that is ``GENERATED ALWAYS AS (...) STORED`` on
+    PostgreSQL (migration 0016), where writes send ``DEFAULT`` and the
+    database computes the value. Elsewhere the value ``save()`` computed is
+    stored.
+    """
+
+    def get_db_prep_save(self, value, connection):
+        if connection.vendor == 'postgresql':
+            return GeneratedValue()
+        return super().get_db_prep_save(value, connection)
+
+
+class GeneratedOnPostgresDecimalField(GeneratedOnPostgresMixin, models.DecimalField):
+    pass
+
+
+class GeneratedOnPostgresCharField(GeneratedOnPostgresMixin, models.CharField):
+    pass
+
+
+def write_db(instance, kwargs):
+    return kwargs.get('using') or router.db_for_write(type(instance), instance=instance)
+
+
+class Clinic(models.Model):
+    """A clinic sharing this deployment; see patients/tenancy.py."""
+    code = models.SlugField(max_length=50, unique=True)
+    name = models.CharField(max_length=200)
+    database = models.CharField(
+        max_length=100,
+        blank=True,
+        help_text="Database alias holding this clinic's data (blank for default)"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['name']
+    
+    def __str__(self):
+        return self.name
+    
+    def clean(self):
+        if self.database and self.database not in settings.DATABASES:
+            raise ValidationError({'database': f"Unknown database alias: {self.database}"})
 
 
 class Patient(models.Model):
@@ -11,6 +128,14 @@ class Patient(models.Model):
         ('O', 'Other'),
     ]
     
+    clinic = models.ForeignKey(
+        Clinic,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        db_constraint=False,
+        related_name='+'
+    )
     patient_id = models.CharField(
         max_length=50,
         unique=True,
@@ -26,17 +151,35 @@ class Patient(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    clinic_lookup = 'clinic'
+    objects = ClinicScopedManager()
+    all_clinics = models.Manager()
+    
     class Meta:
         ordering = ['-registration_date', '-created_at']
         indexes = [
             models.Index(fields=['patient_id']),
             models.Index(fields=['last_name', 'first_name']),
             models.Index(fields=['-registration_date']),
+            models.Index(fields=['updated_at', 'id']),
         ]
     
     def __str__(self):
         return f"{self.patient_id} - {self.first_name} {self.last_name}"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_growth_inputs()
+        return instance
+    
+    def remember_growth_inputs(self):
+        # Visits store BMI-for-age scores derived from these; see signals.rescore_visits.
+        self._loaded_growth_inputs = (self.__dict__.get('date_of_birth'), self.__dict__.get('gender'))
+    
+    def growth_inputs_changed(self):
+        return getattr(self, '_loaded_growth_inputs', None) != (self.date_of_birth, self.gender)
+    
     @property
     def full_name(self):
         return f"{self.first_name} {self.middle_name or ''} {self.last_name}"
@@ -49,86 +192,195 @@ class Patient(models.Model):
             (today.month, today.day) < (self.date_of_birth.month, self.date_of_birth.day)
         )
     
+    def save(self, *args, **kwargs):
+        if self.clinic_id is None and get_current_clinic() is not None:
+            self.clinic = get_current_clinic()
+        # Keep post_save receivers (e.g. the change outbox) in the same transaction.
+        with transaction.atomic(using=write_db(self, kwargs)):
+            super().save(*args, **kwargs)
+    
     def get_latest_visit(self):
         return self.visits.order_by('-visit_date').first()
     
+    def get_archive_summary(self):
+        try:
+            return self.archive_summary
+        except ArchiveSummary.DoesNotExist:
+            return None
+    
     def get_latest_bmi_status(self):
         latest_visit = self.get_latest_visit()
         if latest_visit and latest_visit.bmi is not None:
             return latest_visit.get_bmi_status()
+        if latest_visit is None:
+            summary = self.get_archive_summary()
+            if summary:
+                return bmi_status(summary.last_bmi)
         return None
     
+    def get_latest_bmi_percentile(self):
+        latest_visit = self.get_latest_visit()
+        return latest_visit.bmi_for_age_percentile if latest_visit else None
+    
     def get_latest_assessment_date(self):
         latest_visit = self.get_latest_visit()
         if latest_visit:
             return latest_visit.visit_date
+        summary = self.get_archive_summary()
+        if summary:
+            return summary.last_visit_date
         return None
 
 
+class VisitQuerySet(models.QuerySet):
+    def recalculate_bmi(self):
+        """
+        Recompute ``bmi`` and ``bmi_status`` in the database with a single
+        UPDATE. On PostgreSQL they are generated columns, always current.
+        """
+        if connections[self.db].vendor == 'postgresql':
+            return 0
+        bmi = bmi_expression()
+        return self.update(bmi=bmi, bmi_status=bmi_status_expression(bmi), updated_at=Now())
+    
+    def recalculate_bmi_for_age(self):
+        """Recompute the stored BMI-for-age scores in chunks; see ``growth.update_visits``."""
+        return growth.update_visits(self)
+
+
 class Visit(models.Model):
+    BMI_STATUS_CHOICES = [
+        ('Underweight', 'Underweight'),
+        ('Normal', 'Normal'),
+        ('Overweight', 'Overweight'),
+    ]
+    GROWTH_INPUTS = {'height_mm', 'weight_g', 'visit_date', 'patient', 'patient_id'}
+    
     patient = models.ForeignKey(
         Patient,
         on_delete=models.CASCADE,
         related_name='visits'
     )
     visit_date = models.DateField()
-    height = models.DecimalField(
+    height_mm = models.PositiveIntegerField(
+        validators=[MinValueValidator(300), MaxValueValidator(3000)],
+        help_text="Height in millimetres"
+    )
+    weight_g = models.PositiveIntegerField(
+        validators=[MinValueValidator(1000), MaxValueValidator(500000)],
+        help_text="Weight in grams"
+    )
+    bmi = GeneratedOnPostgresDecimalField(
         max_digits=5,
         decimal_places=2,
-        validators=[MinValueValidator(Decimal('30.0')), MaxValueValidator(Decimal('300.0'))],
-        help_text="Height in centimeters"
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Body Mass Index (derived from height_mm and weight_g)"
+    )
+    bmi_status = GeneratedOnPostgresCharField(
+        max_length=11,
+        choices=BMI_STATUS_CHOICES,
+        blank=True,
+        editable=False,
+        help_text="Classification of bmi (derived)"
     )
-    weight = models.DecimalField(
+    bmi_for_age_z = models.DecimalField(
         max_digits=5,
         decimal_places=2,
-        validators=[MinValueValidator(Decimal('1.0')), MaxValueValidator(Decimal('500.0'))],
-        help_text="Weight in kilograms"
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="BMI-for-age z-score for children (derived; see patients/growth.py)"
     )
-    bmi = models.DecimalField(
+    bmi_for_age_percentile = models.DecimalField(
         max_digits=5,
         decimal_places=2,
         null=True,
         blank=True,
-        help_text="Body Mass Index (auto-calculated)"
+        editable=False,
+        help_text="BMI-for-age percentile for children (derived)"
+    )
+    awaiting_assessment = models.BooleanField(
+        default=True,
+        help_text="Maintained by Assessment signals; see patients/pending.py"
     )
+    assessment_status_changed_at = models.DateTimeField(default=timezone.now, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    clinic_lookup = 'patient__clinic'
+    objects = ClinicScopedManager.from_queryset(VisitQuerySet)()
+    all_clinics = VisitQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-visit_date', '-created_at']
         indexes = [
             models.Index(fields=['patient', '-visit_date']),
             models.Index(fields=['-visit_date']),
+            models.Index(fields=['updated_at', 'id']),
+            models.Index(fields=['bmi'], name='visit_bmi_idx'),
+            models.Index(fields=['bmi_status', '-visit_date'], name='visit_bmi_status_idx'),
+            models.Index(
+                fields=['visit_date', 'id'],
+                condition=models.Q(awaiting_assessment=True),
+                name='visit_pending_assessment_idx'
+            ),
         ]
         unique_together = ['patient', 'visit_date']
     
     def __str__(self):
         return f"{self.patient.patient_id} - Visit on {self.visit_date}"
     
+    @property
+    def height(self):
+        """Height in centimetres, as the API and forms use it."""
+        return from_units(self.height_mm, 10)
+    
+    @height.setter
+    def height(self, value):
+        self.height_mm = to_units(value, 10)
+    
+    @property
+    def weight(self):
+        """Weight in kilograms, as the API and forms use it."""
+        return from_units(self.weight_g, 1000)
+    
+    @weight.setter
+    def weight(self, value):
+        self.weight_g = to_units(value, 1000)
+    
     def calculate_bmi(self):
-        if self.height and self.weight:
-            height_in_meters = self.height / Decimal('100.0')
-            self.bmi = self.weight / (height_in_meters ** 2)
-            return self.bmi
-        return None
+        self.bmi = calculate_bmi(self.height_mm, self.weight_g)
+        self.bmi_status = bmi_status(self.bmi) or ''
+        return self.bmi
+    
+    def calculate_bmi_for_age(self):
+        patient = self.patient
+        self.bmi_for_age_z, self.bmi_for_age_percentile = growth.score(
+            self.bmi, patient.date_of_birth, patient.gender, self.visit_date
+        )
     
     def get_bmi_status(self):
-        if self.bmi is None:
-            return None
-        
-        if self.bmi < Decimal('18.5'):
-            return 'Underweight'
-        elif self.bmi < Decimal('25.0'):
-            return 'Normal'
-        else:
-            return 'Overweight'
+        return self.bmi_status or None
     
     def requires_overweight_assessment(self):
         return self.bmi is not None and self.bmi > Decimal('25.0')
     
     def save(self, *args, **kwargs):
         self.calculate_bmi()
-        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or self.GROWTH_INPUTS & set(update_fields):
+            self.calculate_bmi_for_age()
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if {'height_mm', 'weight_g'} & update_fields:
+                update_fields |= {'bmi', 'bmi_status'}
+            if self.GROWTH_INPUTS & update_fields:
+                update_fields |= {'bmi_for_age_z', 'bmi_for_age_percentile'}
+            kwargs['update_fields'] = update_fields
+        with transaction.atomic(using=write_db(self, kwargs)):
+            super().save(*args, **kwargs)
 
 
 class Assessment(models.Model):
@@ -166,11 +418,16 @@ class Assessment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    clinic_lookup = 'visit__patient__clinic'
+    objects = ClinicScopedManager()
+    all_clinics = models.Manager()
+    
     class Meta:
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['visit']),
             models.Index(fields=['assessment_type']),
+            models.Index(fields=['updated_at', 'id']),
         ]
     
     def __str__(self):
@@ -198,4 +455,275 @@ class Assessment(models.Model):
     
     def save(self, *args, **kwargs):
         self.full_clean()
-        super().save(*args, **kwargs)
+        with transaction.atomic(using=write_db(self, kwargs)):
+            super().save(*args, **kwargs)
+
+
+class ArchivedVisit(models.Model):
+    """Cold copy of a Visit and its Assessment, moved out of the hot tables."""
+    original_id = models.BigIntegerField(unique=True)
+    patient = models.ForeignKey(
+        Patient,
+        on_delete=models.CASCADE,
+        related_name='archived_visits'
+    )
+    visit_date = models.DateField()
+    height = models.DecimalField(max_digits=5, decimal_places=2)
+    weight = models.DecimalField(max_digits=5, decimal_places=2)
+    bmi = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    assessment_id = models.BigIntegerField(null=True, blank=True)
+    assessment_type = models.CharField(
+        max_length=20,
+        choices=Assessment.ASSESSMENT_TYPE_CHOICES,
+        blank=True
+    )
+    general_health = models.CharField(max_length=10, choices=Assessment.HEALTH_CHOICES, blank=True)
+    on_diet = models.BooleanField(null=True, blank=True)
+    using_drugs = models.BooleanField(null=True, blank=True)
+    comments = models.TextField(blank=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    assessment_created_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    clinic_lookup = 'patient__clinic'
+    objects = ClinicScopedManager()
+    all_clinics = models.Manager()
+    
+    class Meta:
+        ordering = ['-visit_date']
+        indexes = [
+            models.Index(fields=['patient', '-visit_date']),
+            models.Index(fields=['-visit_date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.patient_id} - Archived visit on {self.visit_date}"
+    
+    def get_bmi_status(self):
+        return bmi_status(self.bmi)
+
+
+class ArchiveSummary(models.Model):
+    """Per-patient stub describing what was moved to the archive."""
+    patient = models.OneToOneField(
+        Patient,
+        on_delete=models.CASCADE,
+        related_name='archive_summary'
+    )
+    visit_count = models.PositiveIntegerField(default=0)
+    assessment_count = models.PositiveIntegerField(default=0)
+    first_visit_date = models.DateField(null=True, blank=True)
+    last_visit_date = models.DateField(null=True, blank=True)
+    last_bmi = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.patient_id} - {self.visit_count} archived visits"
+
+
+class ChangeEvent(models.Model):
+    """Outbox row appended in the same transaction as each tracked write."""
+    ACTION_CHOICES = [
+        ('create', 'Create'),
+        ('update', 'Update'),
+        ('delete', 'Delete'),
+    ]
+    
+    seq = models.BigAutoField(primary_key=True)
+    clinic = models.ForeignKey(
+        Clinic,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        blank=True,
+        db_constraint=False,
+        related_name='+'
+    )
+    model = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    payload = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    clinic_lookup = 'clinic'
+    objects = ClinicScopedManager()
+    all_clinics = models.Manager()
+    
+    class Meta:
+        ordering = ['seq']
+        indexes = [
+            models.Index(fields=['model', 'object_id']),
+        ]
+    
+    def __str__(self):
+        return f"#{self.seq} {self.action} {self.model} {self.object_id}"
+
+
+class Tombstone(models.Model):
+    """Marker left behind when a synced record is deleted."""
+    clinic = models.ForeignKey(
+        Clinic,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        blank=True,
+        db_constraint=False,
+        related_name='+'
+    )
+    model = models.CharField(max_length=20)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    clinic_lookup = 'clinic'
+    objects = ClinicScopedManager()
+    all_clinics = models.Manager()
+    
+    class Meta:
+        ordering = ['deleted_at']
+    
+    def __str__(self):
+        return f"{self.model} {self.object_id} deleted at {self.deleted_at}"
+
+
+class PatientBlockingKey(models.Model):
+    """Blocking key used to find duplicate-patient candidates without a full scan."""
+    patient = models.ForeignKey(
+        Patient,
+        on_delete=models.CASCADE,
+        related_name='blocking_keys'
+    )
+    key = models.CharField(max_length=64, db_index=True)
+    
+    class Meta:
+        unique_together = ['patient', 'key']
+    
+    def __str__(self):
+        return f"{self.patient_id} - {self.key}"
+
+
+class Job(models.Model):
+    """Background job claimed and run by ``manage.py run_worker``."""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+    
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    priority = models.SmallIntegerField(default=0, help_text="Higher runs first")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    progress = models.PositiveSmallIntegerField(default=0, help_text="Percent complete")
+    progress_message = models.CharField(max_length=255, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_after']),
+        ]
+    
+    def __str__(self):
+        return f"#{self.pk} {self.name} ({self.status})"
+
+
+class DailyClinicStats(models.Model):
+    """Per-clinic, per-visit-date counters kept up to date by signals; see patients/daily_stats.py."""
+    clinic = models.ForeignKey(
+        Clinic,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        db_constraint=False,
+        related_name='+'
+    )
+    date = models.DateField()
+    visits = models.IntegerField(default=0)
+    underweight = models.IntegerField(default=0)
+    normal = models.IntegerField(default=0)
+    overweight = models.IntegerField(default=0)
+    general_assessments = models.IntegerField(default=0)
+    overweight_assessments = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-date']
+        verbose_name_plural = 'daily clinic stats'
+        constraints = [
+            models.UniqueConstraint(fields=['clinic', 'date'], name='daily_stats_clinic_date_uniq'),
+            models.UniqueConstraint(
+                fields=['date'],
+                condition=models.Q(clinic__isnull=True),
+                name='daily_stats_date_uniq'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.date}: {self.visits} visit(s)"
+    
+    @property
+    def assessed(self):
+        return self.general_assessments + self.overweight_assessments
+    
+    @property
+    def completion_rate(self):
+        if not self.visits:
+            return None
+        return round(self.assessed / self.visits, 4)
+
+
+class AuditEvent(models.Model):
+    """Who listed, viewed or changed which records; written in batches by patients/audit.py."""
+    ACTION_CHOICES = [
+        ('list', 'List'),
+        ('view', 'View'),
+        ('create', 'Create'),
+        ('update', 'Update'),
+        ('delete', 'Delete'),
+    ]
+    
+    occurred_at = models.DateTimeField()
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        blank=True,
+        db_constraint=False,
+        related_name='+'
+    )
+    username = models.CharField(max_length=150, blank=True)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    clinic = models.ForeignKey(
+        Clinic,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        blank=True,
+        db_constraint=False,
+        related_name='+'
+    )
+    # Plain ids rather than foreign keys: the log outlives deleted records.
+    patient_pk = models.BigIntegerField(null=True, blank=True)
+    visit_pk = models.BigIntegerField(null=True, blank=True)
+    assessment_pk = models.BigIntegerField(null=True, blank=True)
+    path = models.CharField(max_length=255)
+    status = models.PositiveSmallIntegerField()
+    
+    class Meta:
+        ordering = ['-occurred_at']
+        indexes = [
+            models.Index(fields=['occurred_at']),
+            models.Index(fields=['patient_pk', '-occurred_at']),
+            models.Index(fields=['user', '-occurred_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.occurred_at:%Y-%m-%d %H:%M:%S} {self.username or 'anonymous'} {self.action} {self.path}"
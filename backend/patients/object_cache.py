@@ -0,0 +1,293 @@
+"""
+Write-through object cache for Patient and Visit lookups.
+
+Objects are cached by pk, and patients additionally by their natural key
+(``patient_id`` maps to the pk). The first tier is a bounded in-process LRU;
+an optional shared Django cache (``OBJECT_CACHE_BACKEND``) sits behind it so
+several workers can share fills. ``post_save`` writes the new row through to
+both tiers and ``post_delete`` replaces it with a negative entry; both happen
+on commit, and stale entries are dropped immediately. Lookups of ids that
+do not exist are negatively cached for ``OBJECT_CACHE_NEGATIVE_TTL`` seconds.
+Keys include the database alias, and patients outside the current clinic
+are reported as missing.
+
+Those receivers only reach the writing process's LRU (and the shared tier).
+With ``EVENTS_BACKEND = 'postgres'`` each process also subscribes to the
+change notifications relayed by patients/events.py and drops its local
+copies of every patient and visit another process wrote; otherwise they
+stay until ``OBJECT_CACHE_TIMEOUT``.
+
+Callers always receive a private copy, so mutating a returned instance never
+leaks into the cache or into other requests.
+"""
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, router
+from django.http import Http404
+
+from . import events
+from .models import Patient, Visit
+from .tenancy import belongs_to_current_clinic
+
+MISSING = '__missing__'
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires_at = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RemoteWrites(events.Subscription):
+    """Change notifications from every process, used to drop stale local entries."""
+    MODELS = {'patient': Patient, 'visit': Visit}
+
+    def __init__(self, cache):
+        super().__init__(None)
+        self.cache = cache
+
+    def put(self, event):
+        model = self.MODELS.get(event.get('model'))
+        if model is not None:
+            self.cache.forget(model, event['id'])
+
+
+class ObjectCache:
+    def __init__(self):
+        self.local = LRUCache(settings.OBJECT_CACHE_SIZE)
+        self.stats = {'hits': 0, 'misses': 0, 'negative_hits': 0, 'writes': 0, 'remote_evictions': 0}
+        self._stats_lock = threading.Lock()
+        self._listening = {'pid': None, 'subscription': None}
+
+    @property
+    def shared(self):
+        alias = settings.OBJECT_CACHE_BACKEND
+        return caches[alias] if alias else None
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def listen(self):
+        """Subscribe this process to other processes' writes (again after a fork)."""
+        with self._stats_lock:
+            if self._listening['pid'] == os.getpid():
+                return
+            # A subscription inherited from the parent is not this process's own.
+            if self._listening['subscription'] is not None:
+                events.broadcaster.unsubscribe(self._listening['subscription'])
+            self._listening['pid'] = os.getpid()
+            self._listening['subscription'] = RemoteWrites(self)
+        events.broadcaster.subscribe(self._listening['subscription'])
+
+    def forget(self, model, pk):
+        """Drop this process's local copies of ``pk`` in every database."""
+        for using in connections:
+            self.local.delete(self.pk_key(model, pk, using))
+        self._count('remote_evictions')
+
+    def _get(self, key):
+        if settings.EVENTS_BACKEND == 'postgres' and self._listening['pid'] != os.getpid():
+            self.listen()
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value, self._timeout(value))
+        return value
+
+    def _set(self, key, value):
+        timeout = self._timeout(value)
+        self.local.set(key, value, timeout)
+        if self.shared is not None:
+            self.shared.set(key, value, timeout)
+
+    def _timeout(self, value):
+        if value == MISSING:
+            return settings.OBJECT_CACHE_NEGATIVE_TTL
+        return settings.OBJECT_CACHE_TIMEOUT
+
+    @staticmethod
+    def pk_key(model, pk, using):
+        return f"obj:{using}:{model._meta.model_name}:pk:{pk}"
+
+    @staticmethod
+    def natural_key(model, value, using):
+        return f"obj:{using}:{model._meta.model_name}:nk:{value}"
+
+    @staticmethod
+    def read_db(model):
+        return router.db_for_read(model) or 'default'
+
+    @staticmethod
+    def instance_db(instance):
+        return instance._state.db or router.db_for_write(type(instance), instance=instance) or 'default'
+
+    @staticmethod
+    def detach(instance):
+        instance = copy.copy(instance)
+        instance._state.fields_cache = {}
+        instance.__dict__.pop('_prefetched_objects_cache', None)
+        return instance
+
+    def get(self, model, pk):
+        using = self.read_db(model)
+        key = self.pk_key(model, pk, using)
+        value = self._get(key)
+        if value == MISSING:
+            self._count('negative_hits')
+            raise model.DoesNotExist(f"{model.__name__} {pk} does not exist.")
+        if value is not None:
+            self._count('hits')
+            return self.detach(value)
+
+        self._count('misses')
+        try:
+            # Unscoped, so negative entries never depend on the current clinic.
+            instance = model._base_manager.using(using).get(pk=pk)
+        except model.DoesNotExist:
+            self._set(key, MISSING)
+            raise
+        self.store(instance)
+        return self.detach(instance)
+
+    def get_by_natural_key(self, model, field, value):
+        using = self.read_db(model)
+        key = self.natural_key(model, value, using)
+        pk = self._get(key)
+        if pk == MISSING:
+            self._count('negative_hits')
+            raise model.DoesNotExist(f"{model.__name__} {value} does not exist.")
+        if pk is not None:
+            try:
+                instance = self.get(model, pk)
+            except model.DoesNotExist:
+                instance = None
+            if instance is not None and getattr(instance, field) == value:
+                return instance
+
+        self._count('misses')
+        try:
+            instance = model._base_manager.using(using).get(**{field: value})
+        except model.DoesNotExist:
+            self._set(key, MISSING)
+            raise
+        self.store(instance)
+        return self.detach(instance)
+
+    def store(self, instance):
+        model = type(instance)
+        using = self.instance_db(instance)
+        self._count('writes')
+        self._set(self.pk_key(model, instance.pk, using), self.detach(instance))
+        if model is Patient:
+            self._set(self.natural_key(model, instance.patient_id, using), instance.pk)
+
+    def discard(self, instance):
+        """Drop entries for ``instance`` without leaving a negative entry."""
+        model = type(instance)
+        using = self.instance_db(instance)
+        keys = [self.pk_key(model, instance.pk, using)]
+        if model is Patient:
+            keys.append(self.natural_key(model, instance.patient_id, using))
+        for key in keys:
+            self.local.delete(key)
+            if self.shared is not None:
+                self.shared.delete(key)
+
+    def evict(self, instance, pk=None):
+        model = type(instance)
+        using = self.instance_db(instance)
+        pk = instance.pk if pk is None else pk
+        self._set(self.pk_key(model, pk, using), MISSING)
+        if model is Patient:
+            self._set(self.natural_key(model, instance.patient_id, using), MISSING)
+
+    def clear(self):
+        self.local.clear()
+        with self._stats_lock:
+            for name in self.stats:
+                self.stats[name] = 0
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_ratio'] = (
+            round((stats['hits'] + stats['negative_hits']) / lookups, 4) if lookups else None
+        )
+        stats['local_entries'] = len(self.local)
+        stats['local_max_entries'] = self.local.max_entries
+        stats['shared_backend'] = settings.OBJECT_CACHE_BACKEND or None
+        return stats
+
+
+object_cache = ObjectCache()
+
+
+def get_patient(pk=None, patient_id=None):
+    if patient_id is not None:
+        patient = object_cache.get_by_natural_key(Patient, 'patient_id', patient_id)
+    else:
+        patient = object_cache.get(Patient, pk)
+    if not belongs_to_current_clinic(patient.clinic_id):
+        raise Patient.DoesNotExist(f"Patient {patient_id or pk} does not exist.")
+    return patient
+
+
+def get_visit(pk):
+    visit = object_cache.get(Visit, pk)
+    visit.patient = get_patient(pk=visit.patient_id)
+    return visit
+
+
+def get_patient_or_404(**kwargs):
+    try:
+        return get_patient(**kwargs)
+    except (Patient.DoesNotExist, ValueError):
+        raise Http404('No Patient matches the given query.')
+
+
+def get_visit_or_404(pk):
+    try:
+        return get_visit(pk)
+    except (Visit.DoesNotExist, ValueError):
+        raise Http404('No Visit matches the given query.')
@@ -0,0 +1,318 @@
+"""
+Optional PostgreSQL declarative partitioning for the Visit table.
+
+The ``patients_visit`` table can be converted into a table partitioned by
+RANGE on ``visit_date`` (one partition per year or per month). Queries that
+filter on ``visit_date`` are then pruned by the planner to the partitions
+they touch, and index maintenance stays proportional to recent data.
+
+PostgreSQL requires every unique constraint on a partitioned table to
+include the partition key, so the converted table uses ``(id, visit_date)``
+as its primary key. ``unique_together = (patient, visit_date)`` already
+includes the key and is kept as-is. Ids still come from the same identity
+sequence, so ``Visit.objects.get(pk=...)`` keeps working. The database-level
+foreign key from ``patients_assessment.visit_id`` cannot reference a
+partitioned table without the partition key, so it is dropped; deletes still
+cascade through the ORM's ``on_delete=CASCADE``.
+
+Visits dated outside every partition land in the DEFAULT partition. When a
+partition is created for a range that already has such rows, the default
+partition is detached, the rows are moved into the new partition and the
+default is attached again, all in one transaction.
+
+Once converted, the table's own partitions decide the interval:
+``ensure_partitions`` keeps to it whatever ``VISIT_PARTITION_INTERVAL``
+says now.
+"""
+import re
+from datetime import date
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import Visit
+
+INTERVALS = ('year', 'month')
+
+
+def is_supported():
+    return connection.vendor == 'postgresql'
+
+
+def partition_start(value, interval):
+    if interval == 'year':
+        return date(value.year, 1, 1)
+    return date(value.year, value.month, 1)
+
+
+def next_partition_start(value, interval):
+    start = partition_start(value, interval)
+    if interval == 'year':
+        return date(start.year + 1, 1, 1)
+    if start.month == 12:
+        return date(start.year + 1, 1, 1)
+    return date(start.year, start.month + 1, 1)
+
+
+def partition_name(start, interval, table=None):
+    table = table or Visit._meta.db_table
+    if interval == 'year':
+        return f"{table}_y{start.year}"
+    return f"{table}_y{start.year}m{start.month:02d}"
+
+
+def partition_ranges(first, last, interval):
+    """Yield (start, end) bounds covering every date from first to last."""
+    start = partition_start(first, interval)
+    while start <= last:
+        end = next_partition_start(start, interval)
+        yield start, end
+        start = end
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return date(value.year + month // 12, month % 12 + 1, 1)
+
+
+def get_interval(interval=None):
+    interval = interval or getattr(settings, 'VISIT_PARTITION_INTERVAL', 'month')
+    if interval not in INTERVALS:
+        raise ValueError(f"Unsupported partition interval: {interval}")
+    return interval
+
+
+def partitioned_interval(partitions, table=None):
+    """The interval ``partitions`` (names) were created with, or None if there are none yet."""
+    table = table or Visit._meta.db_table
+    for name in sorted(partitions):
+        match = re.fullmatch(rf'{re.escape(table)}_y\d{{4}}(?P<month>m\d{{2}})?', name)
+        if match:
+            return 'month' if match.group('month') else 'year'
+    return None
+
+
+def is_partitioned(cursor, table=None):
+    table = table or Visit._meta.db_table
+    cursor.execute(
+        "SELECT c.relkind FROM pg_class c "
+        "WHERE c.oid = to_regclass(%s)",
+        [table]
+    )
+    row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def existing_partitions(cursor, table=None):
+    table = table or Visit._meta.db_table
+    cursor.execute(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = %s",
+        [table]
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def copy_columns(cursor, table):
+    """Quoted columns to copy rows by; generated columns (bmi, bmi_status) are recomputed."""
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER' "
+        "ORDER BY ordinal_position",
+        [table]
+    )
+    return ', '.join(connection.ops.quote_name(row[0]) for row in cursor.fetchall())
+
+
+def default_rows_in(cursor, table, start, end):
+    """Whether ``table``'s DEFAULT partition holds visits dated in [start, end)."""
+    default = f"{Visit._meta.db_table}_default"
+    cursor.execute(
+        "SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s) AND inhparent = to_regclass(%s)",
+        [default, table]
+    )
+    if cursor.fetchone() is None:
+        return False
+    cursor.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {connection.ops.quote_name(default)} "
+        f"WHERE visit_date >= %s AND visit_date < %s)",
+        [start.isoformat(), end.isoformat()]
+    )
+    return cursor.fetchone()[0]
+
+
+def create_partition(cursor, start, end, interval, table=None):
+    table = table or Visit._meta.db_table
+    name = partition_name(start, interval, table=Visit._meta.db_table)
+    default = f"{Visit._meta.db_table}_default"
+    qn = connection.ops.quote_name
+    create = (
+        f"CREATE TABLE IF NOT EXISTS {qn(name)} PARTITION OF {qn(table)} "
+        f"FOR VALUES FROM (%s) TO (%s)"
+    )
+    bounds = [start.isoformat(), end.isoformat()]
+    if not default_rows_in(cursor, table, start, end):
+        cursor.execute(create, bounds)
+        return name
+
+    # PostgreSQL refuses a partition whose range matches rows already in the
+    # default partition: take it out, move those rows, then put it back.
+    with transaction.atomic():
+        cursor.execute(f"ALTER TABLE {qn(table)} DETACH PARTITION {qn(default)}")
+        cursor.execute(create, bounds)
+        columns = copy_columns(cursor, table)
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {qn(default)} WHERE visit_date >= %s AND visit_date < %s "
+            f"RETURNING {columns}) "
+            f"INSERT INTO {qn(table)} ({columns}) OVERRIDING SYSTEM VALUE SELECT {columns} FROM moved",
+            bounds
+        )
+        cursor.execute(f"ALTER TABLE {qn(table)} ATTACH PARTITION {qn(default)} DEFAULT")
+    return name
+
+
+def ensure_partitions(ahead=None, interval=None, today=None):
+    """
+    Create partitions from the current period up to ``ahead`` periods in
+    the future, in the interval the table was converted with. Safe to run
+    repeatedly (e.g. daily from cron); returns the names of the partitions
+    that were created. Raises ValueError if ``interval`` is given and differs
+    from the table's.
+    """
+    if ahead is None:
+        ahead = getattr(settings, 'VISIT_PARTITIONS_AHEAD', 3)
+    today = today or date.today()
+
+    created = []
+    with connection.cursor() as cursor:
+        if not is_partitioned(cursor):
+            return created
+        existing = existing_partitions(cursor)
+        converted = partitioned_interval(existing)
+        if interval and converted and interval != converted:
+            raise ValueError(f"{Visit._meta.db_table} is partitioned by {converted}, not {interval}")
+        interval = get_interval(converted or interval)
+        if interval == 'year':
+            last = date(today.year + ahead, 1, 1)
+        else:
+            last = add_months(today, ahead)
+        for start, end in partition_ranges(today, last, interval):
+            name = partition_name(start, interval)
+            if name not in existing:
+                create_partition(cursor, start, end, interval)
+                created.append(name)
+    return created
+
+
+def convert_visit_table(interval=None, ahead=None, stdout=None):
+    """
+    Rebuild ``patients_visit`` as a partitioned table in a single
+    transaction, keeping the Django index and constraint names (and the
+    CHECK constraints and partial index conditions) so later migrations
+    continue to apply.
+    """
+    interval = get_interval(interval)
+    if ahead is None:
+        ahead = getattr(settings, 'VISIT_PARTITIONS_AHEAD', 3)
+    table = Visit._meta.db_table
+    staging = f"{table}_partitioned"
+    qn = connection.ops.quote_name
+
+    def log(message):
+        if stdout is not None:
+            stdout.write(message)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        if is_partitioned(cursor):
+            log(f"{table} is already partitioned.")
+            return False
+
+        cursor.execute(f"LOCK TABLE {qn(table)} IN ACCESS EXCLUSIVE MODE")
+        constraints = connection.introspection.get_constraints(cursor, table)
+        # Full definitions, so expressions, operator classes and WHERE clauses survive.
+        cursor.execute(
+            "SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i "
+            "WHERE i.indrelid = to_regclass(%s) AND NOT EXISTS ("
+            "SELECT 1 FROM pg_constraint c WHERE c.conrelid = i.indrelid AND c.conindid = i.indexrelid)",
+            [table]
+        )
+        indexes = [row[0] for row in cursor.fetchall()]
+
+        cursor.execute(f"SELECT MIN(visit_date), MAX(visit_date) FROM {qn(table)}")
+        first, last = cursor.fetchone()
+        today = date.today()
+        first = min(first or today, today)
+        if interval == 'year':
+            horizon = date(today.year + ahead, 1, 1)
+        else:
+            horizon = add_months(today, ahead)
+        last = max(last or today, horizon)
+
+        cursor.execute(
+            f"CREATE TABLE {qn(staging)} (LIKE {qn(table)} "
+            f"INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING GENERATED INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE (visit_date)"
+        )
+        for start, end in partition_ranges(first, last, interval):
+            create_partition(cursor, start, end, interval, table=staging)
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {qn(table + '_default')} "
+            f"PARTITION OF {qn(staging)} DEFAULT"
+        )
+        columns = copy_columns(cursor, table)
+        log(f"Copying rows into {staging}...")
+        cursor.execute(
+            f"INSERT INTO {qn(staging)} ({columns}) OVERRIDING SYSTEM VALUE "
+            f"SELECT {columns} FROM {qn(table)}"
+        )
+
+        # Constraints that reference the old table go away with it.
+        cursor.execute(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+            "WHERE confrelid = to_regclass(%s) AND contype = 'f'",
+            [table]
+        )
+        for referencing_table, name in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {referencing_table} DROP CONSTRAINT {qn(name)}")
+
+        cursor.execute(f"DROP TABLE {qn(table)}")
+        cursor.execute(f"ALTER TABLE {qn(staging)} RENAME TO {qn(table)}")
+
+        for name, info in constraints.items():
+            columns = ', '.join(qn(c) for c in info['columns'])
+            if info['primary_key']:
+                cursor.execute(
+                    f"ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} "
+                    f"PRIMARY KEY ({columns}, visit_date)"
+                )
+            elif info['unique']:
+                cursor.execute(
+                    f"ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} "
+                    f"UNIQUE ({columns})"
+                )
+            elif info['foreign_key']:
+                ref_table, ref_column = info['foreign_key']
+                cursor.execute(
+                    f"ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} "
+                    f"FOREIGN KEY ({columns}) REFERENCES {qn(ref_table)} ({qn(ref_column)}) "
+                    f"DEFERRABLE INITIALLY DEFERRED"
+                )
+        # The definitions name the table, which the partitioned one now has.
+        for definition in indexes:
+            cursor.execute(definition)
+
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {qn(table)}), 0) + 1, false)",
+            [table]
+        )
+    log(f"{table} is now partitioned by {interval}.")
+    return True
+
+
+def ensure_partitions_after_migrate(sender, using='default', **kwargs):
+    if using != 'default' or not is_supported():
+        return
+    ensure_partitions()
@@ -0,0 +1,83 @@
+"""
+Work queue of visits that still need an assessment.
+
+``Visit.awaiting_assessment`` is cleared when an Assessment is created and
+set again when it is deleted, and ``assessment_status_changed_at`` records
+when that happened. The queue itself is served from the partial index
+``visit_pending_assessment_idx`` (only pending rows are indexed), and
+pollers pass back the ``cursor`` of their previous response to receive only
+visits that entered or left the queue since then. Cursors overlap by
+``PENDING_ASSESSMENT_CURSOR_OVERLAP`` seconds so that rows written by a
+transaction that committed late are not missed; clients apply changes
+idempotently. Deleted (and archived) visits are reported as resolved from
+their tombstones. When a delta fills ``PENDING_ASSESSMENT_LIMIT``, its
+cursor is the change time of the last row sent, so the next poll picks up
+the rest.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import changes, events
+from .models import Tombstone, Visit
+from .object_cache import object_cache
+
+
+def set_awaiting(visit_pk, awaiting, using='default'):
+    # update() skips Visit's post_save receivers: move updated_at for delta
+    # sync and record and publish the change here.
+    now = timezone.now()
+    Visit.all_clinics.using(using).filter(pk=visit_pk).update(
+        awaiting_assessment=awaiting,
+        assessment_status_changed_at=now,
+        updated_at=now
+    )
+    visit = Visit.all_clinics.using(using).filter(pk=visit_pk).first()
+    if visit is None:
+        return
+    object_cache.discard(visit)
+    change = changes.record_change(visit, 'update', visit.patient_id)
+    events.notify(visit, change, visit.patient_id)
+
+
+def pending_visits():
+    return (
+        Visit.objects.filter(awaiting_assessment=True)
+        .select_related('patient')
+        .order_by('visit_date', 'id')
+    )
+
+
+def changes_since(since, limit=None):
+    """
+    Return ``(cursor, pending, resolved_ids)``: the full queue when ``since``
+    is None, otherwise only visits whose queue status changed after it.
+    """
+    limit = limit or settings.PENDING_ASSESSMENT_LIMIT
+    cursor = timezone.now()
+    if since is None:
+        return cursor, list(pending_visits()[:limit]), []
+
+    window_start = since - timedelta(seconds=settings.PENDING_ASSESSMENT_CURSOR_OVERLAP)
+    pending = list(
+        pending_visits().filter(assessment_status_changed_at__gt=window_start)
+        .order_by('assessment_status_changed_at', 'id')[:limit]
+    )
+    resolved = list(
+        Visit.objects.filter(assessment_status_changed_at__gt=window_start, awaiting_assessment=False)
+        .order_by('assessment_status_changed_at', 'id')
+        .values_list('id', 'assessment_status_changed_at')[:limit]
+    )
+    deleted = list(
+        Tombstone.objects.filter(model='visit', deleted_at__gt=window_start)
+        .order_by('deleted_at', 'id')
+        .values_list('object_id', 'deleted_at')[:limit]
+    )
+    # A full list may have left rows behind: resume after the earliest last row.
+    if len(pending) == limit:
+        cursor = min(cursor, pending[-1].assessment_status_changed_at)
+    for rows in (resolved, deleted):
+        if len(rows) == limit:
+            cursor = min(cursor, rows[-1][1])
+    return cursor, pending, [pk for pk, _ in resolved] + [pk for pk, _ in deleted]
@@ -0,0 +1,222 @@
+"""
+Opt-in per-request profiling.
+
+When ``PROFILING_ENABLED`` is set, ``ProfilingMiddleware`` profiles a request
+with cProfile if it carries a valid ``X-Profile`` token (see
+``manage.py profile_token``) or is picked by ``PROFILING_SAMPLE_RATE``. Each
+capture is written to ``PROFILING_DIR`` as ``<id>.prof`` (pstats) plus
+``<id>.json`` with the method and URL route, total time and every SQL
+statement with its duration. Neither the request path nor query parameters
+are stored, so captures hold no patient data.
+With the setting off the middleware removes itself at startup.
+"""
+import cProfile
+import json
+import os
+import pstats
+import random
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+HEADER = 'HTTP_X_PROFILE'
+SALT = 'patients.profiling'
+
+
+def make_token(label='manual'):
+    return signing.TimestampSigner(salt=SALT).sign(label)
+
+
+def valid_token(value):
+    try:
+        signing.TimestampSigner(salt=SALT).unsign(value, max_age=settings.PROFILING_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+class QueryRecorder:
+    """``execute_wrapper`` that keeps each statement and its duration."""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'db': self.alias,
+                'sql': sql,
+                'ms': round((time.perf_counter() - started) * 1000, 3),
+            })
+
+
+def profile_path(profile_id, suffix):
+    if not all(c.isalnum() or c == '-' for c in profile_id):
+        raise ValueError('Invalid profile id')
+    return os.path.join(settings.PROFILING_DIR, f'{profile_id}{suffix}')
+
+
+def save(profiler, request, response, elapsed, queries, trigger):
+    os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+    now = timezone.now()
+    profile_id = f"{now.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    profiler.dump_stats(profile_path(profile_id, '.prof'))
+    meta = {
+        'id': profile_id,
+        'captured_at': now.isoformat(),
+        'method': request.method,
+        # The URL pattern, not the path: paths and query strings carry patient ids and names.
+        'route': getattr(getattr(request, 'resolver_match', None), 'route', None),
+        'status': response.status_code,
+        'trigger': trigger,
+        'total_ms': round(elapsed * 1000, 3),
+        'sql_ms': round(sum(query['ms'] for query in queries), 3),
+        'queries': queries,
+    }
+    with open(profile_path(profile_id, '.json'), 'w') as fp:
+        json.dump(meta, fp)
+    prune()
+    return meta
+
+
+def list_profiles():
+    """Metadata of stored captures, newest first."""
+    if not os.path.isdir(settings.PROFILING_DIR):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(settings.PROFILING_DIR), reverse=True):
+        if name.endswith('.json'):
+            with open(os.path.join(settings.PROFILING_DIR, name)) as fp:
+                profiles.append(json.load(fp))
+    return profiles
+
+
+def load(profile_id):
+    with open(profile_path(profile_id, '.json')) as fp:
+        return json.load(fp)
+
+
+def prune():
+    profiles = list_profiles()
+    for meta in profiles[settings.PROFILING_MAX_PROFILES:]:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(profile_path(meta['id'], suffix))
+            except FileNotFoundError:
+                pass
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def call_tree(profile_id, min_fraction=0.005, max_depth=40):
+    """
+    Build a top-down call tree from the pstats capture. Each node is
+    ``{'name', 'ms', 'children'}``; branches below ``min_fraction`` of the
+    total are folded into their parent.
+    """
+    stats = pstats.Stats(profile_path(profile_id, '.prof')).stats
+    children = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            children.setdefault(caller, []).append((func, caller_stats[3]))
+    roots = [func for func, data in stats.items() if not data[4]]
+    total = sum(stats[func][3] for func in roots) or 1e-9
+
+    def build(func, cumulative, path):
+        node = {'name': _label(func), 'ms': round(cumulative * 1000, 3), 'children': []}
+        if len(path) >= max_depth:
+            return node
+        for child, child_time in sorted(children.get(func, []), key=lambda item: -item[1]):
+            if child in path or child_time / total < min_fraction:
+                continue
+            node['children'].append(build(child, min(child_time, cumulative), path | {child}))
+        return node
+
+    nodes = [build(func, stats[func][3], {func}) for func in roots if stats[func][3] / total >= min_fraction]
+    return {'name': 'request', 'ms': round(total * 1000, 3), 'children': sorted(nodes, key=lambda n: -n['ms'])}
+
+
+def flame_rows(tree):
+    """
+    Flatten a call tree into rows of positioned frames (offset and width in
+    percent of the root) for rendering as an icicle-style flame graph.
+    """
+    rows = []
+    total = tree['ms'] or 1e-9
+
+    def visit(node, depth, offset):
+        while len(rows) <= depth:
+            rows.append([])
+        rows[depth].append({
+            'name': node['name'],
+            'ms': node['ms'],
+            'left': round(offset / total * 100, 3),
+            'width': round(node['ms'] / total * 100, 3),
+        })
+        child_offset = offset
+        for child in node['children']:
+            visit(child, depth + 1, child_offset)
+            child_offset += child['ms']
+
+    visit(tree, 0, 0)
+    return rows
+
+
+class ProfilingMiddleware:
+    """Profile requests that carry a signed ``X-Profile`` token or are sampled."""
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def trigger(self, request):
+        token = request.META.get(HEADER)
+        if token and valid_token(token):
+            return 'header'
+        if settings.PROFILING_SAMPLE_RATE and random.random() < settings.PROFILING_SAMPLE_RATE:
+            return 'sample'
+        return None
+
+    def __call__(self, request):
+        trigger = self.trigger(request)
+        if trigger is None:
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler per process; another
+            # thread holds it, so serve this request unprofiled.
+            return self.get_response(request)
+        recorders = [QueryRecorder(alias) for alias in connections]
+        try:
+            with ExitStack() as stack:
+                for recorder in recorders:
+                    stack.enter_context(connections[recorder.alias].execute_wrapper(recorder))
+                started = time.perf_counter()
+                response = self.get_response(request)
+                elapsed = time.perf_counter() - started
+        finally:
+            profiler.disable()
+
+        queries = [query for recorder in recorders for query in recorder.queries]
+        meta = save(profiler, request, response, elapsed, queries, trigger)
+        response['X-Profile-Id'] = meta['id']
+        return response
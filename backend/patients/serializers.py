@@ -1,5 +1,8 @@
 from rest_framework import serializers
-from .models import Patient, Visit, Assessment
+from .models import (
+    Patient, Visit, Assessment, ArchivedVisit, ArchiveSummary, ChangeEvent, Job, DailyClinicStats, AuditEvent
+)
+from . import archive, duplicates
 from datetime import date
 from decimal import Decimal
 
@@ -7,6 +10,7 @@ from decimal import Decimal
 class PatientSerializer(serializers.ModelSerializer):
     age = serializers.ReadOnlyField()
     full_name = serializers.ReadOnlyField()
+    confirm_duplicate = serializers.BooleanField(write_only=True, required=False, default=False)
     
     class Meta:
         model = Patient
@@ -20,6 +24,7 @@ class PatientSerializer(serializers.ModelSerializer):
             'gender',
             'age',
             'registration_date',
+            'confirm_duplicate',
             'created_at',
             'updated_at'
         ]
@@ -30,7 +35,7 @@ class PatientSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Patient ID cannot be empty.")
         
         if self.instance is None:
-            if Patient.objects.filter(patient_id=value).exists():
+            if Patient.all_clinics.filter(patient_id=value).exists():
                 raise serializers.ValidationError(
                     "A patient with this Patient ID already exists."
                 )
@@ -50,10 +55,39 @@ class PatientSerializer(serializers.ModelSerializer):
             )
         
         return value
+    
+    def validate(self, data):
+        if self.instance is None and not data.get('confirm_duplicate'):
+            candidates = duplicates.find_candidates(
+                data['first_name'],
+                data['last_name'],
+                data['date_of_birth'],
+                data['gender']
+            )
+            if candidates:
+                raise serializers.ValidationError({
+                    'possible_duplicates': [
+                        f"{c['patient_id']} - {c['first_name']} {c['last_name']} "
+                        f"({c['date_of_birth']}, score {c['score']})"
+                        for c in candidates
+                    ],
+                    'confirm_duplicate': 'Set to true to register this patient anyway.'
+                })
+        return data
+    
+    def create(self, validated_data):
+        validated_data.pop('confirm_duplicate', None)
+        return super().create(validated_data)
+    
+    def update(self, instance, validated_data):
+        validated_data.pop('confirm_duplicate', None)
+        return super().update(instance, validated_data)
 
 
 class VisitSerializer(serializers.ModelSerializer):
-    bmi_status = serializers.SerializerMethodField()
+    height = serializers.DecimalField(max_digits=5, decimal_places=2)
+    weight = serializers.DecimalField(max_digits=5, decimal_places=2)
+    bmi_status = serializers.CharField(read_only=True)
     patient_id = serializers.CharField(write_only=True, required=False)
     
     class Meta:
@@ -67,13 +101,12 @@ class VisitSerializer(serializers.ModelSerializer):
             'weight',
             'bmi',
             'bmi_status',
+            'bmi_for_age_z',
+            'bmi_for_age_percentile',
             'created_at',
             'updated_at'
         ]
-        read_only_fields = ['id', 'bmi', 'created_at', 'updated_at']
-    
-    def get_bmi_status(self, obj):
-        return obj.get_bmi_status()
+        read_only_fields = ['id', 'bmi', 'bmi_for_age_z', 'bmi_for_age_percentile', 'created_at', 'updated_at']
     
     def validate_visit_date(self, value):
         if value > date.today():
@@ -87,6 +120,11 @@ class VisitSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(
                 "Height must be between 30 and 300 cm."
             )
+        # Stored in whole millimetres; finer values would come back changed.
+        if value != value.quantize(Decimal('0.1')):
+            raise serializers.ValidationError(
+                "Height can have at most one decimal place (0.1 cm)."
+            )
         return value
     
     def validate_weight(self, value):
@@ -185,6 +223,7 @@ class PatientListSerializer(serializers.ModelSerializer):
     patient_name = serializers.SerializerMethodField()
     age = serializers.ReadOnlyField()
     last_bmi_status = serializers.SerializerMethodField()
+    last_bmi_percentile = serializers.SerializerMethodField()
     last_assessment_date = serializers.SerializerMethodField()
     
     class Meta:
@@ -195,6 +234,7 @@ class PatientListSerializer(serializers.ModelSerializer):
             'patient_name',
             'age',
             'last_bmi_status',
+            'last_bmi_percentile',
             'last_assessment_date'
         ]
     
@@ -204,6 +244,10 @@ class PatientListSerializer(serializers.ModelSerializer):
     def get_last_bmi_status(self, obj):
         return obj.get_latest_bmi_status()
     
+    def get_last_bmi_percentile(self, obj):
+        percentile = obj.get_latest_bmi_percentile()
+        return str(percentile) if percentile is not None else None
+    
     def get_last_assessment_date(self, obj):
         date_obj = obj.get_latest_assessment_date()
         if date_obj:
@@ -211,10 +255,65 @@ class PatientListSerializer(serializers.ModelSerializer):
         return None
 
 
+class ArchivedVisitSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source='original_id', read_only=True)
+    bmi_status = serializers.SerializerMethodField()
+    archived = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = ArchivedVisit
+        fields = [
+            'id',
+            'patient',
+            'visit_date',
+            'height',
+            'weight',
+            'bmi',
+            'bmi_status',
+            'created_at',
+            'updated_at',
+            'archived'
+        ]
+        read_only_fields = fields
+    
+    def get_bmi_status(self, obj):
+        return obj.get_bmi_status()
+    
+    def get_archived(self, obj):
+        return True
+
+
+def serialize_merged_visits(rows, context=None):
+    """Serialize a mix of Visit and ArchivedVisit rows, keeping their order."""
+    hot = [row for row in rows if isinstance(row, Visit)]
+    archived = [row for row in rows if not isinstance(row, Visit)]
+    data = {
+        id(row): item for row, item in zip(
+            hot + archived,
+            list(VisitSerializer(hot, many=True, context=context).data)
+            + list(ArchivedVisitSerializer(archived, many=True, context=context).data)
+        )
+    }
+    return [data[id(row)] for row in rows]
+
+
+class ArchiveSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ArchiveSummary
+        fields = [
+            'visit_count',
+            'assessment_count',
+            'first_visit_date',
+            'last_visit_date',
+            'last_bmi'
+        ]
+
+
 class PatientDetailSerializer(serializers.ModelSerializer):
     age = serializers.ReadOnlyField()
     full_name = serializers.ReadOnlyField()
-    visits = VisitSerializer(many=True, read_only=True)
+    visits = serializers.SerializerMethodField()
+    archive_summary = serializers.SerializerMethodField()
     
     class Meta:
         model = Patient
@@ -229,7 +328,122 @@ class PatientDetailSerializer(serializers.ModelSerializer):
             'age',
             'registration_date',
             'visits',
+            'archive_summary',
             'created_at',
             'updated_at'
         ]
         read_only_fields = ['id', 'registration_date', 'created_at', 'updated_at']
+    
+    def get_visits(self, obj):
+        request = self.context.get('request')
+        if request is None or not archive.wants_archive(request.query_params):
+            return VisitSerializer(obj.visits.all(), many=True).data
+        archived = archive.filter_archived(obj.archived_visits.all(), request.query_params)
+        return serialize_merged_visits(archive.MergedVisits(obj.visits.all(), archived)[:])
+    
+    def get_archive_summary(self, obj):
+        summary = obj.get_archive_summary()
+        if summary is None:
+            return None
+        return ArchiveSummarySerializer(summary).data
+
+
+class ChangeEventSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChangeEvent
+        fields = ['seq', 'model', 'object_id', 'action', 'payload', 'created_at']
+
+
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Job
+        fields = [
+            'id',
+            'name',
+            'payload',
+            'status',
+            'priority',
+            'attempts',
+            'max_attempts',
+            'run_after',
+            'progress',
+            'progress_message',
+            'result',
+            'error',
+            'created_at',
+            'updated_at',
+            'finished_at'
+        ]
+        read_only_fields = fields
+
+
+class DailyClinicStatsSerializer(serializers.ModelSerializer):
+    assessed = serializers.IntegerField(read_only=True)
+    completion_rate = serializers.FloatField(read_only=True)
+    
+    class Meta:
+        model = DailyClinicStats
+        fields = [
+            'date',
+            'visits',
+            'underweight',
+            'normal',
+            'overweight',
+            'general_assessments',
+            'overweight_assessments',
+            'assessed',
+            'completion_rate'
+        ]
+
+
+class PendingAssessmentSerializer(serializers.ModelSerializer):
+    patient_id = serializers.CharField(source='patient.patient_id', read_only=True)
+    patient_name = serializers.SerializerMethodField()
+    required_assessment_type = serializers.SerializerMethodField()
+    bmi_status = serializers.CharField(read_only=True)
+    
+    class Meta:
+        model = Visit
+        fields = [
+            'id',
+            'patient',
+            'patient_id',
+            'patient_name',
+            'visit_date',
+            'bmi',
+            'bmi_status',
+            'required_assessment_type',
+            'assessment_status_changed_at'
+        ]
+    
+    def get_patient_name(self, obj):
+        return f"{obj.patient.first_name} {obj.patient.last_name}"
+    
+    def get_required_assessment_type(self, obj):
+        return 'overweight' if obj.requires_overweight_assessment() else 'general'
+
+
+class AuditEventSerializer(serializers.ModelSerializer):
+    # Declared by column so rows read back from an AUDIT_FILE serialize the same way.
+    user = serializers.IntegerField(source='user_id', read_only=True)
+    clinic = serializers.IntegerField(source='clinic_id', read_only=True)
+    patient = serializers.IntegerField(source='patient_pk', read_only=True)
+    visit = serializers.IntegerField(source='visit_pk', read_only=True)
+    assessment = serializers.IntegerField(source='assessment_pk', read_only=True)
+    
+    class Meta:
+        model = AuditEvent
+        fields = [
+            'id',
+            'occurred_at',
+            'user',
+            'username',
+            'action',
+            'clinic',
+            'patient',
+            'visit',
+            'assessment',
+            'path',
+            'status'
+        ]
+        read_only_fields = fields
@@ -0,0 +1,179 @@
+from django.db.models import QuerySet
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db import transaction
+from django.dispatch import receiver
+
+from .models import ChangeEvent, Clinic, Patient, Visit, Assessment
+from .changes import record_change, recording
+from .sync import record_tombstone
+from . import listing_cache
+from .object_cache import object_cache
+from .duplicates import index_patient
+from . import daily_stats
+from . import pending
+from . import events
+from . import growth
+from .tenancy import forget_clinics
+from .coalescing import coalescer
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_save, sender=Visit)
+@receiver(post_save, sender=Assessment)
+def record_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    patient_pk = _patient_pk(instance)
+    change = record_change(instance, 'create' if created else 'update', patient_pk)
+    events.notify(instance, change, patient_pk)
+
+
+@receiver(post_delete, sender=Patient)
+@receiver(post_delete, sender=Visit)
+@receiver(post_delete, sender=Assessment)
+def record_delete(sender, instance, **kwargs):
+    if not recording():
+        return
+    patient_pk = _patient_pk(instance)
+    change = record_change(instance, 'delete', patient_pk)
+    record_tombstone(instance, change.clinic_id)
+    events.notify(instance, change, patient_pk)
+
+
+def _patient_pk(instance):
+    if isinstance(instance, Patient):
+        return instance.pk
+    if isinstance(instance, Visit):
+        return instance.patient_id
+    if Assessment.visit.is_cached(instance):
+        return instance.visit.patient_id
+    return (
+        Visit.all_clinics.using(instance._state.db)
+        .filter(pk=instance.visit_id)
+        .values_list('patient_id', flat=True)
+        .first()
+    )
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_save, sender=Visit)
+@receiver(post_save, sender=Assessment)
+@receiver(post_delete, sender=Patient)
+@receiver(post_delete, sender=Visit)
+@receiver(post_delete, sender=Assessment)
+def invalidate_listing_row(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # After commit, so a concurrent read cannot re-cache the row as it was.
+    patient_pk, using = _patient_pk(instance), instance._state.db
+    transaction.on_commit(lambda: listing_cache.invalidate(patient_pk, using), using=using)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_save, sender=Visit)
+def write_through_object_cache(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    object_cache.discard(instance)
+    snapshot = object_cache.detach(instance)
+    transaction.on_commit(lambda: object_cache.store(snapshot), using=instance._state.db)
+
+
+@receiver(post_delete, sender=Patient)
+@receiver(post_delete, sender=Visit)
+def evict_object_cache(sender, instance, **kwargs):
+    object_cache.discard(instance)
+    snapshot = object_cache.detach(instance)
+    transaction.on_commit(lambda: object_cache.evict(snapshot), using=instance._state.db)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_save, sender=Visit)
+@receiver(post_save, sender=Assessment)
+@receiver(post_delete, sender=Patient)
+@receiver(post_delete, sender=Visit)
+@receiver(post_delete, sender=Assessment)
+def clear_micro_cache(sender, raw=False, **kwargs):
+    if raw:
+        return
+    coalescer.clear()
+
+
+@receiver(post_save, sender=Patient)
+def update_blocking_keys(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    index_patient(instance)
+
+
+@receiver(post_save, sender=Patient)
+def rescore_visits(sender, instance, created, raw=False, **kwargs):
+    """A changed birth date or gender changes the BMI-for-age scores of every visit."""
+    if raw or created or not instance.growth_inputs_changed():
+        return
+    using = instance._state.db
+    rescored = growth.update_visits(Visit.all_clinics.using(using).filter(patient=instance))
+    # update_visits() bypasses the Visit post_save receivers: record, publish
+    # and drop cached copies here.
+    events_created = ChangeEvent.objects.using(using).bulk_create([
+        ChangeEvent(
+            clinic_id=instance.clinic_id,
+            model='visit',
+            object_id=visit_pk,
+            action='update',
+            payload={'patient': patient_pk, 'visit_date': str(visit_date)}
+        )
+        for visit_pk, patient_pk, visit_date in rescored
+    ])
+    for change, (visit_pk, patient_pk, _) in zip(events_created, rescored):
+        visit = Visit(pk=visit_pk, patient_id=patient_pk)
+        visit._state.db = using
+        object_cache.discard(visit)
+        events.notify(visit, change, patient_pk)
+    if rescored:
+        transaction.on_commit(lambda: listing_cache.invalidate(instance.pk, using), using=using)
+    instance.remember_growth_inputs()
+
+
+@receiver(pre_save, sender=Visit)
+@receiver(pre_save, sender=Assessment)
+def remember_daily_stats(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    daily_stats.record_previous(instance)
+
+
+@receiver(post_save, sender=Visit)
+@receiver(post_save, sender=Assessment)
+def update_daily_stats(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    daily_stats.record_saved(instance, created)
+
+
+@receiver(post_delete, sender=Visit)
+@receiver(post_delete, sender=Assessment)
+def remove_daily_stats(sender, instance, **kwargs):
+    daily_stats.record_deleted(instance)
+
+
+@receiver(post_save, sender=Assessment)
+def leave_pending_queue(sender, instance, created, raw=False, **kwargs):
+    if raw or not created:
+        return
+    pending.set_awaiting(instance.visit_id, False, using=instance._state.db)
+
+
+@receiver(post_delete, sender=Assessment)
+def return_to_pending_queue(sender, instance, origin=None, **kwargs):
+    # Only direct Assessment deletes: in a cascade the visit itself is going away.
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if not recording() or (origin is not None and origin_model is not Assessment):
+        return
+    pending.set_awaiting(instance.visit_id, True, using=instance._state.db)
+
+
+@receiver(post_save, sender=Clinic)
+@receiver(post_delete, sender=Clinic)
+def refresh_clinics(sender, **kwargs):
+    forget_clinics()
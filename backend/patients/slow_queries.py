@@ -0,0 +1,295 @@
+"""
+Slow-query log with sampled execution plans.
+
+With ``SLOW_QUERY_ENABLED`` every database connection gets an
+``execute_wrapper`` that times each statement. Statements slower than
+``SLOW_QUERY_THRESHOLD_MS`` are appended as JSON lines to ``SLOW_QUERY_LOG``
+with their shape (the SQL with literals replaced by ``?`` and parameter
+lists collapsed), a fingerprint of the shape and the innermost call site in
+this project, e.g. the ``PatientFilter`` method or view that built the
+queryset.
+
+A ``SLOW_QUERY_EXPLAIN_RATE`` sample of the slow SELECTs is run again under
+``EXPLAIN (ANALYZE, BUFFERS)`` on PostgreSQL or ``EXPLAIN QUERY PLAN`` on
+SQLite, on a separate cursor. Only node types, relations, indexes, row
+counts, timings and buffer counts are kept from the plan: like profiling
+captures, the log holds no parameters or filter values.
+
+``manage.py query_report`` ranks the shapes by total time and flags
+sequential scans of ``SLOW_QUERY_WATCHED_TABLES`` (partitions included)
+with the columns the query filters them on.
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import traceback
+from collections import Counter
+
+from django.conf import settings
+from django.utils import timezone
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w\"])-?\d+(?:\.\d+)?\b")
+_LIST = re.compile(r"\bIN \(\?(?:\s*,\s*\?)*\)", re.IGNORECASE)
+_SPACE = re.compile(r"\s+")
+_SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+_PARTITION = re.compile(r'^(?P<table>\w+?)(?:_y\d{4}(?:m\d{2})?|_default)$')
+# Row locks, SELECT INTO and functions with side effects that EXPLAIN ANALYZE would run for real.
+_UNSAFE = re.compile(
+    r'\bFOR\s+(?:NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b|\bINTO\b'
+    r'|\b(?:PG_NOTIFY|NEXTVAL|SETVAL|PG_(?:TRY_)?ADVISORY_\w+)\s*\('
+)
+
+PLAN_KEYS = (
+    'Node Type', 'Relation Name', 'Index Name', 'Join Type',
+    'Plan Rows', 'Actual Rows', 'Actual Loops', 'Actual Total Time',
+    'Shared Hit Blocks', 'Shared Read Blocks',
+)
+
+
+def normalize(sql):
+    """The shape of ``sql``: literals and placeholders as ``?``, ``IN`` lists as ``(...)``."""
+    shape = _STRING.sub('?', sql)
+    shape = _NUMBER.sub('?', shape.replace('%s', '?'))
+    shape = _LIST.sub('IN (...)', shape)
+    return _SPACE.sub(' ', shape).strip()
+
+
+def fingerprint(shape):
+    return hashlib.sha1(shape.encode()).hexdigest()[:12]
+
+
+def call_site():
+    """``path:line in function`` of the innermost frame in this project's code."""
+    root = str(settings.BASE_DIR)
+    for frame in reversed(traceback.extract_stack()[:-1]):
+        filename = frame.filename
+        if filename.startswith(root) and filename != __file__ and 'site-packages' not in filename:
+            return f"{os.path.relpath(filename, root)}:{frame.lineno} in {frame.name}"
+    return None
+
+
+def summarize_plan(node):
+    summary = {key: node[key] for key in PLAN_KEYS if key in node}
+    children = [summarize_plan(child) for child in node.get('Plans', [])]
+    if children:
+        summary['Plans'] = children
+    return summary
+
+
+def explainable(sql, many):
+    # EXPLAIN ANALYZE executes the statement: sample plain reads only, never writes or row locks.
+    statement = sql.lstrip().upper()
+    return not many and statement.startswith('SELECT') and not _UNSAFE.search(statement)
+
+
+def explain(connection, sql, params):
+    """Plan of a SELECT on a separate cursor, so the pending result set is untouched."""
+    if connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) '
+    elif connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+    # A failed EXPLAIN must not abort the caller's PostgreSQL transaction.
+    savepoint = connection.vendor == 'postgresql' and not connection.get_autocommit()
+    cursor = connection.create_cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(prefix + sql, params)
+            rows = cursor.fetchall()
+        except Exception:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            raise
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+    finally:
+        cursor.close()
+
+    if connection.vendor == 'postgresql':
+        result = rows[0][0]
+        if isinstance(result, str):
+            result = json.loads(result)
+        result = result[0]
+        return {
+            'format': 'postgresql',
+            'planning_ms': result.get('Planning Time'),
+            'execution_ms': result.get('Execution Time'),
+            'plan': summarize_plan(result['Plan']),
+        }
+    return {
+        'format': 'sqlite',
+        'plan': [{'id': row[0], 'parent': row[1], 'detail': row[3]} for row in rows],
+    }
+
+
+def seq_scans(plan):
+    """Tables read by a full sequential scan in a stored plan."""
+    if not plan:
+        return []
+    tables = []
+    if plan['format'] == 'postgresql':
+        def walk(node):
+            if node.get('Node Type') == 'Seq Scan':
+                tables.append(node.get('Relation Name'))
+            for child in node.get('Plans', []):
+                walk(child)
+        walk(plan['plan'])
+    else:
+        # SQLite reports full passes as SCAN (in index order with USING INDEX) and lookups as SEARCH.
+        for step in plan['plan']:
+            match = _SQLITE_SCAN.match(step['detail'])
+            if match:
+                tables.append(match.group(1))
+    return sorted(set(tables))
+
+
+def watched_table(name):
+    """The watched table that ``name`` is, or is a partition of; else None."""
+    watched = settings.SLOW_QUERY_WATCHED_TABLES
+    if name in watched:
+        return name
+    match = _PARTITION.match(name or '')
+    if match and match.group('table') in watched:
+        return match.group('table')
+    return None
+
+
+def append(entries):
+    data = ''.join(json.dumps(entry) + '\n' for entry in entries).encode()
+    # One O_APPEND write per entry, so lines from several processes never interleave.
+    fd = os.open(settings.SLOW_QUERY_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+class SlowQueryLogger:
+    """``execute_wrapper`` that logs statements over the threshold."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {'captured': 0, 'explained': 0, 'explain_errors': 0, 'write_errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        result = execute(sql, params, many, context)
+        elapsed = (time.perf_counter() - started) * 1000
+        if elapsed >= settings.SLOW_QUERY_THRESHOLD_MS:
+            self.capture(context['connection'], sql, params, many, elapsed)
+        return result
+
+    def capture(self, connection, sql, params, many, elapsed):
+        shape = normalize(sql)
+        entry = {
+            'at': timezone.now().isoformat(),
+            'db': connection.alias,
+            'vendor': connection.vendor,
+            'ms': round(elapsed, 3),
+            'fingerprint': fingerprint(shape),
+            'shape': shape,
+            'call_site': call_site(),
+        }
+        sample = settings.SLOW_QUERY_EXPLAIN_RATE and random.random() < settings.SLOW_QUERY_EXPLAIN_RATE
+        if sample and explainable(sql, many):
+            try:
+                entry['plan'] = explain(connection, sql, params)
+            except Exception:
+                self._count('explain_errors')
+            else:
+                entry['seq_scans'] = seq_scans(entry['plan'])
+                self._count('explained')
+        try:
+            append([entry])
+        except OSError:
+            self._count('write_errors')
+            return
+        self._count('captured')
+
+    def get_stats(self):
+        with self._lock:
+            return {'threshold_ms': settings.SLOW_QUERY_THRESHOLD_MS, **self.stats}
+
+
+slow_query_logger = SlowQueryLogger()
+
+
+def install(sender=None, connection=None, **kwargs):
+    """``connection_created`` receiver adding the logger to the connection's wrappers."""
+    if slow_query_logger not in connection.execute_wrappers:
+        # Outermost, so ``execute_wrapper()`` blocks entered later still pop their own wrapper.
+        connection.execute_wrappers.insert(0, slow_query_logger)
+
+
+def read_log(path, since=None):
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if since is None or entry['at'] >= since:
+                entries.append(entry)
+    return entries
+
+
+def filtered_columns(shape, table):
+    """Columns of ``table`` referenced in the WHERE clause of ``shape``."""
+    where = re.split(r'\bWHERE\b', shape, maxsplit=1)
+    if len(where) < 2:
+        return []
+    clause = re.split(r'\b(?:GROUP BY|ORDER BY|LIMIT)\b', where[1], maxsplit=1)[0]
+    columns = re.findall(rf'"{re.escape(table)}"\."(\w+)"', clause)
+    return list(dict.fromkeys(columns))
+
+
+def report(entries):
+    """Aggregate log entries per shape, slowest total first."""
+    shapes = {}
+    for entry in entries:
+        row = shapes.setdefault(entry['fingerprint'], {
+            'fingerprint': entry['fingerprint'],
+            'shape': entry['shape'],
+            'count': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'call_sites': Counter(),
+            'explained': 0,
+            'seq_scans': set(),
+            'plan': None,
+        })
+        row['count'] += 1
+        row['total_ms'] += entry['ms']
+        row['max_ms'] = max(row['max_ms'], entry['ms'])
+        if entry.get('call_site'):
+            row['call_sites'][entry['call_site']] += 1
+        if entry.get('plan'):
+            row['explained'] += 1
+            row['plan'] = entry['plan']
+            row['seq_scans'].update(filter(None, map(watched_table, entry.get('seq_scans', []))))
+
+    rows = sorted(shapes.values(), key=lambda row: -row['total_ms'])
+    for row in rows:
+        row['total_ms'] = round(row['total_ms'], 3)
+        row['mean_ms'] = round(row['total_ms'] / row['count'], 3)
+        row['call_sites'] = row['call_sites'].most_common(3)
+        row['seq_scans'] = [
+            {'table': table, 'filtered_on': filtered_columns(row['shape'], table)}
+            for table in sorted(row['seq_scans'])
+        ]
+    return rows
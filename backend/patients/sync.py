@@ -0,0 +1,120 @@
+"""
+Delta sync for offline clients.
+
+Clients keep the ``checkpoint`` returned by ``/api/sync/`` and send it back
+as ``since`` on the next call; the response then only holds rows whose
+``updated_at`` moved and the ids of rows deleted since then. The checkpoint
+is taken before the queries run and backed off by ``SYNC_CHECKPOINT_OVERLAP``
+seconds so rows committed by transactions that were still in flight are
+picked up next time; clients must treat rows as upserts. Rows and
+tombstones are limited to the current clinic.
+
+Rows come in pages of at most ``SYNC_PAGE_SIZE`` per model, read in
+``(updated_at, id)`` order with a keyset cursor so a full download never
+loads a whole table. While ``cursor`` is set the client asks again with
+``?cursor=`` and keeps the first page's checkpoint; deleted ids come with
+the first page.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Patient, Visit, Assessment, Tombstone
+from .changes import TRACKED_MODELS
+
+
+def record_tombstone(instance, clinic_id):
+    return Tombstone.objects.using(instance._state.db).create(
+        clinic_id=clinic_id,
+        model=TRACKED_MODELS[type(instance)],
+        object_id=instance.pk,
+    )
+
+
+def tombstone_horizon():
+    return timezone.now() - timedelta(days=settings.SYNC_TOMBSTONE_RETENTION_DAYS)
+
+
+PAGES = {'patients': Patient, 'visits': Visit, 'assessments': Assessment}
+CURSOR_SALT = 'patients.sync'
+
+
+def read_cursor(cursor):
+    """The paging state a previous page handed out; raises ValueError."""
+    try:
+        state = signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        raise ValueError('cursor is not valid')
+    state['since'] = parse_datetime(state['since']) if state['since'] else None
+    state['checkpoint'] = parse_datetime(state['checkpoint'])
+    return state
+
+
+def page_after(queryset, position, limit):
+    """Up to ``limit`` rows after ``position`` (``[updated_at, id]`` or None), plus the next position."""
+    if position is not None:
+        updated_at, pk = parse_datetime(position[0]), position[1]
+        queryset = queryset.filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, pk__gt=pk))
+    rows = list(queryset.order_by('updated_at', 'pk')[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, [rows[-1].updated_at.isoformat(), rows[-1].pk]
+
+
+def changed_since(since=None, cursor=None, limit=None):
+    """
+    Return a page of the rows and the deleted ids a client needs to catch
+    up from ``since`` (None means a full download), the checkpoint to use
+    next time, and the ``cursor`` of the next page (None on the last).
+    """
+    limit = limit or settings.SYNC_PAGE_SIZE
+    if cursor is not None:
+        state = read_cursor(cursor)
+    else:
+        checkpoint = timezone.now() - timedelta(seconds=settings.SYNC_CHECKPOINT_OVERLAP)
+        full_resync = since is None or since < tombstone_horizon()
+        state = {
+            'since': None if full_resync else since,
+            'checkpoint': checkpoint,
+            'full_resync': full_resync,
+            'after': {name: None for name in PAGES},
+        }
+
+    since = state['since']
+    deleted = {name: [] for name in TRACKED_MODELS.values()}
+    if cursor is None and since is not None:
+        for model, object_id in Tombstone.objects.filter(
+            deleted_at__gte=since
+        ).values_list('model', 'object_id'):
+            deleted.setdefault(model, []).append(object_id)
+
+    result = {'checkpoint': state['checkpoint'], 'full_resync': state['full_resync'], 'deleted': deleted}
+    after = {}
+    for name, model in PAGES.items():
+        result[name] = []
+        if name not in state['after']:
+            continue
+        queryset = model.objects.all()
+        if since is not None:
+            queryset = queryset.filter(updated_at__gte=since)
+        result[name], position = page_after(queryset, state['after'][name], limit)
+        if position is not None:
+            after[name] = position
+
+    result['cursor'] = signing.dumps({
+        'since': since.isoformat() if since else None,
+        'checkpoint': state['checkpoint'].isoformat(),
+        'full_resync': state['full_resync'],
+        'after': after,
+    }, salt=CURSOR_SALT) if after else None
+    return result
+
+
+def prune_tombstones():
+    deleted, _ = Tombstone.objects.filter(deleted_at__lt=tombstone_horizon()).delete()
+    return deleted
@@ -0,0 +1,28 @@
+"""Built-in background jobs; see patients/jobs.py."""
+import os
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import archive, export
+from .jobs import register, set_progress
+
+
+@register('export_snapshot')
+def export_snapshot_job(job, tables=None):
+    directory = os.path.join(
+        settings.SNAPSHOT_DIR,
+        timezone.now().strftime('%Y%m%dT%H%M%S') + f'-{job.pk}'
+    )
+    set_progress(job, 0, 'Writing snapshot')
+    manifest = export.write_snapshot(directory, tables=tables)
+    manifest['directory'] = directory
+    return manifest
+
+
+@register('archive_visits')
+def archive_visits_job(job, older_than=None, batch_size=1000):
+    cutoff = archive.parse_older_than(older_than) if older_than else archive.default_cutoff()
+    set_progress(job, 0, f'Archiving visits before {cutoff}')
+    count = archive.archive_visits(cutoff, batch_size=batch_size)
+    return {'archived': count, 'cutoff': cutoff.isoformat()}
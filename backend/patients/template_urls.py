@@ -8,6 +8,10 @@ urlpatterns = [
     path('logout/', template_views.logout_view, name='logout'),
 
     path('listing/', template_views.patient_listing, name='patient_listing'),
+    path('listing/rows/<int:pk>/', template_views.patient_listing_row, name='patient_listing_row'),
+    path('pending-assessments/', template_views.pending_assessments, name='pending_assessments'),
+    path('pending-assessments/rows/<int:pk>/', template_views.pending_assessment_row, name='pending_assessment_row'),
+    path('dashboard/', template_views.clinic_dashboard, name='clinic_dashboard'),
     path('register/', template_views.patient_registration, name='patient_registration'),
     path('vitals/<str:patient_id>/', template_views.vitals_form, name='vitals_form'),
     path('assessment/general/<int:visit_id>/', template_views.general_assessment, name='general_assessment'),
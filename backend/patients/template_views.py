@@ -1,9 +1,18 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect
 from django.views.decorators.http import require_http_methods
 from django.contrib import messages
+from django.conf import settings
 from datetime import date
 from decimal import Decimal
+from django.http import HttpResponse
 from .models import Patient, Visit, Assessment
+from . import listing_cache
+from .object_cache import get_patient_or_404, get_visit_or_404
+from . import duplicates
+from . import daily_stats
+from . import pending
+from . import audit
+from . import events
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth.decorators import login_required
@@ -55,7 +64,8 @@ def patient_registration(request):
         'today': date.today().isoformat(),
         'form_data': {},
         'error': None,
-        'success': None
+        'success': None,
+        'duplicates': []
     }
     
     if request.method == 'POST':
@@ -79,10 +89,23 @@ def patient_registration(request):
             context['error'] = 'All fields are required.'
             return render(request, 'patient_registration.html', context)
         
-        if Patient.objects.filter(patient_id=patient_id).exists():
+        try:
+            date_of_birth = date.fromisoformat(date_of_birth)
+        except ValueError:
+            context['error'] = 'Invalid date of birth.'
+            return render(request, 'patient_registration.html', context)
+        
+        if Patient.all_clinics.filter(patient_id=patient_id).exists():
             context['error'] = 'A patient with this Patient ID already exists. Please use a different ID.'
             return render(request, 'patient_registration.html', context)
         
+        if not request.POST.get('confirm_duplicate'):
+            candidates = duplicates.find_candidates(first_name, last_name, date_of_birth, gender)
+            if candidates:
+                context['duplicates'] = candidates
+                context['error'] = 'This patient may already be registered. Check the matches below or confirm to register anyway.'
+                return render(request, 'patient_registration.html', context)
+        
         try:
             patient = Patient.objects.create(
                 patient_id=patient_id,
@@ -92,6 +115,7 @@ def patient_registration(request):
                 date_of_birth=date_of_birth,
                 gender=gender
             )
+            audit.annotate(request, patient=patient.pk)
             return redirect('vitals_form', patient_id=patient.patient_id)
         except Exception as e:
             context['error'] = f'Error creating patient: {str(e)}'
@@ -103,7 +127,7 @@ def patient_registration(request):
 @require_http_methods(["GET", "POST"])
 def vitals_form(request, patient_id):
     """Handle vitals form submission"""
-    patient = get_object_or_404(Patient, patient_id=patient_id)
+    patient = get_patient_or_404(patient_id=patient_id)
     
     context = {
         'patient': patient,
@@ -130,6 +154,12 @@ def vitals_form(request, patient_id):
             context['error'] = 'All fields are required.'
             return render(request, 'vitals_form.html', context)
         
+        try:
+            visit_date = date.fromisoformat(visit_date)
+        except ValueError:
+            context['error'] = 'Invalid visit date.'
+            return render(request, 'vitals_form.html', context)
+        
         try:
             height_decimal = Decimal(height)
             weight_decimal = Decimal(weight)
@@ -138,6 +168,10 @@ def vitals_form(request, patient_id):
                 context['error'] = 'Height must be between 30 and 300 cm.'
                 return render(request, 'vitals_form.html', context)
             
+            if height_decimal != height_decimal.quantize(Decimal('0.1')):
+                context['error'] = 'Height can have at most one decimal place (0.1 cm).'
+                return render(request, 'vitals_form.html', context)
+            
             if weight_decimal < 1 or weight_decimal > 500:
                 context['error'] = 'Weight must be between 1 and 500 kg.'
                 return render(request, 'vitals_form.html', context)
@@ -152,6 +186,7 @@ def vitals_form(request, patient_id):
                 height=height_decimal,
                 weight=weight_decimal
             )
+            audit.annotate(request, visit=visit.pk)
             
             if visit.bmi > 25:
                 return redirect('overweight_assessment', visit_id=visit.id)
@@ -171,7 +206,7 @@ def vitals_form(request, patient_id):
 @require_http_methods(["GET", "POST"])
 def general_assessment(request, visit_id):
     """Handle general assessment form"""
-    visit = get_object_or_404(Visit, id=visit_id)
+    visit = get_visit_or_404(visit_id)
     
     context = {
         'visit': visit,
@@ -202,13 +237,14 @@ def general_assessment(request, visit_id):
             return render(request, 'general_assessment.html', context)
         
         try:
-            Assessment.objects.create(
+            assessment = Assessment.objects.create(
                 visit=visit,
                 assessment_type='general',
                 general_health=general_health,
                 using_drugs=(using_drugs == 'true'),
                 comments=comments
             )
+            audit.annotate(request, assessment=assessment.pk)
             return redirect('patient_listing')
         except Exception as e:
             context['error'] = f'Error creating assessment: {str(e)}'
@@ -220,7 +256,7 @@ def general_assessment(request, visit_id):
 @require_http_methods(["GET", "POST"])
 def overweight_assessment(request, visit_id):
     """Handle overweight assessment form"""
-    visit = get_object_or_404(Visit, id=visit_id)
+    visit = get_visit_or_404(visit_id)
     
     context = {
         'visit': visit,
@@ -251,13 +287,14 @@ def overweight_assessment(request, visit_id):
             return render(request, 'overweight_assessment.html', context)
         
         try:
-            Assessment.objects.create(
+            assessment = Assessment.objects.create(
                 visit=visit,
                 assessment_type='overweight',
                 general_health=general_health,
                 on_diet=(on_diet == 'true'),
                 comments=comments
             )
+            audit.annotate(request, assessment=assessment.pk)
             return redirect('patient_listing')
         except Exception as e:
             context['error'] = f'Error creating assessment: {str(e)}'
@@ -284,28 +321,84 @@ def patient_listing(request):
         else:
             patients = Patient.objects.all()
         
-        patient_list = []
-        for patient in patients:
-            latest_visit = patient.get_latest_visit()
-            patient_data = {
-                'id': patient.id,
-                'patient_id': patient.patient_id,
-                'first_name': patient.first_name,
-                'middle_name': patient.middle_name,
-                'last_name': patient.last_name,
-                'age': patient.age,
-                'last_bmi_status': patient.get_latest_bmi_status(),
-                'last_assessment_date': patient.get_latest_assessment_date()
-            }
-            patient_list.append(patient_data)
-        
-        context['patients'] = patient_list
+        context['patients'] = listing_cache.get_rows(patients)
+        audit.annotate(request, patient=[row['id'] for row in context['patients']])
         
     except Exception as e:
         context['error'] = f'Error loading patients: {str(e)}'
     
+    context['live_updates'] = events.streams_available(request)
     return render(request, 'patient_listing.html', context)
 
+@login_required
+@require_http_methods(["GET"])
+def patient_listing_row(request, pk):
+    """A single listing row, re-fetched by the page when a live update arrives"""
+    patient = get_patient_or_404(pk=pk)
+    row, = listing_cache.get_rows([patient])
+    return render(request, '_patient_row.html', {'patient': row})
+
+@login_required
+@require_http_methods(["GET"])
+def clinic_dashboard(request):
+    """Daily visits, BMI mix and assessment completion from the per-day counters"""
+    context = {
+        'days': [],
+        'error': None,
+        'start': None,
+        'end': None
+    }
+    
+    try:
+        start, end = daily_stats.date_range(request.GET)
+    except ValueError as e:
+        context['error'] = str(e)
+        return render(request, 'clinic_dashboard.html', context)
+    
+    days = daily_stats.dashboard(start, end)
+    visits = sum(day.visits for day in days)
+    assessed = sum(day.assessed for day in days)
+    context.update({
+        'days': days,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'total_visits': visits,
+        'total_assessed': assessed,
+        'total_underweight': sum(day.underweight for day in days),
+        'total_normal': sum(day.normal for day in days),
+        'total_overweight': sum(day.overweight for day in days),
+        'total_general': sum(day.general_assessments for day in days),
+        'total_overweight_assessments': sum(day.overweight_assessments for day in days),
+        'completion_percent': round(assessed / visits * 100, 1) if visits else None
+    })
+    return render(request, 'clinic_dashboard.html', context)
+
+@login_required
+@require_http_methods(["GET"])
+def pending_assessments(request):
+    """Visits that still need an assessment, oldest first"""
+    visits = list(pending.pending_visits()[:settings.PENDING_ASSESSMENT_LIMIT])
+    context = {
+        'visits': [pending_item(visit) for visit in visits],
+        'live_updates': events.streams_available(request)
+    }
+    return render(request, 'pending_assessments.html', context)
+
+@login_required
+@require_http_methods(["GET"])
+def pending_assessment_row(request, pk):
+    """A single work queue row; 204 once the visit no longer needs an assessment"""
+    visit = pending.pending_visits().filter(pk=pk).first()
+    if visit is None:
+        return HttpResponse(status=204)
+    return render(request, '_pending_row.html', {'item': pending_item(visit)})
+
+def pending_item(visit):
+    return {
+        'visit': visit,
+        'assessment_type': 'overweight' if visit.requires_overweight_assessment() else 'general'
+    }
+
 def logout_view(request):
     """Logout view"""
     logout(request)
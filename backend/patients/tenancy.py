@@ -0,0 +1,149 @@
+"""
+Multi-clinic tenancy.
+
+Every patient belongs to a ``Clinic``; visits and assessments belong to a
+clinic through their patient. ``ClinicMiddleware`` resolves the clinic for
+each request (``X-Clinic`` header, then the ``?clinic=`` choice remembered
+in the session, then ``DEFAULT_CLINIC``) and makes it current for the
+duration of the request. While a clinic is current:
+
+- the default managers of Patient, Visit and Assessment only return that
+  clinic's rows, so viewsets, template views and the admin are scoped
+  without per-view filters;
+- ``ClinicRouter`` sends reads and writes of the clinic data models to the
+  clinic's ``database`` alias, so a large clinic can live on its own
+  database. Clinics themselves, background jobs and the audit log stay on
+  ``default``.
+
+With no current clinic (management commands, single-clinic deployments)
+nothing is filtered and everything uses ``default``. Run commands for a
+clinic inside ``use_clinic(clinic)``.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import models
+from django.http import JsonResponse
+
+_current_clinic = ContextVar('current_clinic', default=None)
+
+SHARED_MODELS = {'clinic', 'job', 'auditevent'}
+HEADER = 'HTTP_X_CLINIC'
+SESSION_KEY = 'clinic'
+
+
+def get_current_clinic():
+    return _current_clinic.get()
+
+
+@contextmanager
+def use_clinic(clinic):
+    token = _current_clinic.set(clinic)
+    try:
+        yield clinic
+    finally:
+        _current_clinic.reset(token)
+
+
+def current_database():
+    clinic = get_current_clinic()
+    if clinic is not None and clinic.database:
+        return clinic.database
+    return 'default'
+
+
+def belongs_to_current_clinic(clinic_id):
+    clinic = get_current_clinic()
+    return clinic is None or clinic.pk == clinic_id
+
+
+class ClinicScopedManager(models.Manager):
+    """
+    Default manager that filters to the current clinic, if there is one. The
+    path to the clinic is the model's ``clinic_lookup`` attribute (a class
+    attribute rather than an argument, so Django's related managers, which
+    subclass the default manager, are scoped too).
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        clinic = get_current_clinic()
+        if clinic is not None:
+            queryset = queryset.filter(**{self.model.clinic_lookup: clinic.pk})
+        return queryset
+
+
+class ClinicRouter:
+    """Route clinic data to the current clinic's database alias."""
+
+    def _is_clinic_data(self, model):
+        return model._meta.app_label == 'patients' and model._meta.model_name not in SHARED_MODELS
+
+    def db_for_read(self, model, **hints):
+        if not self._is_clinic_data(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return current_database()
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Clinic rows live on default and are referenced without a DB constraint.
+        if 'clinic' in (obj1._meta.model_name, obj2._meta.model_name):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+_clinics = {'loaded_at': 0, 'by_code': {}}
+
+
+def clinic_for_code(code):
+    """Look up a clinic by code, from a small in-process map refreshed every CLINIC_CACHE_SECONDS."""
+    from .models import Clinic
+
+    if time.monotonic() - _clinics['loaded_at'] > settings.CLINIC_CACHE_SECONDS:
+        _clinics['by_code'] = {clinic.code: clinic for clinic in Clinic.objects.using('default')}
+        _clinics['loaded_at'] = time.monotonic()
+    return _clinics['by_code'].get(code)
+
+
+def forget_clinics():
+    _clinics['loaded_at'] = 0
+
+
+class ClinicMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def resolve(self, request):
+        """Return ``(clinic, error)`` for the request."""
+        code = request.META.get(HEADER)
+        if not code and 'clinic' in request.GET and hasattr(request, 'session'):
+            code = request.GET['clinic']
+            request.session[SESSION_KEY] = code
+        if not code and hasattr(request, 'session'):
+            code = request.session.get(SESSION_KEY)
+        code = code or settings.DEFAULT_CLINIC
+        if not code:
+            return None, None
+        clinic = clinic_for_code(code)
+        if clinic is None:
+            if hasattr(request, 'session'):
+                request.session.pop(SESSION_KEY, None)
+            return None, f"Unknown clinic: {code}"
+        return clinic, None
+
+    def __call__(self, request):
+        clinic, error = self.resolve(request)
+        if error:
+            return JsonResponse({'error': error}, status=400)
+        request.clinic = clinic
+        with use_clinic(clinic):
+            return self.get_response(request)
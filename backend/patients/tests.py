@@ -1,9 +1,16 @@
-from django.test import TestCase
+from unittest import skipIf, skipUnless
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, LiveServerTestCase
 from django.utils import timezone
 from decimal import Decimal
 from datetime import date, timedelta
 from .models import Patient, Visit, Assessment
 
+# bmi and bmi_status are generated columns there; stored drift cannot be set up.
+GENERATED_BMI = skipIf(connection.vendor == 'postgresql', 'bmi is a generated column on PostgreSQL')
+
 
 class PatientModelTest(TestCase):
     def setUp(self):
@@ -97,6 +104,64 @@ class VisitModelTest(TestCase):
                 height=Decimal('175.00'),
                 weight=Decimal('75.00')
             )
+    
+    def test_vitals_stored_as_integer_units(self):
+        visit = Visit.objects.create(
+            patient=self.patient,
+            visit_date=date.today(),
+            height=Decimal('172.35'),
+            weight=Decimal('80.25')
+        )
+        visit.refresh_from_db()
+        self.assertEqual((visit.height_mm, visit.weight_g), (1724, 80250))
+        self.assertEqual((visit.height, visit.weight), (Decimal('172.40'), Decimal('80.25')))
+        self.assertEqual((visit.bmi, visit.bmi_status), (Decimal('27.00'), 'Overweight'))
+    
+    @GENERATED_BMI
+    def test_database_recalculation_matches_save(self):
+        visit = Visit.objects.create(
+            patient=self.patient,
+            visit_date=date.today(),
+            height=Decimal('181.00'),
+            weight=Decimal('81.90')
+        )
+        expected = (visit.bmi, visit.bmi_status)
+        Visit.objects.filter(pk=visit.pk).update(bmi=None, bmi_status='', weight_g=81900)
+        self.assertEqual(Visit.objects.filter(pk=visit.pk).recalculate_bmi(), 1)
+        visit.refresh_from_db()
+        self.assertEqual((visit.bmi, visit.bmi_status), expected)
+    
+    def test_api_keeps_decimals_and_filters_by_status(self):
+        from rest_framework.test import APIClient
+        Visit.objects.create(
+            patient=self.patient,
+            visit_date=date(2024, 1, 1),
+            height=Decimal('170.00'),
+            weight=Decimal('50.00')
+        )
+        client = APIClient()
+        response = client.post('/api/visits/', {
+            'patient': self.patient.pk,
+            'visit_date': '2024-01-02',
+            'height': '165.50',
+            'weight': '90.10'
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            (response.data['height'], response.data['weight'], response.data['bmi_status']),
+            ('165.50', '90.10', 'Overweight')
+        )
+        response = client.post('/api/visits/', {
+            'patient': self.patient.pk,
+            'visit_date': '2024-01-03',
+            'height': '170.25',
+            'weight': '90.10'
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('height', response.data)
+        response = client.get('/api/visits/', {'bmi_status': 'Underweight'})
+        self.assertEqual([v['visit_date'] for v in response.data['results']], ['2024-01-01'])
+        self.assertEqual(client.get('/api/visits/', {'bmi_status': 'Obese'}).status_code, 400)
 
 
 class AssessmentModelTest(TestCase):
@@ -153,3 +218,1933 @@ class AssessmentModelTest(TestCase):
                 on_diet=False,
                 comments='Second assessment'
             )
+
+
+class VisitPartitioningTest(TestCase):
+    def test_monthly_partition_ranges(self):
+        from .partitioning import partition_ranges, partition_name
+        ranges = list(partition_ranges(date(2024, 11, 15), date(2025, 1, 3), 'month'))
+        self.assertEqual(ranges, [
+            (date(2024, 11, 1), date(2024, 12, 1)),
+            (date(2024, 12, 1), date(2025, 1, 1)),
+            (date(2025, 1, 1), date(2025, 2, 1)),
+        ])
+        self.assertEqual(partition_name(ranges[0][0], 'month'), 'patients_visit_y2024m11')
+    
+    def test_yearly_partition_ranges(self):
+        from .partitioning import partition_ranges
+        ranges = list(partition_ranges(date(2023, 6, 1), date(2024, 2, 1), 'year'))
+        self.assertEqual(ranges, [
+            (date(2023, 1, 1), date(2024, 1, 1)),
+            (date(2024, 1, 1), date(2025, 1, 1)),
+        ])
+    
+    def test_interval_is_read_from_partition_names(self):
+        from .partitioning import partitioned_interval
+        self.assertEqual(partitioned_interval({'patients_visit_default', 'patients_visit_y2024'}), 'year')
+        self.assertEqual(partitioned_interval({'patients_visit_default', 'patients_visit_y2024m03'}), 'month')
+        self.assertIsNone(partitioned_interval({'patients_visit_default'}))
+    
+    def test_command_requires_postgresql(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        if connection.vendor == 'postgresql':
+            self.skipTest('PostgreSQL backend supports partitioning')
+        with self.assertRaises(CommandError):
+            call_command('partition_visits')
+    
+    @skipIf(connection.vendor != 'postgresql', 'Visit partitioning requires PostgreSQL')
+    def test_conversion_keeps_partial_indexes_and_new_partitions_adopt_default_rows(self):
+        from .partitioning import convert_visit_table, ensure_partitions
+        patient = Patient.objects.create(
+            patient_id='PART001', first_name='Ida', last_name='Roy', date_of_birth=date(1980, 1, 1), gender='F'
+        )
+        convert_visit_table(interval='year', ahead=1)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'visit_pending_assessment_idx'")
+            self.assertIn('WHERE', cursor.fetchone()[0])
+        
+        later = date(date.today().year + 5, 6, 1)
+        visit = Visit.objects.create(patient=patient, visit_date=later, height=Decimal('160.0'), weight=Decimal('60.0'))
+        # Later runs keep the converted table's interval, whatever VISIT_PARTITION_INTERVAL says.
+        with self.settings(VISIT_PARTITION_INTERVAL='month'):
+            self.assertIn(f'patients_visit_y{later.year}', ensure_partitions(ahead=0, today=later))
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tableoid::regclass::text FROM patients_visit WHERE id = %s", [visit.pk])
+            self.assertEqual(cursor.fetchone()[0], f'patients_visit_y{later.year}')
+
+
+class VisitArchiveTest(TestCase):
+    def setUp(self):
+        self.patient = Patient.objects.create(
+            patient_id='TEST004',
+            first_name='Ann',
+            last_name='Lee',
+            date_of_birth=date(1970, 2, 2),
+            gender='F'
+        )
+        self.old_visit = Visit.objects.create(
+            patient=self.patient,
+            visit_date=date(2015, 6, 1),
+            height=Decimal('160.00'),
+            weight=Decimal('80.00')
+        )
+        Assessment.objects.create(
+            visit=self.old_visit,
+            assessment_type='overweight',
+            general_health='Good',
+            on_diet=True,
+            comments='Old assessment'
+        )
+        self.recent_visit = Visit.objects.create(
+            patient=self.patient,
+            visit_date=date.today(),
+            height=Decimal('160.00'),
+            weight=Decimal('60.00')
+        )
+    
+    def test_archive_moves_old_visits(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from .models import ArchivedVisit
+        call_command('archive_visits', '--older-than', '2020-01-01', stdout=StringIO())
+        self.assertFalse(Visit.objects.filter(id=self.old_visit.id).exists())
+        self.assertEqual(Assessment.objects.count(), 0)
+        archived = ArchivedVisit.objects.get(original_id=self.old_visit.id)
+        self.assertEqual(archived.assessment_type, 'overweight')
+        summary = self.patient.archive_summary
+        self.assertEqual(summary.visit_count, 1)
+        self.assertEqual(summary.assessment_count, 1)
+        self.assertEqual(summary.last_visit_date, date(2015, 6, 1))
+    
+    def test_visits_endpoint_reads_through_for_old_dates(self):
+        from rest_framework.test import APIClient
+        from .archive import archive_visits
+        archive_visits(date(2020, 1, 1))
+        client = APIClient()
+        
+        response = client.get('/api/visits/')
+        self.assertEqual([v['id'] for v in response.data['results']], [self.recent_visit.id])
+        
+        response = client.get('/api/visits/', {'visit_date_from': '2010-01-01'})
+        self.assertEqual(
+            [v['id'] for v in response.data['results']],
+            [self.recent_visit.id, self.old_visit.id]
+        )
+        
+        response = client.get(f'/api/patients/{self.patient.id}/', {'include_archived': 'true'})
+        self.assertEqual(len(response.data['visits']), 2)
+        self.assertEqual(response.data['archive_summary']['visit_count'], 1)
+        
+        response = client.get(f'/api/patients/{self.patient.id}/visits/', {'include_archived': 'true'})
+        self.assertEqual(
+            [(v['id'], v.get('archived', False)) for v in response.data['results']],
+            [(self.recent_visit.id, False), (self.old_visit.id, True)]
+        )
+    
+    def test_archiving_is_not_published_as_deletion(self):
+        from .archive import archive_visits
+        from .models import ChangeEvent, Tombstone
+        ChangeEvent.objects.all().delete()
+        archive_visits(date(2020, 1, 1))
+        self.assertFalse(ChangeEvent.objects.exists())
+        self.assertFalse(Tombstone.objects.exists())
+    
+    def test_read_through_applies_every_visit_filter_and_ordering(self):
+        from rest_framework.test import APIClient
+        from .archive import archive_visits
+        archive_visits(date(2020, 1, 1))
+        client = APIClient()
+        
+        def ids(**params):
+            response = client.get('/api/visits/', {'visit_date_from': '2010-01-01', **params})
+            return [v['id'] for v in response.data['results']]
+        
+        self.assertEqual(ids(bmi_status='Overweight'), [self.old_visit.id])
+        self.assertEqual(ids(bmi_status='Normal'), [self.recent_visit.id])
+        self.assertEqual(ids(updated_since='2999-01-01T00:00:00Z'), [])
+        self.assertEqual(ids(ordering='-bmi'), [self.old_visit.id, self.recent_visit.id])
+        self.assertEqual(ids(ordering='bmi'), [self.recent_visit.id, self.old_visit.id])
+    
+    def test_merged_pages_read_only_offset_plus_limit_rows(self):
+        from django.test.utils import CaptureQueriesContext
+        from .archive import MergedVisits, archive_visits
+        from .models import ArchivedVisit
+        archive_visits(date(2020, 1, 1))
+        rows = MergedVisits(Visit.objects.all(), ArchivedVisit.objects.all())
+        
+        self.assertEqual(rows.count(), 2)
+        with CaptureQueriesContext(connection) as queries:
+            page = rows[1:2]
+        self.assertEqual([type(row) for row in page], [ArchivedVisit])
+        self.assertTrue(all('LIMIT 2' in query['sql'] for query in queries.captured_queries))
+
+
+class SnapshotExportTest(TestCase):
+    def setUp(self):
+        patient = Patient.objects.create(
+            patient_id='TEST005',
+            first_name='Sam',
+            last_name='Kim',
+            date_of_birth=date(1992, 7, 4),
+            gender='M'
+        )
+        visit = Visit.objects.create(
+            patient=patient,
+            visit_date=date(2024, 3, 1),
+            height=Decimal('180.00'),
+            weight=Decimal('70.00')
+        )
+        Assessment.objects.create(
+            visit=visit,
+            assessment_type='general',
+            general_health='Good',
+            using_drugs=False,
+            comments='Fine'
+        )
+    
+    def test_snapshot_is_typed_and_dictionary_encoded(self):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        import os
+        import tempfile
+        from .export import write_snapshot
+        
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = write_snapshot(directory, row_group_size=1)
+            self.assertEqual(manifest['tables']['visits']['rows'], 1)
+            patients = pq.read_table(os.path.join(directory, 'patients.parquet'))
+            visits = pq.read_table(os.path.join(directory, 'visits.parquet'))
+            assessments = pq.read_table(os.path.join(directory, 'assessments.parquet'))
+        
+        self.assertTrue(pa.types.is_dictionary(patients.schema.field('gender').type))
+        self.assertTrue(pa.types.is_dictionary(assessments.schema.field('assessment_type').type))
+        self.assertEqual(visits.schema.field('visit_date').type, pa.date32())
+        self.assertEqual(visits.schema.field('bmi').type, pa.decimal128(5, 2))
+        self.assertEqual(visits.column('bmi').to_pylist(), [Decimal('21.60')])
+
+
+class ChangeOutboxTest(TestCase):
+    def test_writes_append_events(self):
+        from .models import ChangeEvent
+        patient = Patient.objects.create(
+            patient_id='TEST006',
+            first_name='Eve',
+            last_name='Park',
+            date_of_birth=date(1988, 9, 9),
+            gender='F'
+        )
+        visit = Visit.objects.create(
+            patient=patient,
+            visit_date=date(2024, 1, 1),
+            height=Decimal('165.00'),
+            weight=Decimal('60.00')
+        )
+        patient_pk, visit_pk = patient.pk, visit.pk
+        patient.first_name = 'Eva'
+        patient.save()
+        patient.delete()
+        
+        events = list(ChangeEvent.objects.values_list('model', 'object_id', 'action'))
+        self.assertEqual(events, [
+            ('patient', patient_pk, 'create'),
+            ('visit', visit_pk, 'create'),
+            ('patient', patient_pk, 'update'),
+            ('visit', visit_pk, 'delete'),
+            ('patient', patient_pk, 'delete'),
+        ])
+    
+    def test_change_feed_and_compaction(self):
+        from rest_framework.test import APIClient
+        from .changes import compact_changes, latest_seq
+        patient = Patient.objects.create(
+            patient_id='TEST007',
+            first_name='Max',
+            last_name='Ray',
+            date_of_birth=date(1975, 4, 4),
+            gender='M'
+        )
+        first_seq = latest_seq()
+        patient.save()
+        patient.save()
+        
+        # Too recent to be safe from lower seqs committing later: held back.
+        response = APIClient().get('/api/changes/', {'after': first_seq})
+        self.assertEqual((response.data['events'], response.data['last_seq']), ([], first_seq))
+        
+        with self.settings(CHANGE_FEED_SAFETY_LAG=0):
+            response = APIClient().get('/api/changes/', {'after': first_seq})
+            self.assertEqual([e['action'] for e in response.data['events']], ['update', 'update'])
+            self.assertEqual(response.data['last_seq'], latest_seq())
+            
+            self.assertEqual(compact_changes(latest_seq()), 2)
+            response = APIClient().get('/api/changes/')
+            self.assertEqual(len(response.data['events']), 1)
+
+
+class DeltaSyncTest(TestCase):
+    def setUp(self):
+        self.patient = Patient.objects.create(
+            patient_id='TEST008',
+            first_name='Kai',
+            last_name='Ng',
+            date_of_birth=date(2000, 1, 1),
+            gender='O'
+        )
+        self.visit = Visit.objects.create(
+            patient=self.patient,
+            visit_date=date(2024, 5, 5),
+            height=Decimal('170.00'),
+            weight=Decimal('60.00')
+        )
+    
+    def test_sync_returns_only_changes_and_deletions(self):
+        from rest_framework.test import APIClient
+        client = APIClient()
+        
+        response = client.get('/api/sync/')
+        self.assertTrue(response.data['full_resync'])
+        self.assertEqual(len(response.data['patients']), 1)
+        
+        since = timezone.now()
+        Patient.objects.filter(pk=self.patient.pk).update(updated_at=since - timedelta(days=1))
+        visit_pk = self.visit.pk
+        self.visit.delete()
+        
+        response = client.get('/api/sync/', {'since': since.isoformat()})
+        self.assertFalse(response.data['full_resync'])
+        self.assertEqual(response.data['patients'], [])
+        self.assertEqual(response.data['deleted']['visit'], [visit_pk])
+    
+    def test_sync_pages_with_a_keyset_cursor(self):
+        from rest_framework.test import APIClient
+        client = APIClient()
+        stamp = timezone.now() - timedelta(hours=1)
+        for n in range(4):
+            Patient.objects.create(
+                patient_id=f'PAGE{n}', first_name='Page', last_name=f'Row{n}',
+                date_of_birth=date(1990, 1, 1), gender='F'
+            )
+        # Ties on updated_at are broken by id, so no row is skipped or repeated.
+        Patient.objects.update(updated_at=stamp)
+        
+        seen, pages = [], 0
+        with self.settings(SYNC_PAGE_SIZE=2):
+            response = client.get('/api/sync/')
+            checkpoint = response.data['checkpoint']
+            while True:
+                pages += 1
+                seen.extend(row['id'] for row in response.data['patients'])
+                self.assertEqual(response.data['checkpoint'], checkpoint)
+                if response.data['cursor'] is None:
+                    break
+                response = client.get('/api/sync/', {'cursor': response.data['cursor']})
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, sorted(Patient.objects.values_list('pk', flat=True)))
+        self.assertEqual(response.data['visits'], [])
+        self.assertEqual(client.get('/api/sync/', {'cursor': 'forged'}).status_code, 400)
+    
+    def test_feeds_only_show_the_current_clinic(self):
+        from rest_framework.test import APIClient
+        from .models import Clinic
+        north = Clinic.objects.create(code='north', name='North')
+        south = Clinic.objects.create(code='south', name='South')
+        since = timezone.now()
+        north_patient = Patient.objects.create(
+            patient_id='NORTH1', first_name='Ana', last_name='Lee',
+            date_of_birth=date(1990, 1, 1), gender='F', clinic=north
+        )
+        south_patient = Patient.objects.create(
+            patient_id='SOUTH1', first_name='Ben', last_name='Lee',
+            date_of_birth=date(1990, 1, 1), gender='M', clinic=south
+        )
+        north_pk, south_pk = north_patient.pk, south_patient.pk
+        north_patient.delete()
+        south_patient.delete()
+        
+        client = APIClient(HTTP_X_CLINIC='north')
+        with self.settings(CHANGE_FEED_SAFETY_LAG=0):
+            response = client.get('/api/changes/')
+        self.assertEqual({e['object_id'] for e in response.data['events']}, {north_pk})
+        response = client.get('/api/sync/', {'since': since.isoformat()})
+        self.assertEqual(response.data['deleted']['patient'], [north_pk])
+        response = APIClient().get('/api/sync/', {'since': since.isoformat()})
+        self.assertEqual(sorted(response.data['deleted']['patient']), [north_pk, south_pk])
+    
+    def test_updated_since_filter(self):
+        from rest_framework.test import APIClient
+        future = (timezone.now() + timedelta(days=1)).isoformat()
+        response = APIClient().get('/api/patients/', {'updated_since': future})
+        self.assertEqual(response.data['count'], 0)
+        response = APIClient().get('/api/visits/', {'updated_since': '2000-01-01T00:00:00Z'})
+        self.assertEqual(response.data['count'], 1)
+
+
+class ListingRowCacheTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from .listing_cache import get_cache
+        get_cache().clear()
+        self.user = User.objects.create_user('nurse', password='pw-12345')
+        self.client.force_login(self.user)
+        self.patient = Patient.objects.create(
+            patient_id='TEST009',
+            first_name='Lia',
+            last_name='Cho',
+            date_of_birth=date(1990, 1, 1),
+            gender='F'
+        )
+    
+    def test_rows_are_cached_and_invalidated_by_visits(self):
+        from .listing_cache import get_cache, row_key
+        self.client.get('/patients/listing/')
+        self.assertIsNone(get_cache().get(row_key(self.patient.pk))['last_bmi_status'])
+        
+        with self.captureOnCommitCallbacks() as callbacks:
+            Visit.objects.create(
+                patient=self.patient,
+                visit_date=date.today(),
+                height=Decimal('160.00'),
+                weight=Decimal('90.00')
+            )
+        # Not before commit: a concurrent read could re-cache the old row.
+        self.assertIsNotNone(get_cache().get(row_key(self.patient.pk)))
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(get_cache().get(row_key(self.patient.pk)))
+        
+        response = self.client.get('/patients/listing/')
+        self.assertEqual(response.context['patients'][0]['last_bmi_status'], 'Overweight')
+        
+        with self.assertNumQueries(3):
+            self.client.get('/patients/listing/')
+    
+    def test_next_age_change(self):
+        from .listing_cache import next_age_change
+        self.assertEqual(next_age_change(date(1990, 6, 15), date(2025, 6, 14)), date(2025, 6, 15))
+        self.assertEqual(next_age_change(date(1990, 6, 15), date(2025, 6, 15)), date(2026, 6, 15))
+        self.assertEqual(next_age_change(date(2000, 2, 29), date(2025, 2, 1)), date(2025, 3, 1))
+
+
+class ObjectCacheTest(TestCase):
+    def setUp(self):
+        from .object_cache import object_cache
+        object_cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patient = Patient.objects.create(
+                patient_id='TEST010',
+                first_name='Noa',
+                last_name='Bell',
+                date_of_birth=date(1983, 3, 3),
+                gender='F'
+            )
+    
+    def test_lookups_hit_cache_after_write_through(self):
+        from .object_cache import get_patient, object_cache
+        with self.assertNumQueries(0):
+            self.assertEqual(get_patient(patient_id='TEST010').pk, self.patient.pk)
+            self.assertEqual(get_patient(pk=self.patient.pk).first_name, 'Noa')
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patient.first_name = 'Nora'
+            self.patient.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_patient(pk=self.patient.pk).first_name, 'Nora')
+        self.assertEqual(object_cache.get_stats()['hits'], 3)
+    
+    def test_writes_in_other_processes_drop_local_copies(self):
+        from .events import broadcaster
+        from .object_cache import get_patient, object_cache
+        with self.settings(EVENTS_BACKEND='postgres'):
+            get_patient(pk=self.patient.pk)
+            self.addCleanup(object_cache._listening.update, pid=None, subscription=None)
+            self.addCleanup(broadcaster.unsubscribe, object_cache._listening['subscription'])
+            # Another worker renames the patient; the listener relays its notification.
+            Patient.objects.filter(pk=self.patient.pk).update(first_name='Nell')
+            broadcaster.publish({'model': 'patient', 'id': self.patient.pk, 'clinic': None})
+            with self.assertNumQueries(1):
+                self.assertEqual(get_patient(pk=self.patient.pk).first_name, 'Nell')
+        self.assertEqual(object_cache.get_stats()['remote_evictions'], 1)
+    
+    def test_missing_ids_are_negatively_cached(self):
+        from .object_cache import get_patient
+        with self.assertRaises(Patient.DoesNotExist):
+            get_patient(patient_id='NOPE')
+        with self.assertNumQueries(0):
+            with self.assertRaises(Patient.DoesNotExist):
+                get_patient(patient_id='NOPE')
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.create(
+                patient_id='NOPE',
+                first_name='Late',
+                last_name='Comer',
+                date_of_birth=date(1999, 9, 9),
+                gender='M'
+            )
+        self.assertEqual(get_patient(patient_id='NOPE').first_name, 'Late')
+    
+    def test_registration_caches_parsed_dates(self):
+        from django.contrib.auth.models import User
+        from .object_cache import get_patient
+        self.client.force_login(User.objects.create_user('clerk', password='pw'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/patients/register/', {
+                'patient_id': 'TEST011',
+                'first_name': 'Raw',
+                'last_name': 'Form',
+                'date_of_birth': '1990-05-05',
+                'gender': 'M'
+            })
+        with self.assertNumQueries(0):
+            self.assertEqual(get_patient(patient_id='TEST011').date_of_birth, date(1990, 5, 5))
+    
+    def test_returned_instances_are_private_copies(self):
+        from .object_cache import get_patient
+        get_patient(pk=self.patient.pk).first_name = 'Changed'
+        self.assertEqual(get_patient(pk=self.patient.pk).first_name, 'Noa')
+
+
+class AdmissionControlTest(TestCase):
+    def test_sheds_when_class_is_full(self):
+        from .middleware import AdmissionController
+        controller = AdmissionController(
+            limits={'write': 1, 'report': 1},
+            timeouts={'write': 0.05, 'report': 0.01},
+            max_queue={'write': 5, 'report': 0}
+        )
+        self.assertTrue(controller.acquire('report'))
+        self.assertFalse(controller.acquire('report'))
+        self.assertTrue(controller.acquire('write'))
+        self.assertFalse(controller.acquire('write'))
+        controller.release('report')
+        self.assertTrue(controller.acquire('report'))
+        stats = controller.get_stats()
+        self.assertEqual(stats['report']['shed'], 1)
+        self.assertEqual(stats['write']['in_flight'], 1)
+    
+    def test_shipped_limits_bind_below_the_worker_threads(self):
+        import os
+        import runpy
+        from unittest import mock
+        from django.conf import settings
+        threads = runpy.run_path(str(settings.BASE_DIR / 'gunicorn.conf.py'))['threads']
+        self.assertEqual(settings.ADMISSION_CONTROL_THREADS, threads)
+        for count in (4, 8, 16, 32):
+            with mock.patch.dict(os.environ, {'GUNICORN_THREADS': str(count)}):
+                shipped = runpy.run_path(str(settings.BASE_DIR / 'patient_management' / 'settings.py'))
+            limits, queues = shipped['ADMISSION_CONTROL_LIMITS'], shipped['ADMISSION_CONTROL_MAX_QUEUE']
+            reads = sum(limits[name] + queues[name] for name in ('interactive', 'report', 'poll'))
+            self.assertLessEqual(reads, count - shipped['ADMISSION_CONTROL_WRITE_RESERVE'], count)
+            self.assertEqual(queues['poll'], 0)
+    
+    def test_classifies_long_polls_and_row_refetches(self):
+        from django.test import RequestFactory
+        from .middleware import AdmissionControlMiddleware
+        middleware = AdmissionControlMiddleware(lambda request: None)
+        factory = RequestFactory()
+        self.assertEqual(middleware.classify(factory.get('/api/changes/')), 'poll')
+        self.assertEqual(middleware.classify(factory.get('/patients/listing/')), 'report')
+        self.assertEqual(middleware.classify(factory.get('/patients/listing/rows/1/')), 'interactive')
+    
+    def test_middleware_returns_503_with_retry_after(self):
+        from unittest import mock
+        from .middleware import admission_controller
+        full = admission_controller.limits['report']
+        with mock.patch.dict(admission_controller.in_flight, {'report': full}), \
+                mock.patch.dict(admission_controller.max_queue, {'report': 0}):
+            response = self.client.get('/api/visits/')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+
+
+class AdminScaleTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw-12345')
+        self.client.force_login(self.admin)
+        for index in range(5):
+            patient = Patient.objects.create(
+                patient_id=f'ADM{index}',
+                first_name='Row',
+                last_name=f'Patient{index}',
+                date_of_birth=date(1980, 1, 1),
+                gender='M'
+            )
+            visit = Visit.objects.create(
+                patient=patient,
+                visit_date=date(2024, 1, 1),
+                height=Decimal('170.00'),
+                weight=Decimal('60.00')
+            )
+            Assessment.objects.create(
+                visit=visit,
+                assessment_type='general',
+                general_health='Good',
+                using_drugs=False,
+                comments='ok'
+            )
+    
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        with self.assertNumQueries(4):
+            response = self.client.get('/admin/patients/visit/')
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(4):
+            response = self.client.get('/admin/patients/assessment/')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_prefix_search(self):
+        response = self.client.get('/admin/patients/patient/', {'q': 'adm3'})
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+
+class DuplicateDetectionTest(TestCase):
+    def setUp(self):
+        self.patient = Patient.objects.create(
+            patient_id='DUP001',
+            first_name='Catherine',
+            last_name='Johnson',
+            date_of_birth=date(1979, 8, 12),
+            gender='F'
+        )
+    
+    def test_soundex(self):
+        from .duplicates import soundex
+        self.assertEqual(soundex('Robert'), 'R163')
+        self.assertEqual(soundex('Rupert'), 'R163')
+        self.assertEqual(soundex('Ashcraft'), 'A261')
+    
+    def test_finds_spelling_variant_with_same_birth_date(self):
+        from .duplicates import find_candidates
+        candidates = find_candidates('Katherine', 'Jonson', date(1979, 8, 12), 'F')
+        self.assertEqual([c['patient_id'] for c in candidates], ['DUP001'])
+        self.assertEqual(find_candidates('Catherine', 'Johnson', date(1990, 1, 1), 'F'), [])
+    
+    def test_api_requires_confirmation_for_likely_duplicates(self):
+        from rest_framework.test import APIClient
+        data = {
+            'patient_id': 'DUP002',
+            'first_name': 'Catherine',
+            'last_name': 'Johnston',
+            'date_of_birth': '1979-08-12',
+            'gender': 'F'
+        }
+        response = APIClient().post('/api/patients/', data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('possible_duplicates', response.data)
+        
+        data['confirm_duplicate'] = True
+        response = APIClient().post('/api/patients/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+    
+    def test_audit_command_reports_pairs(self):
+        from io import StringIO
+        from django.core.management import call_command
+        Patient.objects.create(
+            patient_id='DUP003',
+            first_name='Catherine',
+            last_name='Jonhson',
+            date_of_birth=date(1979, 8, 12),
+            gender='F'
+        )
+        output = StringIO()
+        call_command('audit_duplicates', '--workers', '1', stdout=output, stderr=StringIO())
+        self.assertIn('DUP001,DUP003', output.getvalue())
+
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        from . import jobs
+        self.calls = []
+        
+        @jobs.register('test_echo')
+        def echo(job, value):
+            jobs.set_progress(job, 50, 'halfway')
+            self.calls.append(value)
+            return {'value': value}
+        
+        @jobs.register('test_fail')
+        def fail(job):
+            raise RuntimeError('boom')
+    
+    def tearDown(self):
+        from . import jobs
+        jobs.registry.pop('test_echo', None)
+        jobs.registry.pop('test_fail', None)
+    
+    def test_worker_runs_queued_jobs_by_priority(self):
+        from . import jobs
+        low = jobs.enqueue('test_echo', {'value': 'low'})
+        high = jobs.enqueue('test_echo', {'value': 'high'}, priority=5)
+        jobs.enqueue('test_echo', {'value': 'later'}, delay=3600)
+        
+        self.assertEqual(jobs.work(once=True), 2)
+        self.assertEqual(self.calls, ['high', 'low'])
+        low.refresh_from_db()
+        high.refresh_from_db()
+        self.assertEqual(low.status, 'succeeded')
+        self.assertEqual(low.progress, 100)
+        self.assertEqual(low.result, {'value': 'low'})
+        self.assertEqual(high.attempts, 1)
+    
+    def test_claim_is_exclusive(self):
+        from . import jobs
+        jobs.enqueue('test_echo', {'value': 'x'})
+        self.assertIsNotNone(jobs.claim('worker-a'))
+        self.assertIsNone(jobs.claim('worker-b'))
+    
+    def test_failed_job_is_retried_then_marked_failed(self):
+        from . import jobs
+        job = jobs.enqueue('test_fail', max_attempts=2)
+        
+        jobs.work(once=True)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'queued')
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn('boom', job.error)
+        
+        job.run_after = timezone.now()
+        job.save()
+        jobs.work(once=True)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNotNone(job.finished_at)
+    
+    def test_stale_running_job_is_requeued(self):
+        from . import jobs
+        from .models import Job
+        job = jobs.enqueue('test_echo', {'value': 'x'})
+        jobs.claim('dead-worker')
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(jobs.requeue_stale(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'queued')
+    
+    def test_stale_job_out_of_attempts_fails(self):
+        from . import jobs
+        from .models import Job
+        job = jobs.enqueue('test_echo', {'value': 'x'}, max_attempts=1)
+        jobs.claim('dead-worker')
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(jobs.requeue_stale(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIsNotNone(job.finished_at)
+    
+    def test_progress_refreshes_the_lock(self):
+        from . import jobs
+        from .models import Job
+        job = jobs.enqueue('test_echo', {'value': 'x'})
+        job = jobs.claim('worker-a')
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(days=1))
+        jobs.set_progress(job, 10)
+        self.assertEqual(jobs.requeue_stale(), 0)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, 'running')
+    
+    def test_status_api(self):
+        from django.contrib.auth.models import User
+        from rest_framework.test import APIClient
+        from . import jobs
+        job = jobs.enqueue('test_echo', {'value': 'x'})
+        client = APIClient()
+        self.assertEqual(client.get(f'/api/jobs/{job.pk}/').status_code, 403)
+        
+        client.force_authenticate(User.objects.create_superuser('admin', 'a@example.com', 'pw'))
+        response = client.get(f'/api/jobs/{job.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'queued')
+        response = client.get('/api/jobs/', {'status': 'queued'})
+        self.assertEqual(response.data['count'], 1)
+
+
+class LoadTestHarnessTest(LiveServerTestCase):
+    def test_percentile(self):
+        from .loadtest import percentile
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertIsNone(percentile([], 95))
+    
+    def test_workflow_runs_against_live_server(self):
+        from django.contrib.auth.models import User
+        from .loadtest import Session, StepStats
+        User.objects.create_user('clinician', password='secret-pass-1')
+        stats = StepStats()
+        session = Session(self.live_server_url, stats)
+        session.login('clinician', 'secret-pass-1')
+        session.workflow()
+        
+        steps = {row['step']: row for row in stats.summary()}
+        self.assertTrue(all(row['errors'] == 0 for row in steps.values()))
+        self.assertIn('vitals', steps)
+        self.assertIn('listing', steps)
+        self.assertEqual(Assessment.objects.count(), 1)
+
+
+class RequestProfilingTest(TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.patient = Patient.objects.create(
+            patient_id='PROF001',
+            first_name='Lena',
+            last_name='Ortiz',
+            date_of_birth=date(1985, 2, 3),
+            gender='F'
+        )
+    
+    def test_signed_header_captures_profile_and_sql(self):
+        import json
+        import os
+        from django.contrib.auth.models import User
+        from .profiling import make_token, list_profiles
+        with self.settings(PROFILING_ENABLED=True, PROFILING_DIR=self.directory.name):
+            response = self.client.get('/api/patients/')
+            self.assertNotIn('X-Profile-Id', response)
+            response = self.client.get('/api/patients/', HTTP_X_PROFILE='forged:token')
+            self.assertNotIn('X-Profile-Id', response)
+            
+            response = self.client.get(f'/api/patients/{self.patient.pk}/?fields=Ortiz', HTTP_X_PROFILE=make_token())
+            profile_id = response['X-Profile-Id']
+            self.assertTrue(os.path.exists(os.path.join(self.directory.name, f'{profile_id}.prof')))
+            [meta] = list_profiles()
+            self.assertEqual(meta['route'], 'api/patients/(?P<pk>[^/.]+)/$')
+            self.assertNotIn('Ortiz', json.dumps({key: value for key, value in meta.items() if key != 'queries'}))
+            self.assertTrue(any('patients_patient' in q['sql'] for q in meta['queries']))
+            
+            self.client.force_login(User.objects.create_superuser('admin', 'a@example.com', 'pw'))
+            self.assertContains(self.client.get('/admin/profiles/'), profile_id)
+            response = self.client.get(f'/admin/profiles/{profile_id}/')
+            self.assertContains(response, 'flame-frame')
+            self.assertContains(response, 'patients_patient')
+            self.assertEqual(self.client.get('/admin/profiles/..%2Fsecret/').status_code, 404)
+    
+    def test_busy_profiler_serves_request_unprofiled(self):
+        import cProfile
+        from unittest import mock
+        from .profiling import make_token
+        busy = mock.patch.object(cProfile.Profile, 'enable', side_effect=ValueError('Another profiling tool is already active'))
+        with self.settings(PROFILING_ENABLED=True, PROFILING_DIR=self.directory.name), busy:
+            response = self.client.get('/api/patients/', HTTP_X_PROFILE=make_token())
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response)
+    
+    def test_disabled_middleware_is_not_loaded(self):
+        from .profiling import make_token
+        with self.settings(PROFILING_ENABLED=False, PROFILING_DIR=self.directory.name):
+            response = self.client.get('/api/patients/', HTTP_X_PROFILE=make_token())
+        self.assertNotIn('X-Profile-Id', response)
+
+
+class WarmUpTest(TestCase):
+    def setUp(self):
+        from .object_cache import object_cache
+        object_cache.clear()
+        self.patient = Patient.objects.create(
+            patient_id='WARM001',
+            first_name='Omar',
+            last_name='Haddad',
+            date_of_birth=date(1970, 6, 1),
+            gender='M'
+        )
+    
+    def test_phases_are_timed_and_caches_primed(self):
+        from .object_cache import object_cache
+        from .warmup import warm_up
+        with self.assertLogs('patients.warmup', 'INFO') as logs:
+            timings = warm_up(close_connections=False)
+        
+        phases = {name: count for name, ms, count in timings}
+        self.assertEqual(list(phases), ['imports', 'urls', 'templates', 'caches'])
+        self.assertGreaterEqual(phases['templates'], 8)
+        self.assertEqual(phases['caches'], 1)
+        self.assertIn('templates=', logs.output[0])
+        
+        object_cache.clear()
+        warm_up(close_connections=False)
+        with self.assertNumQueries(0):
+            object_cache.get(Patient, self.patient.pk)
+
+
+class DailyClinicStatsTest(TestCase):
+    def setUp(self):
+        self.patient = Patient.objects.create(
+            patient_id='DASH001',
+            first_name='Nia',
+            last_name='Banda',
+            date_of_birth=date(1988, 9, 9),
+            gender='F'
+        )
+        self.day = date(2024, 5, 6)
+    
+    def stats(self, day=None):
+        from .models import DailyClinicStats
+        return DailyClinicStats.objects.get(date=day or self.day)
+    
+    def test_counters_follow_visit_and_assessment_writes(self):
+        visit = Visit.objects.create(
+            patient=self.patient,
+            visit_date=self.day,
+            height=Decimal('160.00'),
+            weight=Decimal('80.00')
+        )
+        stats = self.stats()
+        self.assertEqual((stats.visits, stats.overweight, stats.assessed), (1, 1, 0))
+        
+        assessment = Assessment.objects.create(
+            visit=visit,
+            assessment_type='overweight',
+            general_health='Good',
+            on_diet=True,
+            comments='Diet plan'
+        )
+        self.assertEqual(self.stats().overweight_assessments, 1)
+        self.assertEqual(self.stats().completion_rate, 1.0)
+        
+        visit.weight = Decimal('55.00')
+        visit.save()
+        stats = self.stats()
+        self.assertEqual((stats.overweight, stats.normal), (0, 1))
+        
+        visit.visit_date = date(2024, 5, 7)
+        visit.save()
+        self.assertEqual((self.stats().visits, self.stats().overweight_assessments), (0, 0))
+        moved = self.stats(date(2024, 5, 7))
+        self.assertEqual((moved.visits, moved.normal, moved.overweight_assessments), (1, 1, 1))
+        
+        assessment.delete()
+        self.assertEqual(self.stats(date(2024, 5, 7)).assessed, 0)
+        visit.delete()
+        self.assertEqual(self.stats(date(2024, 5, 7)).visits, 0)
+    
+    def test_dashboard_reads_one_row_per_day(self):
+        from rest_framework.test import APIClient
+        Visit.objects.create(
+            patient=self.patient,
+            visit_date=self.day,
+            height=Decimal('170.00'),
+            weight=Decimal('50.00')
+        )
+        with self.assertNumQueries(1):
+            response = APIClient().get('/api/dashboard/daily/', {'start': '2024-05-01', 'end': '2024-05-07'})
+        self.assertEqual(len(response.data['days']), 7)
+        self.assertEqual(response.data['totals']['visits'], 1)
+        self.assertEqual(response.data['totals']['underweight'], 1)
+        self.assertIsNone(response.data['days'][0]['completion_rate'])
+        self.assertEqual(
+            APIClient().get('/api/dashboard/daily/', {'days': '0'}).status_code,
+            400
+        )
+    
+    def test_reconcile_repairs_drift_and_keeps_archived_days(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from .archive import archive_visits
+        from .models import DailyClinicStats
+        Visit.objects.create(
+            patient=self.patient,
+            visit_date=self.day,
+            height=Decimal('170.00'),
+            weight=Decimal('65.00')
+        )
+        archive_visits(date(2025, 1, 1))
+        self.assertEqual(self.stats().visits, 1)
+        
+        DailyClinicStats.objects.filter(date=self.day).update(visits=5, normal=0)
+        output = StringIO()
+        call_command('reconcile_daily_stats', stdout=output)
+        self.assertIn('visits 5 -> 1', output.getvalue())
+        stats = self.stats()
+        self.assertEqual((stats.visits, stats.normal), (1, 1))
+    
+    def test_dashboard_page_renders(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_user('nurse', password='pw'))
+        response = self.client.get('/patients/dashboard/', {'days': '7'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['days']), 7)
+
+
+class PendingAssessmentQueueTest(TestCase):
+    def setUp(self):
+        from .object_cache import object_cache
+        object_cache.clear()
+        patient = Patient.objects.create(
+            patient_id='PEND001',
+            first_name='Tomas',
+            last_name='Silva',
+            date_of_birth=date(1975, 3, 3),
+            gender='M'
+        )
+        self.normal = Visit.objects.create(
+            patient=patient,
+            visit_date=date(2024, 6, 1),
+            height=Decimal('180.00'),
+            weight=Decimal('70.00')
+        )
+        self.heavy = Visit.objects.create(
+            patient=patient,
+            visit_date=date(2024, 6, 2),
+            height=Decimal('160.00'),
+            weight=Decimal('90.00')
+        )
+    
+    def test_queue_lists_required_assessment_type(self):
+        from rest_framework.test import APIClient
+        response = APIClient().get('/api/visits/pending-assessment/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(v['id'], v['required_assessment_type']) for v in response.data['pending']],
+            [(self.normal.id, 'general'), (self.heavy.id, 'overweight')]
+        )
+        self.assertEqual(response.data['pending'][0]['patient_id'], 'PEND001')
+    
+    def test_flag_follows_assessment_create_and_delete(self):
+        assessment = Assessment.objects.create(
+            visit=self.normal,
+            assessment_type='general',
+            general_health='Good',
+            using_drugs=False,
+            comments='Fine'
+        )
+        self.normal.refresh_from_db()
+        self.assertFalse(self.normal.awaiting_assessment)
+        assessment.delete()
+        self.normal.refresh_from_db()
+        self.assertTrue(self.normal.awaiting_assessment)
+    
+    def test_deleting_assessed_visit_does_not_requeue_it(self):
+        from .models import ChangeEvent
+        Assessment.objects.create(
+            visit=self.normal,
+            assessment_type='general',
+            general_health='Good',
+            using_drugs=False,
+            comments='Fine'
+        )
+        after = ChangeEvent.objects.latest('seq').seq
+        self.normal.delete()
+        self.assertEqual(
+            list(ChangeEvent.objects.filter(seq__gt=after).order_by('seq').values_list('model', 'action')),
+            [('assessment', 'delete'), ('visit', 'delete')]
+        )
+    
+    def test_since_cursor_returns_only_changes(self):
+        from rest_framework.test import APIClient
+        client = APIClient()
+        with self.settings(PENDING_ASSESSMENT_CURSOR_OVERLAP=0):
+            cursor = client.get('/api/visits/pending-assessment/').data['cursor']
+            Visit.objects.filter(pk__in=[self.normal.pk, self.heavy.pk]).update(
+                assessment_status_changed_at=timezone.now() - timedelta(minutes=5)
+            )
+            Assessment.objects.create(
+                visit=self.heavy,
+                assessment_type='overweight',
+                general_health='Poor',
+                on_diet=False,
+                comments='Refer'
+            )
+            response = client.get('/api/visits/pending-assessment/', {'since': cursor})
+        self.assertEqual(response.data['pending'], [])
+        self.assertEqual(response.data['resolved'], [self.heavy.id])
+    
+    def test_deleted_visits_resolve_and_full_deltas_resume_from_their_last_row(self):
+        from .pending import changes_since
+        since = timezone.now()
+        with self.settings(PENDING_ASSESSMENT_CURSOR_OVERLAP=0):
+            normal_pk = self.normal.pk
+            self.normal.delete()
+            self.assertEqual(changes_since(since)[2], [normal_pk])
+            
+            since = timezone.now() - timedelta(seconds=10)
+            extra = Visit.objects.create(
+                patient=self.heavy.patient, visit_date=date(2024, 6, 3), height=Decimal('170.00'), weight=Decimal('70.00')
+            )
+            earlier = since + timedelta(seconds=1)
+            Visit.objects.filter(pk=self.heavy.pk).update(assessment_status_changed_at=earlier)
+            Visit.objects.filter(pk=extra.pk).update(assessment_status_changed_at=since + timedelta(seconds=2))
+            cursor, pending, _ = changes_since(since, limit=1)
+            self.assertEqual(([visit.pk for visit in pending], cursor), ([self.heavy.pk], earlier))
+            self.assertEqual([visit.pk for visit in changes_since(cursor, limit=1)[1]], [extra.pk])
+    
+    def test_status_changes_move_updated_at_and_reach_the_outbox(self):
+        from .models import ChangeEvent
+        before = Visit.objects.get(pk=self.heavy.pk).updated_at
+        Assessment.objects.create(
+            visit=self.heavy, assessment_type='overweight', general_health='Poor', on_diet=False, comments='Refer'
+        )
+        self.assertGreater(Visit.objects.get(pk=self.heavy.pk).updated_at, before)
+        self.assertTrue(ChangeEvent.objects.filter(model='visit', object_id=self.heavy.pk, action='update').exists())
+    
+    def test_listing_page(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_user('nurse', password='pw'))
+        response = self.client.get('/patients/pending-assessments/')
+        self.assertContains(response, f'/patients/assessment/overweight/{self.heavy.id}/')
+        self.assertContains(response, f'/patients/assessment/general/{self.normal.id}/')
+
+
+class ClinicTenancyTest(TestCase):
+    databases = {'default', 'clinic_b'} if 'clinic_b' in settings.DATABASES else {'default'}
+    
+    def setUp(self):
+        from django.core.cache import caches
+        from .models import Clinic
+        from .object_cache import object_cache
+        from .tenancy import use_clinic
+        object_cache.clear()
+        caches['default'].clear()
+        self.north = Clinic.objects.create(code='north', name='North Clinic')
+        self.south = Clinic.objects.create(code='south', name='South Clinic')
+        with use_clinic(self.north):
+            self.north_patient = Patient.objects.create(
+                patient_id='NORTH001',
+                first_name='Ana',
+                last_name='Lima',
+                date_of_birth=date(1980, 1, 1),
+                gender='F'
+            )
+        with use_clinic(self.south):
+            self.south_patient = Patient.objects.create(
+                patient_id='SOUTH001',
+                first_name='Ben',
+                last_name='Okoro',
+                date_of_birth=date(1981, 2, 2),
+                gender='M'
+            )
+            Visit.objects.create(
+                patient=self.south_patient,
+                visit_date=date(2024, 7, 1),
+                height=Decimal('170.00'),
+                weight=Decimal('95.00')
+            )
+    
+    def test_new_patients_join_the_current_clinic(self):
+        self.assertEqual(self.north_patient.clinic, self.north)
+        self.assertEqual(self.south_patient.clinic, self.south)
+    
+    def test_api_is_scoped_by_header(self):
+        from rest_framework.test import APIClient
+        client = APIClient(HTTP_X_CLINIC='north')
+        response = client.get('/api/patients/')
+        self.assertEqual([p['patient_id'] for p in response.data['results']], ['NORTH001'])
+        self.assertEqual(client.get(f'/api/patients/{self.south_patient.pk}/').status_code, 404)
+        self.assertEqual(client.get('/api/visits/').data['results'], [])
+        self.assertEqual(
+            client.get('/api/dashboard/daily/', {'start': '2024-07-01', 'end': '2024-07-01'}).data['totals']['visits'],
+            0
+        )
+        south = APIClient(HTTP_X_CLINIC='south')
+        self.assertEqual(south.get(f'/api/patients/{self.south_patient.pk}/').status_code, 200)
+        self.assertEqual(
+            south.get('/api/dashboard/daily/', {'start': '2024-07-01', 'end': '2024-07-01'}).data['totals']['visits'],
+            1
+        )
+        self.assertEqual(APIClient(HTTP_X_CLINIC='nowhere').get('/api/patients/').status_code, 400)
+    
+    def test_api_creates_patients_in_header_clinic(self):
+        from rest_framework.test import APIClient
+        response = APIClient(HTTP_X_CLINIC='south').post('/api/patients/', {
+            'patient_id': 'SOUTH002',
+            'first_name': 'Cleo',
+            'last_name': 'Mensah',
+            'date_of_birth': '1990-03-03',
+            'gender': 'F'
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Patient.all_clinics.get(patient_id='SOUTH002').clinic_id, self.south.pk)
+    
+    def test_template_views_remember_chosen_clinic(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_user('nurse', password='pw'))
+        response = self.client.get('/patients/listing/', {'clinic': 'south'})
+        self.assertContains(response, 'SOUTH001')
+        self.assertNotContains(response, 'NORTH001')
+        response = self.client.get('/patients/listing/')
+        self.assertContains(response, 'SOUTH001')
+        self.assertNotContains(response, 'NORTH001')
+    
+    def test_without_clinic_everything_is_visible(self):
+        self.assertEqual(Patient.objects.count(), 2)
+    
+    @skipUnless('clinic_b' in settings.DATABASES, "needs a 'clinic_b' database alias")
+    def test_large_clinic_uses_its_own_database(self):
+        from rest_framework.test import APIClient
+        from .models import Clinic
+        from .tenancy import use_clinic
+        big = Clinic.objects.create(code='big', name='Big Clinic', database='clinic_b')
+        with use_clinic(big):
+            patient = Patient.objects.create(
+                patient_id='BIG001',
+                first_name='Dara',
+                last_name='Kim',
+                date_of_birth=date(1970, 4, 4),
+                gender='O'
+            )
+            Visit.objects.create(
+                patient=patient,
+                visit_date=date(2024, 7, 2),
+                height=Decimal('180.00'),
+                weight=Decimal('70.00')
+            )
+        self.assertEqual(patient._state.db, 'clinic_b')
+        self.assertFalse(Patient.all_clinics.using('default').filter(patient_id='BIG001').exists())
+        self.assertEqual(Visit.all_clinics.using('clinic_b').filter(patient_id=patient.pk).count(), 1)
+        
+        client = APIClient(HTTP_X_CLINIC='big')
+        response = client.get('/api/patients/')
+        self.assertEqual([p['patient_id'] for p in response.data['results']], ['BIG001'])
+        self.assertEqual(client.get(f'/api/patients/{patient.pk}/').data['patient_id'], 'BIG001')
+    
+    @skipUnless('clinic_b' in settings.DATABASES, "needs a 'clinic_b' database alias")
+    def test_outbox_rows_follow_the_write_outside_requests(self):
+        from .models import ChangeEvent, Clinic, Tombstone
+        from .tenancy import use_clinic
+        big = Clinic.objects.create(code='big', name='Big Clinic', database='clinic_b')
+        with use_clinic(big):
+            patient = Patient.objects.create(
+                patient_id='BIG002',
+                first_name='Eli',
+                last_name='Park',
+                date_of_birth=date(1975, 5, 5),
+                gender='M'
+            )
+        # No clinic is current here, as in a management command or the job worker.
+        patient.first_name = 'Elias'
+        patient.save()
+        pk = patient.pk
+        patient.delete()
+        for alias, expected in (('clinic_b', ['create', 'update', 'delete']), ('default', [])):
+            events = ChangeEvent.all_clinics.using(alias).filter(clinic=big, model='patient', object_id=pk)
+            self.assertEqual(list(events.order_by('seq').values_list('action', flat=True)), expected)
+        for alias, expected in (('clinic_b', True), ('default', False)):
+            tombstones = Tombstone.all_clinics.using(alias).filter(clinic=big, model='patient', object_id=pk)
+            self.assertEqual(tombstones.exists(), expected)
+
+
+class RequestCoalescingTest(TestCase):
+    def setUp(self):
+        from .coalescing import coalescer
+        coalescer.reset()
+    
+    def middleware(self, view):
+        from .coalescing import CoalescingMiddleware
+        return CoalescingMiddleware(view)
+    
+    def get(self, path, user=None):
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        request = RequestFactory().get(path)
+        request.user = user or AnonymousUser()
+        return request
+    
+    def test_concurrent_identical_requests_share_one_computation(self):
+        import threading
+        import time
+        from django.http import HttpResponse
+        calls = []
+        
+        def view(request):
+            calls.append(request)
+            time.sleep(0.2)
+            return HttpResponse(f'listing {len(calls)}')
+        
+        middleware = self.middleware(view)
+        responses = []
+        threads = [
+            threading.Thread(target=lambda: responses.append(middleware(self.get('/api/patients/?page=1'))))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(calls), 1)
+        self.assertEqual({response.content for response in responses}, {b'listing 1'})
+        self.assertEqual(sum(response.get('X-Coalesced') == 'shared' for response in responses), 4)
+        from .coalescing import coalescer
+        stats = coalescer.get_stats()
+        route = stats['routes'][r'^/api/(patients|visits|assessments)/$']
+        self.assertEqual((route['requests'], route['computed'], route['coalesced']), (5, 1, 4))
+        self.assertEqual(stats['in_flight'], 0)
+    
+    def test_herd_collapses_under_the_shipped_gunicorn_config(self):
+        import runpy
+        import threading
+        import time
+        from django.conf import settings
+        from django.http import HttpResponse
+        config = runpy.run_path(str(settings.BASE_DIR / 'gunicorn.conf.py'))
+        # A sync worker serves one request at a time, so it never has a herd to collapse.
+        self.assertEqual(config['worker_class'], 'gthread')
+        self.assertGreater(config['threads'], 1)
+        
+        calls = []
+        arrived = threading.Barrier(config['threads'])
+        
+        def view(request):
+            calls.append(request)
+            time.sleep(0.2)
+            return HttpResponse('listing')
+        
+        middleware = self.middleware(view)
+        
+        def serve():
+            arrived.wait()
+            middleware(self.get('/patients/listing/'))
+        
+        threads = [threading.Thread(target=serve) for _ in range(config['threads'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+    
+    def test_micro_cache_respects_route_ttl_and_writes(self):
+        from django.http import HttpResponse
+        calls = []
+        
+        def view(request):
+            calls.append(request)
+            return HttpResponse(f'dashboard {len(calls)}')
+        
+        with self.settings(COALESCING_ROUTES=[{'pattern': r'^/api/dashboard/daily/$', 'ttl': 30}]):
+            middleware = self.middleware(view)
+            middleware(self.get('/api/dashboard/daily/'))
+            cached = middleware(self.get('/api/dashboard/daily/'))
+            self.assertEqual((cached.content, cached['X-Coalesced']), (b'dashboard 1', 'cache'))
+            self.assertEqual(middleware(self.get('/api/dashboard/daily/?days=7')).content, b'dashboard 2')
+            
+            Patient.objects.create(
+                patient_id='HERD001',
+                first_name='Lena',
+                last_name='Park',
+                date_of_birth=date(1992, 2, 2),
+                gender='F'
+            )
+            self.assertEqual(middleware(self.get('/api/dashboard/daily/')).content, b'dashboard 3')
+    
+    def test_personal_responses_are_not_shared(self):
+        from django.contrib.auth.models import User
+        from django.http import HttpResponse
+        from django.middleware.csrf import get_token
+        from .coalescing import snapshot
+        nurse = User.objects.create_user('nurse', password='pw')
+        doctor = User.objects.create_user('doctor', password='pw')
+        middleware = self.middleware(lambda request: HttpResponse(request.user.username))
+        self.assertNotEqual(
+            middleware.key(self.get('/patients/listing/', nurse), 'user'),
+            middleware.key(self.get('/patients/listing/', doctor), 'user')
+        )
+        self.assertEqual(
+            middleware.key(self.get('/api/patients/', nurse), 'permissions'),
+            middleware.key(self.get('/api/patients/', doctor), 'permissions')
+        )
+        
+        def form(request):
+            return HttpResponse(get_token(request))
+        
+        request = self.get('/patients/listing/')
+        self.assertIsNone(snapshot(request, form(request)))
+
+
+class LiveEventsTest(TestCase):
+    def setUp(self):
+        from django.core.cache import caches
+        caches['default'].clear()
+    
+    def subscribe(self, clinic_id=None):
+        from .events import QueueSubscription, broadcaster
+        subscription = QueueSubscription(clinic_id, 10)
+        broadcaster.subscribe(subscription)
+        self.addCleanup(broadcaster.unsubscribe, subscription)
+        return subscription
+    
+    def create_patient(self, patient_id='LIVE001', **kwargs):
+        return Patient.objects.create(
+            patient_id=patient_id,
+            first_name='Ada',
+            last_name='Obi',
+            date_of_birth=date(1990, 1, 1),
+            gender='F',
+            **kwargs
+        )
+    
+    def test_commits_are_published_to_subscribers(self):
+        subscription = self.subscribe()
+        with self.captureOnCommitCallbacks(execute=True):
+            patient = self.create_patient()
+        with self.captureOnCommitCallbacks(execute=True):
+            visit = Visit.objects.create(patient=patient, visit_date=date.today(), height=Decimal('170.00'), weight=Decimal('60.00'))
+        
+        first, second = subscription.get(0), subscription.get(0)
+        self.assertEqual((first['model'], first['action'], first['id'], first['patient']), ('patient', 'create', patient.pk, patient.pk))
+        self.assertEqual((second['model'], second['visit'], second['patient']), ('visit', visit.pk, patient.pk))
+        self.assertGreater(second['seq'], first['seq'])
+        self.assertNotIn('first_name', first)
+    
+    def test_subscriptions_only_see_their_clinic(self):
+        from .models import Clinic
+        north = Clinic.objects.create(code='north', name='North')
+        south = Clinic.objects.create(code='south', name='South')
+        subscription = self.subscribe(north.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_patient('LIVE001', clinic=south)
+            patient = self.create_patient('LIVE002', clinic=north)
+        
+        self.assertEqual(subscription.get(0)['id'], patient.pk)
+        self.assertIsNone(subscription.get(0))
+    
+    def test_stream_replays_missed_events_then_heartbeats(self):
+        from . import changes
+        from .events import replay
+        self.create_patient('LIVE001')
+        after = changes.latest_seq()
+        patient = self.create_patient('LIVE002')
+        self.assertEqual([event['id'] for event in replay(after, None)], [patient.pk])
+        self.assertIsNone(replay(0, None, limit=1))
+        
+        self.assertEqual(self.client.get('/api/events/').status_code, 302)
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_user('nurse', password='pw-12345'))
+        # Under WSGI streams are off unless enabled; 204 stops EventSource reconnecting.
+        self.assertEqual(self.client.get('/api/events/').status_code, 204)
+        self.assertNotContains(self.client.get('/patients/listing/'), 'live_updates.js')
+        
+        with self.settings(EVENTS_MAX_STREAM_SECONDS=0.2, EVENTS_HEARTBEAT=0.05, EVENTS_WSGI_STREAMS=True):
+            self.assertContains(self.client.get('/patients/listing/'), 'live_updates.js')
+            response = self.client.get('/api/events/', HTTP_LAST_EVENT_ID=str(after))
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            body = ''.join(chunk.decode() for chunk in response.streaming_content)
+        self.assertTrue(body.startswith('retry: '))
+        self.assertIn(f'id: {changes.latest_seq()}\nevent: patient\n', body)
+        self.assertIn(': keepalive', body)
+        with self.settings(EVENTS_WSGI_STREAMS=True):
+            self.assertEqual(self.client.get('/api/events/?after=x').status_code, 400)
+        self.assertEqual(changes.seq_before(timezone.now() - timedelta(days=1)), 0)
+    
+    def test_row_endpoints_render_single_rows(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_user('nurse', password='pw-12345'))
+        patient = self.create_patient()
+        visit = Visit.objects.create(patient=patient, visit_date=date.today(), height=Decimal('170.00'), weight=Decimal('60.00'))
+        
+        response = self.client.get(f'/patients/listing/rows/{patient.pk}/')
+        self.assertContains(response, f'id="patient-row-{patient.pk}"')
+        self.assertEqual(self.client.get(f'/patients/listing/rows/{patient.pk + 100}/').status_code, 404)
+        self.assertContains(self.client.get(f'/patients/pending-assessments/rows/{visit.pk}/'), f'id="visit-row-{visit.pk}"')
+        
+        Assessment.objects.create(visit=visit, assessment_type='general', general_health='Good', using_drugs=False, comments='Seen')
+        self.assertEqual(self.client.get(f'/patients/pending-assessments/rows/{visit.pk}/').status_code, 204)
+
+
+class AccessAuditTest(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from django.core.cache import caches
+        from .audit import buffer
+        from .coalescing import coalescer
+        caches['default'].clear()
+        coalescer.reset()
+        buffer.clear()
+        self.admin = User.objects.create_superuser('auditor', 'a@example.com', 'pw')
+        self.client.force_login(self.admin)
+        self.patient = Patient.objects.create(
+            patient_id='AUD001',
+            first_name='Ines',
+            last_name='Moyo',
+            date_of_birth=date(1985, 5, 5),
+            gender='F'
+        )
+        self.visit = Visit.objects.create(
+            patient=self.patient,
+            visit_date=date.today(),
+            height=Decimal('170.00'),
+            weight=Decimal('60.00')
+        )
+    
+    def test_reads_are_buffered_then_written_in_one_batch(self):
+        from . import audit
+        from .models import AuditEvent
+        self.client.get(f'/api/patients/{self.patient.pk}/')
+        self.client.get(f'/api/visits/{self.visit.pk}/')
+        self.client.get(f'/patients/vitals/{self.patient.patient_id}/')
+        self.client.get('/patients/listing/')
+        self.client.get('/api/metrics/')
+        self.assertFalse(AuditEvent.objects.exists())
+        
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(audit.flush(), 4)
+        self.assertEqual(sum(query['sql'].startswith('INSERT') for query in queries.captured_queries), 1)
+        rows = list(AuditEvent.objects.order_by('occurred_at', 'id').values_list('action', 'patient_pk', 'visit_pk', 'username'))
+        self.assertEqual(rows, [
+            ('view', self.patient.pk, None, 'auditor'),
+            ('view', self.patient.pk, self.visit.pk, 'auditor'),
+            ('view', self.patient.pk, None, 'auditor'),
+            ('list', self.patient.pk, None, 'auditor'),
+        ])
+    
+    def test_listings_record_each_patient_on_the_page(self):
+        import re
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from . import audit
+        from .coalescing import CoalescingMiddleware, coalescer, snapshot
+        from .models import AuditEvent
+        other = Patient.objects.create(patient_id='AUD002', first_name='Juma', last_name='Moyo', date_of_birth=date(1990, 1, 1), gender='M')
+        self.client.get('/api/patients/')
+        self.client.get('/api/patients/?visit_date=1999-01-01')
+        audit.flush()
+        self.assertEqual(
+            sorted(AuditEvent.objects.values_list('action', 'patient_pk'), key=str),
+            sorted([('list', self.patient.pk), ('list', other.pk), ('list', None)], key=str)
+        )
+        
+        # A coalesced follower logs the ids the leader's response showed.
+        request = RequestFactory().get('/api/patients/')
+        request.audit_ids = {'patient_pk': [other.pk]}
+        response = HttpResponse('[]')
+        follower = RequestFactory().get('/api/patients/')
+        middleware = CoalescingMiddleware(lambda request: response)
+        middleware.routes = [(re.compile('^/api/patients/$'), 60, 'permissions')]
+        coalescer.cache.set(middleware.key(follower, 'permissions'), snapshot(request, response))
+        middleware(follower)
+        self.assertEqual(follower.audit_ids, {'patient_pk': [other.pk]})
+    
+    def test_forked_child_gets_fresh_locks_and_no_parent_events(self):
+        from . import audit
+        self.client.get(f'/api/patients/{self.patient.pk}/')
+        audit.buffer.lock.acquire()
+        audit._after_fork()
+        self.assertFalse(audit.buffer.lock.locked())
+        self.assertEqual(audit.buffer.get_stats()['buffered'], 0)
+    
+    def test_creates_record_the_new_record(self):
+        from . import audit
+        from .models import AuditEvent
+        response = self.client.post('/api/visits/', {
+            'patient': self.patient.pk,
+            'visit_date': (date.today() - timedelta(days=1)).isoformat(),
+            'height': '170.00',
+            'weight': '90.00'
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        audit.flush()
+        event = AuditEvent.objects.get()
+        self.assertEqual((event.action, event.visit_pk, event.patient_pk), ('create', response.data['id'], self.patient.pk))
+    
+    def test_admin_posts_record_update_and_delete(self):
+        from . import audit
+        from .models import AuditEvent
+        self.client.post(f'/admin/patients/patient/{self.patient.pk}/change/', {})
+        self.client.post(f'/admin/patients/visit/{self.visit.pk}/delete/', {'post': 'yes'})
+        audit.flush()
+        self.assertEqual(
+            sorted(AuditEvent.objects.values_list('action', 'patient_pk', 'visit_pk'), key=str),
+            sorted([('update', self.patient.pk, None), ('delete', None, self.visit.pk)], key=str)
+        )
+    
+    def test_buffer_keeps_failed_batches_and_drops_oldest_when_full(self):
+        from unittest import mock
+        from . import audit
+        self.client.get(f'/api/patients/{self.patient.pk}/')
+        with mock.patch.dict(audit.WRITERS, {'database': mock.Mock(side_effect=RuntimeError('down'))}):
+            with self.assertLogs('patients.audit', 'ERROR'):
+                self.assertEqual(audit.flush(), 0)
+        self.assertEqual(len(audit.buffer.events), 1)
+        
+        small = audit.AuditBuffer(2)
+        for n in range(3):
+            small.append({'n': n})
+        small.restore([{'n': 'failed'}])
+        self.assertEqual([event['n'] for event in small.events], [1, 2])
+        self.assertEqual(small.get_stats()['dropped'], 2)
+        
+        with self.settings(AUDIT_FLUSH_SIZE=2):
+            self.client.get(f'/api/patients/{self.patient.pk}/')
+        self.assertEqual(len(audit.buffer.events), 0)
+    
+    def test_query_api_over_database_and_file(self):
+        import os
+        import tempfile
+        self.client.get(f'/api/visits/{self.visit.pk}/')
+        self.client.get('/api/patients/')
+        response = self.client.get(f'/api/audit/?patient={self.patient.pk}')
+        self.assertEqual([row['visit'] for row in response.data['results']], [None, self.visit.pk])
+        self.assertEqual(self.client.get('/api/audit/?since=yesterday').status_code, 400)
+        
+        with tempfile.TemporaryDirectory() as directory:
+            with self.settings(AUDIT_BACKEND='file', AUDIT_FILE=os.path.join(directory, 'audit.jsonl')):
+                self.client.get(f'/api/patients/{self.patient.pk}/')
+                self.client.get('/api/patients/')
+                response = self.client.get('/api/audit/?action=view&username=auditor')
+        self.assertEqual(
+            [(row['action'], row['patient']) for row in response.data['results']],
+            [('view', self.patient.pk)]
+        )
+
+
+class PatientAutocompleteTest(TestCase):
+    def setUp(self):
+        for patient_id, first_name, last_name in [
+            ('KE100', 'Amina', 'Otieno'),
+            ('KE101', 'Brian', 'Kamau'),
+            ('UG200', 'Kato', 'Keya'),
+            ('TZ300', 'Neema', 'Mushi'),
+        ]:
+            Patient.objects.create(
+                patient_id=patient_id,
+                first_name=first_name,
+                last_name=last_name,
+                date_of_birth=date(1990, 1, 1),
+                gender='F'
+            )
+    
+    def test_matches_patient_id_then_last_name_prefix(self):
+        response = self.client.get('/api/patients/autocomplete/?prefix=k')
+        self.assertEqual(
+            [(row['patient_id'], row['name']) for row in response.json()],
+            [('KE100', 'Amina Otieno'), ('KE101', 'Brian Kamau'), ('UG200', 'Kato Keya')]
+        )
+        self.assertEqual(set(response.json()[0]), {'id', 'patient_id', 'name'})
+        self.assertEqual([row['patient_id'] for row in self.client.get('/api/patients/autocomplete/?prefix=mus').json()], ['TZ300'])
+    
+    def test_limit_wildcards_and_validation(self):
+        from . import autocomplete
+        self.assertEqual(len(autocomplete.search('K', limit=2)), 2)
+        self.assertEqual(autocomplete.search('K_'), [])
+        self.assertEqual(autocomplete.escape_like('5%_\\'), '5\\%\\_\\\\')
+        self.assertEqual(self.client.get('/api/patients/autocomplete/?prefix=').status_code, 400)
+
+
+class VisitsMaintenanceTest(TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.patient = Patient.objects.create(
+            patient_id='MNT001',
+            first_name='Otto',
+            last_name='Berg',
+            date_of_birth=date(1970, 3, 3),
+            gender='M'
+        )
+        self.visits = [
+            Visit.objects.create(
+                patient=self.patient,
+                visit_date=date(2024, 1, day),
+                height=Decimal('170.00'),
+                weight=Decimal(weight)
+            )
+            for day, weight in enumerate(['60.00', '70.00', '80.00', '65.00', '55.00'], start=1)
+        ]
+    
+    def path(self, name):
+        import os
+        return os.path.join(self.directory.name, name)
+    
+    def run_command(self, *args):
+        from io import StringIO
+        from django.core.management import call_command
+        call_command(
+            'visits_maintenance',
+            '--workers', '1',
+            '--chunk-size', '2',
+            '--checkpoint', self.path('checkpoint.json'),
+            '--output', self.path('report.csv'),
+            *args,
+            stderr=StringIO()
+        )
+        with open(self.path('report.csv')) as fp:
+            return sorted((row['rule'], int(row['id'])) for row in __import__('csv').DictReader(fp))
+    
+    def test_vectorized_bmi_matches_model(self):
+        import numpy as np
+        from .maintenance import STATUSES, bmi_hundredths, status_codes
+        from .models import bmi_status, calculate_bmi
+        heights = np.array([300, 1234, 1700, 1700, 1999, 3000, 0], dtype=np.int64)
+        weights = np.array([1000, 45678, 53465, 72250, 99999, 500000, 60000], dtype=np.int64)
+        hundredths = bmi_hundredths(heights, weights)
+        for height, weight, value, code in zip(heights, weights, hundredths, status_codes(hundredths)):
+            bmi = calculate_bmi(int(height), int(weight))
+            self.assertEqual(value, -1 if bmi is None else int(bmi * 100))
+            self.assertEqual(STATUSES[code], bmi_status(bmi) or '')
+    
+    @GENERATED_BMI
+    def test_reports_violations_and_fixes_drifted_bmi(self):
+        from .models import ChangeEvent
+        first, second, third, fourth, _ = self.visits
+        Assessment.objects.create(visit=first, assessment_type='general', general_health='Good', using_drugs=False, comments='ok')
+        Assessment.objects.create(visit=third, assessment_type='overweight', general_health='Good', on_diet=True, comments='ok')
+        Visit.objects.filter(pk=first.pk).update(bmi=Decimal('10.00'))
+        Visit.objects.filter(pk=second.pk).update(bmi_status='Overweight')
+        Visit.objects.filter(pk=third.pk).update(weight_g=60000)
+        Visit.objects.filter(pk=fourth.pk).update(height_mm=100)
+        events = ChangeEvent.objects.count()
+        updated_at = Visit.objects.get(pk=first.pk).updated_at
+        
+        self.assertEqual(self.run_command(), sorted([
+            ('bmi', first.pk), ('bmi', second.pk), ('bmi', third.pk), ('bmi', fourth.pk),
+            ('vitals_range', fourth.pk), ('assessment_type', third.assessment.pk),
+        ]))
+        self.assertEqual(Visit.objects.get(pk=first.pk).bmi, Decimal('10.00'))
+        
+        self.run_command('--fix')
+        first.refresh_from_db()
+        third.refresh_from_db()
+        self.assertEqual((first.bmi, first.bmi_status), (Decimal('20.76'), 'Normal'))
+        self.assertEqual((third.bmi, third.bmi_status), (Decimal('20.76'), 'Normal'))
+        self.assertGreater(first.updated_at, updated_at)
+        self.assertEqual(ChangeEvent.objects.count(), events + 3)
+        self.assertEqual(self.run_command(), sorted([
+            ('bmi', fourth.pk), ('vitals_range', fourth.pk), ('assessment_type', third.assessment.pk),
+        ]))
+    
+    @GENERATED_BMI
+    def test_interrupted_run_resumes_from_checkpoint(self):
+        import os
+        from unittest import mock
+        from django.core.management.base import CommandError
+        from . import maintenance
+        Visit.objects.filter(pk=self.visits[4].pk).update(bmi=Decimal('1.00'))
+        run_chunk = maintenance.run_chunk
+        calls = []
+        
+        def crash_on_second(args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('worker died')
+            return run_chunk(args)
+        
+        with mock.patch.object(maintenance, 'run_chunk', crash_on_second):
+            with self.assertRaises(RuntimeError):
+                self.run_command()
+        checkpoint = maintenance.Checkpoint.load(self.path('checkpoint.json'))
+        self.assertEqual(len(checkpoint.done), 1)
+        self.assertEqual(checkpoint.totals()[0], 2)
+        with open(self.path('checkpoint.json')) as fp:
+            self.assertEqual(sorted(__import__('json').load(fp)), ['done', 'plan'])
+        with self.assertRaises(CommandError):
+            self.run_command('--resume', '--fix')
+        
+        with mock.patch.object(maintenance, 'run_chunk', side_effect=run_chunk) as resumed:
+            self.assertEqual(self.run_command('--resume'), [('bmi', self.visits[4].pk)])
+        self.assertEqual(resumed.call_count, 2)
+        self.assertFalse(os.path.exists(self.path('checkpoint.json')))
+        self.assertFalse(os.path.exists(self.path('checkpoint.json.results.jsonl')))
+
+
+class SlowQueryLogTest(TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        from .slow_queries import install, slow_query_logger
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = os.path.join(directory.name, 'slow.jsonl')
+        install(connection=connection)
+        self.addCleanup(connection.execute_wrappers.remove, slow_query_logger)
+        self.patient = Patient.objects.create(
+            patient_id='SLOW001',
+            first_name='Ida',
+            last_name='Lund',
+            date_of_birth=date(1985, 6, 1),
+            gender='F'
+        )
+        Visit.objects.create(
+            patient=self.patient,
+            visit_date=date(2024, 2, 1),
+            height=Decimal('165.00'),
+            weight=Decimal('58.00')
+        )
+    
+    def test_normalize_collapses_literals_and_lists(self):
+        from .slow_queries import fingerprint, normalize
+        first = normalize('SELECT "t"."id" FROM "t" WHERE "t"."id" IN (%s, %s, %s) AND "t"."name" = \'x\' LIMIT 21')
+        second = normalize('SELECT  "t"."id" FROM "t"\nWHERE "t"."id" IN (%s) AND "t"."name" = \'it\'\'s\' LIMIT 5')
+        self.assertEqual(first, 'SELECT "t"."id" FROM "t" WHERE "t"."id" IN (...) AND "t"."name" = ? LIMIT ?')
+        self.assertEqual(fingerprint(first), fingerprint(second))
+    
+    def test_logs_slow_queries_with_plan_and_call_site(self):
+        import json
+        from .slow_queries import read_log
+        with self.settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_EXPLAIN_RATE=1, SLOW_QUERY_LOG=self.log):
+            self.assertEqual(len(Visit.objects.filter(weight_g__gt=1000)), 1)
+            Patient.objects.filter(pk=self.patient.pk).update(first_name='Ida')
+        entries = read_log(self.log)
+        select = next(entry for entry in entries if '"patients_visit"."weight_g" > ?' in entry['shape'])
+        self.assertIn('patients/tests.py', select['call_site'])
+        self.assertIn('patients_visit', select['seq_scans'])
+        self.assertNotIn('1000', json.dumps(select))
+        update = next(entry for entry in entries if entry['shape'].startswith('UPDATE'))
+        self.assertNotIn('plan', update)
+    
+    def test_only_side_effect_free_selects_are_explained(self):
+        from .slow_queries import explainable
+        self.assertTrue(explainable('SELECT "t"."id" FROM "t" WHERE "t"."note" = %s', False))
+        for sql in (
+            'SELECT "t"."id" FROM "t" FOR UPDATE',
+            'SELECT "t"."id" FROM "t" FOR NO KEY UPDATE SKIP LOCKED',
+            'SELECT "t"."id" FROM "t" FOR SHARE',
+            'select "t"."id" from "t" for key share',
+            "SELECT pg_notify('visits', %s)",
+            "SELECT nextval('patients_visit_id_seq')",
+            "SELECT setval('patients_visit_id_seq', 1)",
+            'SELECT pg_try_advisory_lock(%s)',
+            'SELECT * INTO "copy" FROM "t"',
+            'UPDATE "t" SET "x" = 1',
+        ):
+            self.assertFalse(explainable(sql, False), sql)
+        self.assertFalse(explainable('SELECT 1', True))
+    
+    def test_below_threshold_is_not_logged(self):
+        import os
+        with self.settings(SLOW_QUERY_THRESHOLD_MS=60000, SLOW_QUERY_LOG=self.log):
+            list(Visit.objects.all())
+        self.assertFalse(os.path.exists(self.log))
+    
+    def test_query_report_ranks_shapes_and_flags_seq_scans(self):
+        import json
+        from io import StringIO
+        from django.core.management import call_command
+        from .slow_queries import append
+        scan = {'format': 'postgresql', 'plan': {'Node Type': 'Seq Scan', 'Relation Name': 'patients_visit_y2024'}}
+        shapes = {
+            'a': 'SELECT * FROM "patients_visit" WHERE "patients_visit"."visit_date" >= ? ORDER BY "patients_visit"."id"',
+            'b': 'SELECT * FROM "patients_patient" WHERE "patients_patient"."id" = ?',
+        }
+        with self.settings(SLOW_QUERY_LOG=self.log):
+            append([
+                {'at': '2024-03-01T10:00:00+00:00', 'ms': 300.0, 'fingerprint': 'a', 'shape': shapes['a'],
+                 'call_site': 'patients/filters.py:40 in filter_range', 'plan': scan, 'seq_scans': ['patients_visit_y2024']},
+                {'at': '2024-03-01T10:00:01+00:00', 'ms': 250.0, 'fingerprint': 'a', 'shape': shapes['a'],
+                 'call_site': 'patients/filters.py:40 in filter_range'},
+                {'at': '2024-03-01T10:00:02+00:00', 'ms': 400.0, 'fingerprint': 'b', 'shape': shapes['b'],
+                 'call_site': 'patients/views.py:10 in retrieve'},
+            ])
+        output = StringIO()
+        call_command('query_report', '--log', self.log, stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('#1 [a] 550.0 ms total, 2 call(s)'))
+        self.assertIn('SEQ SCAN on patients_visit: consider an index on patients_visit (visit_date)', output.getvalue())
+        self.assertTrue(any(line.startswith('#2 [b]') for line in lines))
+        
+        output = StringIO()
+        call_command('query_report', '--log', self.log, '--since', '2024-03-01T10:00:02+00:00', '--json', stdout=output)
+        self.assertEqual([row['fingerprint'] for row in json.loads(output.getvalue())], ['b'])
+
+
+class BmiForAgeTest(TestCase):
+    def setUp(self):
+        self.child = Patient.objects.create(
+            patient_id='KID001',
+            first_name='Mika',
+            last_name='Sato',
+            date_of_birth=date(2015, 1, 1),
+            gender='M'
+        )
+    
+    def create_visit(self, patient, visit_date, height='110.00', weight='20.00'):
+        return Visit.objects.create(
+            patient=patient,
+            visit_date=visit_date,
+            height=Decimal(height),
+            weight=Decimal(weight)
+        )
+    
+    def test_scores_match_reference_curves(self):
+        from .growth import bmi_for_age, lms_value, load_reference
+        ages, L, M, S = load_reference('who')['M']
+        at = ages.searchsorted(61 * 30.4375)
+        # WHO 2007 BMI-for-age, boys 5 years 1 month: -3 to +3 SD.
+        self.assertEqual(
+            [round(float(lms_value(z, L[at], M[at], S[at])), 1) for z in range(-3, 4)],
+            [12.1, 13.0, 14.1, 15.3, 16.6, 18.3, 20.2]
+        )
+        # CDC 2000, boys 24 months: the 85th percentile is BMI 18.2.
+        z, percentile = bmi_for_age([18.2, 16.575], [730.5, 730.5], ['M', 'M'], reference='cdc')
+        self.assertEqual([round(value) for value in percentile], [85, 50])
+        z, percentile = bmi_for_age([20, 20, 20, 20], [-1, 7000, 3000, 3000], ['M', 'M', 'O', 'F'], reference='who')
+        self.assertEqual([value != value for value in z], [True, True, True, False])
+    
+    def test_visits_store_scores_for_children_only(self):
+        from rest_framework.test import APIClient
+        from .models import ChangeEvent
+        visit = self.create_visit(self.child, date(2022, 1, 1), height='120.00', weight='30.00')
+        self.assertEqual((visit.bmi_for_age_z, visit.bmi_for_age_percentile), (Decimal('2.73'), Decimal('99.69')))
+        adult = Patient.objects.create(
+            patient_id='ADU001', first_name='Ana', last_name='Roy', date_of_birth=date(1980, 1, 1), gender='F'
+        )
+        self.assertIsNone(self.create_visit(adult, date(2022, 1, 1)).bmi_for_age_z)
+        
+        response = APIClient().get(f'/api/visits/{visit.pk}/')
+        self.assertEqual(response.data['bmi_for_age_percentile'], '99.69')
+        
+        from .events import QueueSubscription, broadcaster
+        subscription = QueueSubscription(None, 10)
+        broadcaster.subscribe(subscription)
+        self.addCleanup(broadcaster.unsubscribe, subscription)
+        updated_at = visit.updated_at
+        self.child.gender = 'F'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.child.save()
+        visit.refresh_from_db()
+        self.assertEqual((visit.bmi_for_age_z, visit.bmi_for_age_percentile), (Decimal('2.34'), Decimal('99.03')))
+        self.assertGreater(visit.updated_at, updated_at)
+        self.assertTrue(ChangeEvent.objects.filter(model='visit', object_id=visit.pk, action='update').exists())
+        notified = [subscription.get(0), subscription.get(0)]
+        self.assertIn(('visit', visit.pk), [(event['model'], event['id']) for event in notified])
+        
+        events = ChangeEvent.objects.count()
+        self.child.first_name = 'Mia'
+        self.child.save()
+        self.assertEqual(ChangeEvent.objects.count(), events + 1)
+    
+    def test_listing_shows_latest_percentile(self):
+        from django.contrib.auth.models import User
+        from .listing_cache import get_cache
+        get_cache().clear()
+        self.create_visit(self.child, date(2022, 1, 1), height='120.00', weight='22.00')
+        self.client.force_login(User.objects.create_user('nurse', password='pw-12345'))
+        response = self.client.get('/patients/listing/')
+        self.assertEqual(response.context['patients'][0]['last_bmi_percentile'], Decimal('44.16'))
+        self.assertContains(response, 'P44')
+    
+    def test_update_visits_rewrites_only_stale_rows(self):
+        first = self.create_visit(self.child, date(2021, 1, 1))
+        second = self.create_visit(self.child, date(2022, 1, 1))
+        Visit.objects.filter(pk=first.pk).update(bmi_for_age_z=None, bmi_for_age_percentile=None)
+        self.assertEqual(
+            Visit.objects.all().recalculate_bmi_for_age(),
+            [(first.pk, self.child.pk, date(2021, 1, 1))]
+        )
+        first.refresh_from_db()
+        self.assertIsNotNone(first.bmi_for_age_z)
+        with self.settings(PEDIATRIC_BMI_REFERENCE='cdc'):
+            self.assertEqual(len(Visit.objects.filter(pk=second.pk).recalculate_bmi_for_age()), 1)
+    
+    def test_maintenance_reports_and_fixes_stale_scores(self):
+        import os
+        import tempfile
+        from io import StringIO
+        from django.core.management import call_command
+        visit = self.create_visit(self.child, date(2022, 1, 1))
+        expected = (visit.bmi_for_age_z, visit.bmi_for_age_percentile)
+        Visit.objects.filter(pk=visit.pk).update(bmi_for_age_z=Decimal('0.00'))
+        with tempfile.TemporaryDirectory() as directory:
+            output = StringIO()
+            call_command(
+                'visits_maintenance', '--workers', '1', '--fix',
+                '--checkpoint', os.path.join(directory, 'checkpoint.json'),
+                stdout=output, stderr=StringIO()
+            )
+        self.assertIn(f'bmi_for_age,visit,{visit.pk},', output.getvalue())
+        visit.refresh_from_db()
+        self.assertEqual((visit.bmi_for_age_z, visit.bmi_for_age_percentile), expected)
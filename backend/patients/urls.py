@@ -1,12 +1,32 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import PatientViewSet, VisitViewSet, AssessmentViewSet
+from .views import (
+    PatientViewSet,
+    VisitViewSet,
+    AssessmentViewSet,
+    JobViewSet,
+    SnapshotExportView,
+    ChangeFeedView,
+    SyncView,
+    DailyDashboardView,
+    MetricsView,
+    AuditLogView,
+    event_stream
+)
 
 router = DefaultRouter()
 router.register(r'patients', PatientViewSet, basename='patient')
 router.register(r'visits', VisitViewSet, basename='visit')
 router.register(r'assessments', AssessmentViewSet, basename='assessment')
+router.register(r'jobs', JobViewSet, basename='job')
 
 urlpatterns = [
+    path('snapshot/', SnapshotExportView.as_view(), name='snapshot-export'),
+    path('changes/', ChangeFeedView.as_view(), name='change-feed'),
+    path('sync/', SyncView.as_view(), name='sync'),
+    path('dashboard/daily/', DailyDashboardView.as_view(), name='daily-dashboard'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('events/', event_stream, name='event-stream'),
+    path('audit/', AuditLogView.as_view(), name='audit-log'),
     path('', include(router.urls)),
 ]
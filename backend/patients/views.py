@@ -1,17 +1,39 @@
-from rest_framework import viewsets, status
+import tempfile
+from datetime import date, datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.contrib.auth.decorators import login_required
+from django.http import FileResponse, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from rest_framework import generics, viewsets, status
 from rest_framework.decorators import action
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import OrderingFilter
-from .models import Patient, Visit, Assessment
+from .models import Patient, Visit, Assessment, ArchivedVisit, Job
 from .serializers import (
     PatientSerializer,
     PatientListSerializer,
     PatientDetailSerializer,
     VisitSerializer,
-    AssessmentSerializer
+    AssessmentSerializer,
+    ChangeEventSerializer,
+    JobSerializer,
+    DailyClinicStatsSerializer,
+    PendingAssessmentSerializer,
+    AuditEventSerializer,
+    serialize_merged_visits
 )
-from .filters import PatientFilter, VisitFilter
+from .filters import PatientFilter, VisitFilter, AssessmentFilter
+from . import archive, audit, autocomplete, changes, daily_stats, events, export, jobs, pending, sync
+from .slow_queries import slow_query_logger
+from .object_cache import object_cache, get_patient_or_404
+from .middleware import admission_controller
+from .coalescing import coalescer
 
 
 class PatientViewSet(viewsets.ModelViewSet):
@@ -38,12 +60,43 @@ class PatientViewSet(viewsets.ModelViewSet):
         
         return queryset
     
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        rows = response.data['results'] if isinstance(response.data, dict) else response.data
+        audit.annotate(request, patient=[row['id'] for row in rows])
+        return response
+    
+    def get_object(self):
+        if self.action not in ('retrieve', 'visits'):
+            return super().get_object()
+        patient = get_patient_or_404(pk=self.kwargs[self.lookup_field])
+        self.check_object_permissions(self.request, patient)
+        return patient
+    
     @action(detail=True, methods=['get'])
     def visits(self, request, pk=None):
         patient = self.get_object()
         visits = patient.visits.all()
-        serializer = VisitSerializer(visits, many=True)
-        return Response(serializer.data)
+        if not archive.wants_archive(request.query_params):
+            return Response(VisitSerializer(visits, many=True).data)
+        # Reading through to the archive can return years of visits; page it.
+        archived = archive.filter_archived(patient.archived_visits.all(), request.query_params)
+        rows = archive.MergedVisits(visits, archived)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serialize_merged_visits(page))
+        return Response(serialize_merged_visits(rows[:]))
+    
+    @action(detail=False, methods=['get'])
+    def autocomplete(self, request):
+        """Type-ahead on patient ID or last name prefix: ``[{id, patient_id, name}]``."""
+        prefix = request.query_params.get('prefix', '').strip()
+        if len(prefix) < settings.AUTOCOMPLETE_MIN_LENGTH:
+            return Response(
+                {'error': f'prefix must be at least {settings.AUTOCOMPLETE_MIN_LENGTH} characters'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(autocomplete.search(prefix))
     
     @action(detail=False, methods=['get'])
     def check_patient_id(self, request):
@@ -54,7 +107,7 @@ class PatientViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        exists = Patient.objects.filter(patient_id=patient_id).exists()
+        exists = Patient.all_clinics.filter(patient_id=patient_id).exists()
         return Response({'exists': exists})
 
 
@@ -79,6 +132,47 @@ class VisitViewSet(viewsets.ModelViewSet):
         
         return queryset
     
+    def list(self, request, *args, **kwargs):
+        if not archive.wants_archive(request.query_params):
+            return super().list(request, *args, **kwargs)
+        
+        queryset = self.filter_queryset(self.get_queryset())
+        archived = archive.filter_archived(
+            ArchivedVisit.objects.all(),
+            request.query_params
+        )
+        ordering = OrderingFilter().get_ordering(request, queryset, self)
+        rows = archive.MergedVisits(queryset, archived, ordering)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serialize_merged_visits(page, self.get_serializer_context()))
+        return Response(serialize_merged_visits(rows[:], self.get_serializer_context()))
+    
+    @action(detail=False, methods=['get'], url_path='pending-assessment')
+    def pending_assessment(self, request):
+        """
+        Visits still waiting for an assessment, oldest first. Pass the
+        returned ``cursor`` back as ``since`` to get only the visits that
+        entered (``pending``) or left (``resolved``) the queue since then.
+        """
+        since = request.query_params.get('since')
+        if since:
+            since = parse_datetime(since)
+            if since is None:
+                return Response(
+                    {'error': 'since must be an ISO 8601 datetime'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        
+        cursor, visits, resolved = pending.changes_since(since or None)
+        return Response({
+            'cursor': cursor.isoformat(),
+            'pending': PendingAssessmentSerializer(visits, many=True).data,
+            'resolved': resolved
+        })
+    
     @action(detail=True, methods=['get'])
     def assessment(self, request, pk=None):
         visit = self.get_object()
@@ -97,6 +191,7 @@ class AssessmentViewSet(viewsets.ModelViewSet):
     queryset = Assessment.objects.all()
     serializer_class = AssessmentSerializer
     filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_class = AssessmentFilter
     ordering_fields = ['created_at']
     ordering = ['-created_at']
     
@@ -112,3 +207,184 @@ class AssessmentViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(assessment_type=assessment_type)
         
         return queryset
+
+
+class SnapshotExportView(APIView):
+    """
+    Download a Parquet snapshot of all tables as a zip archive, or with
+    ``background=true`` queue it as a job and return the job immediately.
+    """
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        tables = request.query_params.getlist('table') or None
+        if tables:
+            unknown = [name for name in tables if name not in export.TABLES]
+            if unknown:
+                return Response(
+                    {'error': f"Unknown table(s): {', '.join(unknown)}"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        
+        if request.query_params.get('background') in ('1', 'true'):
+            job = jobs.enqueue('export_snapshot', {'tables': tables})
+            return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+        
+        output = tempfile.TemporaryFile()
+        with tempfile.TemporaryDirectory() as directory:
+            export.write_snapshot_zip(output, directory, tables=tables)
+        output.seek(0)
+        return FileResponse(
+            output,
+            as_attachment=True,
+            filename=f"snapshot-{date.today().isoformat()}.zip",
+            content_type='application/zip'
+        )
+
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = [IsAdminUser]
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_fields = ['status', 'name']
+    ordering_fields = ['created_at', 'priority']
+    ordering = ['-created_at']
+
+
+class ChangeFeedView(APIView):
+    """Serve outbox events after a sequence number, long-polling when idle."""
+    
+    def get(self, request):
+        try:
+            after = int(request.query_params.get('after', 0))
+            limit = int(request.query_params.get('limit', 0)) or None
+            wait = float(request.query_params.get('wait', 0))
+        except ValueError:
+            return Response(
+                {'error': 'after, limit and wait must be numbers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        events = changes.fetch_changes(after=after, limit=limit, wait=wait)
+        return Response({
+            'events': ChangeEventSerializer(events, many=True).data,
+            'last_seq': events[-1].seq if events else after
+        })
+
+
+class SyncView(APIView):
+    """Everything changed since a client checkpoint, a page at a time (``?cursor=``)."""
+    
+    def get(self, request):
+        cursor = request.query_params.get('cursor')
+        since = request.query_params.get('since')
+        if since:
+            since = parse_datetime(since)
+            if since is None:
+                return Response(
+                    {'error': 'since must be an ISO 8601 datetime'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        
+        try:
+            changed = sync.changed_since(since or None, cursor or None)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'checkpoint': changed['checkpoint'].isoformat(),
+            'full_resync': changed['full_resync'],
+            'cursor': changed['cursor'],
+            'patients': PatientSerializer(changed['patients'], many=True).data,
+            'visits': VisitSerializer(changed['visits'], many=True).data,
+            'assessments': AssessmentSerializer(changed['assessments'], many=True).data,
+            'deleted': changed['deleted']
+        })
+
+
+class DailyDashboardView(APIView):
+    """Per-day clinic counters for ``?days=N`` or ``?start=&end=``, newest first."""
+    
+    def get(self, request):
+        try:
+            start, end = daily_stats.date_range(request.query_params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        days = daily_stats.dashboard(start, end)
+        totals = {
+            field: sum(getattr(day, field) for day in days)
+            for field in daily_stats.COUNTER_FIELDS
+        }
+        assessed = totals['general_assessments'] + totals['overweight_assessments']
+        totals['assessed'] = assessed
+        totals['completion_rate'] = round(assessed / totals['visits'], 4) if totals['visits'] else None
+        return Response({
+            'start': start,
+            'end': end,
+            'totals': totals,
+            'days': DailyClinicStatsSerializer(days, many=True).data
+        })
+
+
+class MetricsView(APIView):
+    """Runtime counters for tuning caches and capacity limits."""
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        return Response({
+            'object_cache': object_cache.get_stats(),
+            'admission_control': admission_controller.get_stats(),
+            'coalescing': coalescer.get_stats(),
+            'events': events.broadcaster.get_stats(),
+            'audit': audit.buffer.get_stats(),
+            'slow_queries': slow_query_logger.get_stats()
+        })
+
+
+class AuditLogView(generics.ListAPIView):
+    """
+    Search the access audit log, newest first. Filters: ``user``,
+    ``username``, ``action``, ``clinic``, ``patient``, ``visit``,
+    ``assessment`` and an ISO 8601 ``since``/``until`` range.
+    """
+    serializer_class = AuditEventSerializer
+    permission_classes = [IsAdminUser]
+    
+    def list(self, request, *args, **kwargs):
+        try:
+            filters = audit.parse_filters(request.query_params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        events = audit.query(filters)
+        page = self.paginate_queryset(events)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(events, many=True).data)
+
+
+@login_required
+@require_GET
+def event_stream(request):
+    """Server-sent change notifications for the current clinic; see patients/events.py."""
+    if not events.streams_available(request):
+        return HttpResponse(status=204)
+    clinic = getattr(request, 'clinic', None)
+    clinic_id = clinic.pk if clinic is not None else None
+    after = request.headers.get('Last-Event-ID') or request.GET.get('after')
+    since = request.GET.get('since')
+    try:
+        if not after and since:
+            # Pages pass their render time; a second of overlap only replays
+            # a few rows they already show.
+            after = changes.seq_before(datetime.fromtimestamp(int(since) - 1, tz=dt_timezone.utc))
+        backlog = events.replay(int(after), clinic_id) if after else ()
+    except (ValueError, OverflowError, OSError):
+        return HttpResponseBadRequest('after and Last-Event-ID must be outbox positions and since a Unix time')
+    stream = events.async_stream if isinstance(request, ASGIRequest) else events.sync_stream
+    response = StreamingHttpResponse(stream(clinic_id, backlog), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
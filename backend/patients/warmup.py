@@ -0,0 +1,123 @@
+"""
+Process warm-up for WSGI/ASGI servers.
+
+``wsgi.py`` and ``asgi.py`` call ``warm_up()`` right after building the
+application. It imports the API stack, resolves the URLconf, compiles every
+template under the project template directories into the cached loader
+and primes the in-process caches, logging how long each phase took. With
+gunicorn's ``preload_app`` this runs once in the master, so forked workers
+inherit the imported modules, compiled templates and primed LRU entries.
+Database connections are not warmed: they belong to the thread that opened
+them and, without ``CONN_MAX_AGE``, close after each request, so the
+connection priming the caches is closed again before forking.
+"""
+import logging
+import os
+import time
+from importlib import import_module
+
+from django.conf import settings
+from django.db import connections
+from django.template import engines
+from django.urls import get_resolver
+
+logger = logging.getLogger(__name__)
+
+MODULES = [
+    'rest_framework.views',
+    'rest_framework.serializers',
+    'rest_framework.renderers',
+    'rest_framework.parsers',
+    'rest_framework.pagination',
+    'django_filters.rest_framework',
+    'django.contrib.admin.views.main',
+    'patients.views',
+    'patients.template_views',
+    'patients.admin',
+]
+
+
+def import_modules():
+    for name in MODULES:
+        import_module(name)
+    return len(MODULES)
+
+
+def load_urls():
+    """Resolve the URLconf so every view module is imported."""
+    resolver = get_resolver()
+    resolver.reverse_dict  # populates the resolver's lookup tables
+    return len(resolver.url_patterns)
+
+
+def template_names(directory):
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            if filename.endswith('.html'):
+                yield os.path.relpath(os.path.join(root, filename), directory).replace(os.sep, '/')
+
+
+def compile_templates():
+    compiled = set()
+    for engine in engines.all():
+        for directory in engine.template_dirs:
+            if not str(directory).startswith(str(settings.BASE_DIR)):
+                continue
+            for name in template_names(directory):
+                if (engine.name, name) not in compiled:
+                    engine.get_template(name)
+                    compiled.add((engine.name, name))
+    return len(compiled)
+
+
+def prime_caches(limit=None):
+    """Load the most recently updated patients and visits into the hot caches."""
+    from . import listing_cache
+    from .models import Patient, Visit
+    from .object_cache import object_cache
+
+    limit = limit if limit is not None else settings.WARMUP_PRIME_LIMIT
+    patients = list(Patient.objects.order_by('-updated_at')[:limit])
+    visits = list(Visit.objects.order_by('-updated_at')[:limit])
+    for instance in patients + visits:
+        object_cache.store(instance)
+    listing_cache.get_rows(patients)
+    return len(patients) + len(visits)
+
+
+PHASES = [
+    ('imports', import_modules),
+    ('urls', load_urls),
+    ('templates', compile_templates),
+    ('caches', prime_caches),
+]
+
+
+def warm_up(close_connections=True):
+    """
+    Run each warm-up phase and return ``[(phase, ms, count), ...]``. A
+    failing phase is logged and skipped so a warm-up problem (e.g. the
+    database not being reachable yet) never stops the server from starting.
+    """
+    timings = []
+    started = time.perf_counter()
+    for name, phase in PHASES:
+        phase_started = time.perf_counter()
+        try:
+            count = phase()
+        except Exception:
+            logger.exception("Warm-up phase %s failed", name)
+            count = None
+        timings.append((name, round((time.perf_counter() - phase_started) * 1000, 1), count))
+    if close_connections:
+        # Connections must not be shared with forked workers.
+        connections.close_all()
+
+    total = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(
+        "Warm-up finished in %sms (pid %s): %s",
+        total,
+        os.getpid(),
+        ', '.join(f"{name}={ms}ms" + (f" [{count}]" if count is not None else ' [failed]') for name, ms, count in timings)
+    )
+    return timings
@@ -0,0 +1,95 @@
+/*
+ * Live updates for the patient listing and pending-assessment pages.
+ *
+ * Listens to /api/events/ (server-sent change notifications, see
+ * patients/events.py) and re-fetches only the rows a change touched from the
+ * page's row endpoint. A 404 or 204 from that endpoint removes the row. A
+ * "resync" event means notifications were missed, so the page reloads.
+ */
+(function () {
+    var root = document.querySelector('[data-live-rows]');
+    if (!root || !window.EventSource) {
+        return;
+    }
+
+    var rowsUrl = root.dataset.liveRows;
+    var key = root.dataset.liveKey;
+    var insert = root.dataset.liveInsert;
+    var queued = {};
+    var timer = null;
+
+    function render(id, html) {
+        var current = document.getElementById(key + '-row-' + id);
+        var tbody = root.querySelector('tbody');
+        if (html === null) {
+            if (current) {
+                current.remove();
+            }
+            return;
+        }
+        var template = document.createElement('template');
+        template.innerHTML = html.trim();
+        var row = template.content.firstElementChild;
+        if (current) {
+            current.replaceWith(row);
+        } else if (insert && !tbody) {
+            // The page is showing its empty state; render the table.
+            window.location.reload();
+        } else if (insert === 'start') {
+            tbody.insertBefore(row, tbody.firstChild);
+        } else if (insert === 'end') {
+            tbody.appendChild(row);
+        }
+    }
+
+    function refresh(id) {
+        fetch(rowsUrl + id + '/', {credentials: 'same-origin'}).then(function (response) {
+            if (response.status === 404 || response.status === 204) {
+                render(id, null);
+            } else if (response.ok) {
+                response.text().then(function (html) {
+                    render(id, html);
+                });
+            }
+        });
+    }
+
+    function flush() {
+        var ids = Object.keys(queued);
+        queued = {};
+        timer = null;
+        ids.forEach(refresh);
+    }
+
+    function queue(id) {
+        if (id === null || id === undefined) {
+            return;
+        }
+        queued[id] = true;
+        if (timer === null) {
+            // Several notifications for one save (visit + assessment) share a fetch.
+            timer = window.setTimeout(flush, 250);
+        }
+    }
+
+    function changed(event) {
+        var data = JSON.parse(event.data);
+        if (key === 'patient') {
+            queue(data.patient);
+        } else if (data.model === 'patient') {
+            root.querySelectorAll('tr[data-patient="' + data.patient + '"]').forEach(function (row) {
+                queue(row.id.slice(key.length + 5));
+            });
+        } else {
+            queue(data.visit);
+        }
+    }
+
+    var source = new EventSource('/api/events/?since=' + root.dataset.liveSince);
+    ['patient', 'visit', 'assessment'].forEach(function (name) {
+        source.addEventListener(name, changed);
+    });
+    source.addEventListener('resync', function () {
+        window.location.reload();
+    });
+})();
@@ -0,0 +1,62 @@
+/*
+ * Type-ahead on the registration form: while a patient ID or last name is
+ * typed, list already registered patients that match the prefix (from
+ * /api/patients/autocomplete/) with a link to record a visit for them.
+ */
+(function () {
+    var results = document.querySelector('[data-autocomplete-results]');
+    var inputs = document.querySelectorAll('[data-autocomplete]');
+    if (!results || !inputs.length) {
+        return;
+    }
+
+    var timer = null;
+    var latest = 0;
+
+    function show(rows) {
+        results.textContent = '';
+        results.hidden = !rows.length;
+        if (!rows.length) {
+            return;
+        }
+        results.appendChild(document.createTextNode('Already registered: '));
+        rows.forEach(function (row, index) {
+            var link = document.createElement('a');
+            link.href = '/patients/vitals/' + encodeURIComponent(row.patient_id) + '/';
+            link.textContent = row.patient_id + ' ' + row.name;
+            if (index) {
+                results.appendChild(document.createTextNode(', '));
+            }
+            results.appendChild(link);
+        });
+    }
+
+    function lookup(prefix) {
+        var request = ++latest;
+        fetch('/api/patients/autocomplete/?prefix=' + encodeURIComponent(prefix), {credentials: 'same-origin'})
+            .then(function (response) {
+                return response.ok ? response.json() : [];
+            })
+            .then(function (rows) {
+                // Ignore answers that arrive after a newer keystroke's.
+                if (request === latest) {
+                    show(rows);
+                }
+            });
+    }
+
+    inputs.forEach(function (input) {
+        input.addEventListener('input', function () {
+            var prefix = input.value.trim();
+            window.clearTimeout(timer);
+            if (!prefix) {
+                latest++;
+                show([]);
+                return;
+            }
+            timer = window.setTimeout(function () {
+                lookup(prefix);
+            }, 150);
+        });
+    });
+})();